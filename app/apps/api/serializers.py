@@ -1,6 +1,8 @@
 import bleach
+import hashlib
 import logging
 import html
+import os
 
 from django.conf import settings
 from django.db.models import Count, Q
@@ -26,7 +28,9 @@ from core.models import (Project,
                          OcrModel,
                          OcrModelDocument,
                          DocumentTag)
-from core.tasks import (segtrain, train, segment, transcribe)
+from core.tasks import (segtrain, train, segment)
+from imports.models import ImportUpload
+from imports.parsers import XML_EXTENSIONS
 from reporting.models import TaskReport
 
 logger = logging.getLogger(__name__)
@@ -212,12 +216,56 @@ class PartSerializer(serializers.ModelSerializer):
         data['document'] = document
         data['original_filename'] = data['image'].name
         data['image_file_size'] = data['image'].size
+        sha256 = hashlib.sha256()
+        for chunk in data['image'].chunks():
+            sha256.update(chunk)
+        data['image_hash'] = sha256.hexdigest()
+        # the same image was already uploaded, it is stored only once
+        upload = data['image']
+        twin = DocumentPart(document=document).find_twin_image(data['image_hash'])
+        if twin:
+            data['image'] = twin
         obj = super().create(data)
+        if twin and not obj.twin_image_kept():
+            upload.seek(0)
+            obj.image.save(upload.name, upload)
         # generate card thumbnail right away since we need it
         get_thumbnailer(obj.image).get_thumbnail(settings.THUMBNAIL_ALIASES['']['card'])
         return obj
 
 
+class ImportUploadSerializer(serializers.ModelSerializer):
+    offset = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = ImportUpload
+        fields = ('id', 'filename', 'size', 'offset', 'name', 'override', 'created_at')
+        read_only_fields = ('id', 'created_at')
+
+    def validate_filename(self, value):
+        # the same files as the ImportForm, checked before uploading them
+        extension = os.path.splitext(value)[1][1:]
+        if extension not in XML_EXTENSIONS + ['zip', 'pdf']:
+            raise serializers.ValidationError(_("Invalid extension for the file to be imported."))
+        return os.path.basename(value)
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError(_("The file is empty."))
+        return value
+
+    def validate(self, data):
+        # If quotas are enforced, assert that the user has enough disk storage left for ZIP and PDF files
+        user = self.context['request'].user
+        if (not settings.DISABLE_QUOTAS
+            and os.path.splitext(data['filename'])[1][1:] in ['zip', 'pdf']
+            and user.disk_storage_limit() != None):
+            if data['size'] > user.disk_storage_limit() - user.calc_disk_usage():
+                raise serializers.ValidationError(
+                    _("The file is bigger than the disk storage you have left."))
+        return data
+
+
 class BlockSerializer(serializers.ModelSerializer):
     typology = serializers.PrimaryKeyRelatedField(
         queryset=BlockType.objects.all(),
@@ -603,9 +651,4 @@ class TranscribeSerializer(ProcessSerializerMixin, serializers.Serializer):
             ocr_model_document.executed_on = timezone.now()
             ocr_model_document.save()
 
-        for part in self.validated_data.get('parts'):
-            part.chain_tasks(
-                transcribe.si(instance_pk=part.pk,
-                              model_pk=model.pk,
-                              user_pk=self.user.pk)
-            )
+        self.document.transcribe_parts(self.validated_data.get('parts'), model, user=self.user)
@@ -6,12 +6,21 @@ So no need to test the content unless there is some magic in the serializer.
 
 import unittest
 import os
+import time
+from datetime import timedelta
+from io import BytesIO
+
+from PIL import Image
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
+from django_redis import get_redis_connection
 
+from core import tiles
 from core.models import Block, Line, Transcription, LineTranscription, OcrModel
 from core.tests.factory import CoreFactoryTestCase
+from imports.models import DocumentImport, ImportUpload
 
 
 class UserViewSetTestCase(CoreFactoryTestCase):
@@ -372,7 +381,7 @@ class PartViewSetTestCase(CoreFactoryTestCase):
         self.client.force_login(self.user)
         uri = reverse('api:part-list',
                       kwargs={'document_pk': self.part.document.pk})
-        with self.assertNumQueries(42):
+        with self.assertNumQueries(43):
             img = self.factory.make_image_file()
             resp = self.client.post(uri, {
                 'image': SimpleUploadedFile(
@@ -403,6 +412,96 @@ class PartViewSetTestCase(CoreFactoryTestCase):
         self.part2.refresh_from_db()
         self.assertEqual(self.part2.order, 0)
 
+    @override_settings(IIIF_MAX_WIDTH=1000, IIIF_MAX_AREA=100 * 100)
+    def test_iiif(self):
+        self.client.force_login(self.user)
+        uri = reverse('api:part-detail',
+                      kwargs={'document_pk': self.part.document.pk,
+                              'pk': self.part.pk}) + 'iiif/'
+        resp = self.client.get(uri + 'info.json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual((resp.data['maxWidth'], resp.data['maxArea']), (1000, 100 * 100))
+
+        # the missing tiles are generated by a task
+        self.part.delete_tiles()
+        resp = self.client.get(uri + 'full/max/0/default.jpg')
+        self.assertEqual(resp.status_code, 503)
+        self.assertTrue(os.path.exists(tiles.tiles_base(self.part.image.path) + '.dzi'))
+
+        # the 864x206 image is bounded by maxArea
+        resp = self.client.get(uri + 'full/max/0/default.jpg')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.content)).size, (204, 48))
+        resp = self.client.get(uri + '0,0,30,30/20,/0/gray.png')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.content)).size, (20, 20))
+
+        for size in ('full', 'pct:200', '200,100', '1000,'):
+            resp = self.client.get(uri + 'full/%s/0/default.jpg' % size)
+            self.assertEqual(resp.status_code, 400, size)
+
+
+    @override_settings(THUMBNAIL_ENABLE=False, TILES_ENABLE=False)
+    def test_rotate(self):
+        # the image is 864x206
+        line = Line.objects.create(document_part=self.part,
+                                   baseline=[[10, 20], [100, 20]],
+                                   mask=[[10, 10], [100, 10], [100, 30], [10, 30]])
+        block = Block.objects.create(document_part=self.part,
+                                     box=[[0, 0], [50, 0], [50, 30], [0, 30]])
+        self.client.force_login(self.user)
+        uri = reverse('api:part-rotate',
+                      kwargs={'document_pk': self.part.document.pk,
+                              'pk': self.part.pk})
+        resp = self.client.post(uri, {'angle': 90}, content_type='application/json')
+        self.assertEqual(resp.status_code, 202)
+
+        # done by the task, clockwise
+        self.part.refresh_from_db()
+        self.assertEqual((self.part.image.width, self.part.image.height), (206, 864))
+        line.refresh_from_db()
+        self.assertEqual(line.baseline, [[186, 10], [186, 100]])
+        self.assertEqual(line.mask, [[196, 10], [196, 100], [176, 100], [176, 10]])
+        block.refresh_from_db()
+        self.assertEqual(block.box, [[206, 0], [206, 50], [176, 50], [176, 0]])
+
+    @override_settings(THUMBNAIL_ENABLE=False, TILES_ENABLE=False)
+    def test_crop(self):
+        line = Line.objects.create(document_part=self.part,
+                                   baseline=[[10, 20], [100, 20]],
+                                   mask=[[10, 10], [100, 10], [100, 30], [10, 30]])
+        block = Block.objects.create(document_part=self.part,
+                                     box=[[0, 0], [50, 0], [50, 30], [0, 30]])
+        self.client.force_login(self.user)
+        uri = reverse('api:part-crop',
+                      kwargs={'document_pk': self.part.document.pk,
+                              'pk': self.part.pk})
+        resp = self.client.post(uri, {'x1': 5, 'y1': 10, 'x2': 505, 'y2': 160},
+                                content_type='application/json')
+        self.assertEqual(resp.status_code, 202)
+
+        self.part.refresh_from_db()
+        self.assertEqual((self.part.image.width, self.part.image.height), (500, 150))
+        line.refresh_from_db()
+        self.assertEqual(line.baseline, [[5, 10], [95, 10]])
+        self.assertEqual(line.mask, [[5, 0], [95, 0], [95, 20], [5, 20]])
+        block.refresh_from_db()
+        self.assertEqual(block.box, [[-5, -10], [45, -10], [45, 20], [-5, 20]])
+
+    def test_transform_conflict(self):
+        # a rotation or a crop of the part is still running
+        get_redis_connection().set('transform-%d' % self.part.pk, 1)
+        self.client.force_login(self.user)
+        for action, data in (('rotate', {'angle': 90}),
+                             ('crop', {'x1': 5, 'y1': 10, 'x2': 505, 'y2': 160})):
+            uri = reverse('api:part-%s' % action,
+                          kwargs={'document_pk': self.part.document.pk,
+                                  'pk': self.part.pk})
+            resp = self.client.post(uri, data, content_type='application/json')
+            self.assertEqual(resp.status_code, 409)
+        self.part.refresh_from_db()
+        self.assertEqual((self.part.image.width, self.part.image.height), (864, 206))
+
 
 class BlockViewSetTestCase(CoreFactoryTestCase):
     def setUp(self):
@@ -439,11 +538,12 @@ class BlockViewSetTestCase(CoreFactoryTestCase):
         uri = reverse('api:block-list',
                       kwargs={'document_pk': self.part.document.pk,
                               'part_pk': self.part.pk})
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(6):
             # 1-2: auth
             # 3 select document_part
             # 4 select max block order
             # 5 insert
+            # 6 touch the part
             resp = self.client.post(uri, {
                 'document_part': self.part.pk,
                 'box': '[[10,10], [20,20], [50,50]]'
@@ -456,7 +556,7 @@ class BlockViewSetTestCase(CoreFactoryTestCase):
                       kwargs={'document_pk': self.part.document.pk,
                               'part_pk': self.part.pk,
                               'pk': self.block.pk})
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(6):
             resp = self.client.patch(uri, {
                 'box': '[[100,100], [150,150]]'
             }, content_type='application/json')
@@ -493,7 +593,7 @@ class LineViewSetTestCase(CoreFactoryTestCase):
         uri = reverse('api:line-list',
                       kwargs={'document_pk': self.part.document.pk,
                               'part_pk': self.part.pk})
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(6):
             resp = self.client.post(uri, {
                 'document_part': self.part.pk,
                 'baseline': '[[10, 10], [50, 50]]'
@@ -507,7 +607,7 @@ class LineViewSetTestCase(CoreFactoryTestCase):
                       kwargs={'document_pk': self.part.document.pk,
                               'part_pk': self.part.pk,
                               'pk': self.line.pk})
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(6):
             resp = self.client.patch(uri, {
                 'baseline': '[[100,100], [150,150]]'
             }, content_type='application/json')
@@ -519,7 +619,7 @@ class LineViewSetTestCase(CoreFactoryTestCase):
         self.client.force_login(self.user)
         uri = reverse('api:line-bulk-delete',
                       kwargs={'document_pk': self.part.document.pk, 'part_pk': self.part.pk})
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(6):
             resp = self.client.post(uri, {'lines': [self.line.pk]},
                                     content_type='application/json')
         self.assertEqual(Line.objects.count(), 2)
@@ -529,7 +629,7 @@ class LineViewSetTestCase(CoreFactoryTestCase):
         self.client.force_login(self.user)
         uri = reverse('api:line-bulk-update',
                       kwargs={'document_pk': self.part.document.pk, 'part_pk': self.part.pk})
-        with self.assertNumQueries(7):
+        with self.assertNumQueries(8):
             resp = self.client.put(uri, {'lines': [
                 {'pk': self.line.pk,
                  'mask': '[[60, 40], [60, 50], [90, 50], [90, 40]]',
@@ -667,3 +767,126 @@ class LineTranscriptionViewSetTestCase(CoreFactoryTestCase):
             self.assertEqual(lines[0].content, "")
             self.assertEqual(lines[1].content, "")
             self.assertEqual(resp.status_code, 204)
+
+    def test_delete(self):
+        self.client.force_login(self.user)
+        uri = reverse('api:linetranscription-detail',
+                      kwargs={'document_pk': self.part.document.pk,
+                              'part_pk': self.part.pk,
+                              'pk': self.lt.pk})
+        updated_at = self.part.updated_at
+        resp = self.client.delete(uri)
+        self.assertEqual(resp.status_code, 204)
+        self.assertFalse(LineTranscription.objects.filter(pk=self.lt.pk).exists())
+        # the cached exports of the part are invalidated
+        self.part.refresh_from_db()
+        self.assertGreater(self.part.updated_at, updated_at)
+
+
+class ImportUploadViewSetTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.factory.make_document()
+        # matched by the alto files of the zip
+        self.part1 = self.factory.make_part(document=self.document,
+                                            original_filename='test1.png')
+        self.part2 = self.factory.make_part(document=self.document,
+                                            original_filename='test2.png')
+        self.client.force_login(self.document.owner)
+        mock_path = os.path.join(os.path.dirname(__file__), '..', 'imports', 'mocks', 'test.zip')
+        with open(mock_path, 'rb') as fh:
+            self.content = fh.read()
+
+    def put_chunk(self, uri, first, last):
+        return self.client.put(
+            uri, self.content[first:last + 1],
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes %d-%d/%d' % (first, last, len(self.content)))
+
+    def test_upload(self):
+        resp = self.client.post(
+            reverse('api:upload-list', kwargs={'document_pk': self.document.pk}),
+            {'filename': 'test.zip', 'size': len(self.content)})
+        self.assertEqual(resp.status_code, 201, resp.content)
+        self.assertEqual(resp.json()['offset'], 0)
+        uri = reverse('api:upload-detail', kwargs={'document_pk': self.document.pk,
+                                                   'pk': resp.json()['id']})
+        half = len(self.content) // 2
+
+        resp = self.put_chunk(uri, 0, half - 1)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()['offset'], half)
+
+        # the chunk was lost, the upload resumes from the offset
+        resp = self.put_chunk(uri, half + 10, len(self.content) - 1)
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self.client.get(uri).json()['offset'], half)
+
+        resp = self.put_chunk(uri, half, len(self.content) - 1)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()['status'], 'ok')
+
+        imp = DocumentImport.objects.get(pk=resp.json()['import'])
+        self.assertEqual(imp.workflow_state, DocumentImport.WORKFLOW_STATE_DONE)
+        self.assertEqual(self.part1.lines.count(), 3)
+        self.assertEqual(self.part2.lines.count(), 1)
+        self.assertFalse(ImportUpload.objects.exists())
+
+    def test_create_forbidden(self):
+        # another user's document or a document which doesn't exist
+        other = self.factory.make_document()
+        for pk in [other.pk, other.pk + 1000]:
+            resp = self.client.post(reverse('api:upload-list', kwargs={'document_pk': pk}),
+                                    {'filename': 'test.zip', 'size': len(self.content)})
+            self.assertEqual(resp.status_code, 403)
+        self.assertFalse(ImportUpload.objects.exists())
+
+    def test_invalid_extension(self):
+        resp = self.client.post(
+            reverse('api:upload-list', kwargs={'document_pk': self.document.pk}),
+            {'filename': 'test.exe', 'size': 10})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_chunk_beyond_size(self):
+        upload = ImportUpload.objects.create(document=self.document,
+                                             created_by=self.document.owner,
+                                             filename='test.zip', size=len(self.content))
+        uri = reverse('api:upload-detail', kwargs={'document_pk': self.document.pk,
+                                                   'pk': upload.pk})
+        resp = self.put_chunk(uri, 0, len(self.content))
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(upload.offset, 0)
+
+    @override_settings(DISABLE_QUOTAS=False)
+    def test_disk_quota(self):
+        owner = self.document.owner
+        owner.quota_disk_storage = 1  # Mb
+        owner.save()
+        uri = reverse('api:upload-list', kwargs={'document_pk': self.document.pk})
+        left = owner.disk_storage_limit() - owner.calc_disk_usage()
+        resp = self.client.post(uri, {'filename': 'test.zip', 'size': left + 1})
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.post(uri, {'filename': 'test.zip', 'size': left})
+        self.assertEqual(resp.status_code, 201, resp.content)
+
+    def test_purge(self):
+        old, recent = [ImportUpload.objects.create(document=self.document,
+                                                   created_by=self.document.owner,
+                                                   filename='test.zip', size=len(self.content))
+                       for i in range(2)]
+        ImportUpload.objects.filter(pk=old.pk).update(
+            created_at=timezone.now() - timedelta(hours=2))
+        for upload in (old, recent):
+            upload.append(BytesIO(self.content), 0, 10)
+        # left by a crash
+        orphan = os.path.join(os.path.dirname(old.path), 'orphan')
+        with open(orphan, 'wb') as fh:
+            fh.write(b'test')
+        os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+
+        self.assertEqual(ImportUpload.purge(3600), 2)
+        self.assertEqual(list(ImportUpload.objects.all()), [recent])
+        self.assertFalse(os.path.exists(old.path))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(recent.offset, 10)
+        recent.delete()
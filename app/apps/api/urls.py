@@ -14,7 +14,8 @@ from api.views import (ProjectViewSet,
                        LineTranscriptionViewSet,
                        ScriptViewSet,
                        OcrModelViewSet,
-                       TagViewSet)
+                       TagViewSet,
+                       ImportUploadViewSet)
 
 router = routers.DefaultRouter()
 router.register(r'scripts', ScriptViewSet)
@@ -31,6 +32,7 @@ projects_router.register(r'tags', TagViewSet, basename='tag')
 documents_router = routers.NestedSimpleRouter(router, r'documents', lookup='document')
 documents_router.register(r'parts', PartViewSet, basename='part')
 documents_router.register(r'transcriptions', DocumentTranscriptionViewSet, basename='transcription')
+documents_router.register(r'uploads', ImportUploadViewSet, basename='upload')
 
 parts_router = routers.NestedSimpleRouter(documents_router, r'parts', lookup='part')
 parts_router.register(r'blocks', BlockViewSet)
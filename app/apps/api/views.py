@@ -1,17 +1,21 @@
 import json
 import logging
+import os
+import re
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.db.models import Prefetch
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils import timezone
+from django_redis import get_redis_connection
 
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework import status
-from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from rest_framework import mixins, status
+from rest_framework.viewsets import GenericViewSet, ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.serializers import PrimaryKeyRelatedField
 
@@ -36,7 +40,8 @@ from api.serializers import (UserOnboardingSerializer,
                              ScriptSerializer,
                              TranscribeSerializer,
                              OcrModelSerializer,
-                             TagDocumentSerializer)
+                             TagDocumentSerializer,
+                             ImportUploadSerializer)
 
 from core.models import (Project,
                          Document,
@@ -52,13 +57,17 @@ from core.models import (Project,
                          AlreadyProcessingException,
                          DocumentTag)
 
-from core.tasks import recalculate_masks
+from core import tiles
+from core.tasks import recalculate_masks, rotate, crop, generate_part_tiles
 from users.models import User
 from imports.forms import ImportForm, ExportForm
+from imports.models import ImportUpload, UploadConflict
 from imports.parsers import ParseError
 from versioning.models import NoChangeException
 from reporting.models import TaskReport
 
+redis_ = get_redis_connection()
+
 logger = logging.getLogger(__name__)
 
 
@@ -205,12 +214,18 @@ class DocumentViewSet(ModelViewSet):
             return Response({'status': 'failed'}, status=400)
         return Response({'status': 'canceled'})
 
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['get', 'post'])
     def export(self, request, pk=None):
         document = self.get_object()
-        form = ExportForm(document, request.user, request.POST)
+        # a GET streams the export, so that its download can be resumed
+        if request.method == 'GET':
+            form = ExportForm(document, request.user, request.GET)
+        else:
+            form = ExportForm(document, request.user, request.POST)
         if form.is_valid():
-            # return form.stream()
+            if form.cleaned_data['streaming'] or request.method == 'GET':
+                return form.stream(range_header=request.META.get('HTTP_RANGE'),
+                                   if_range=request.META.get('HTTP_IF_RANGE'))
             form.process()
             return Response({'status': 'ok'})
         else:
@@ -262,6 +277,27 @@ class DocumentPermissionMixin():
         return super().get_queryset()
 
 
+class PartChildMixin():
+    """
+    Touches the part when its lines or blocks are changed,
+    its cached exports are invalidated by it.
+    """
+    def touch_part(self):
+        DocumentPart(pk=self.kwargs['part_pk']).touch()
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        self.touch_part()
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        self.touch_part()
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        self.touch_part()
+
+
 class PartViewSet(DocumentPermissionMixin, ModelViewSet):
     queryset = DocumentPart.objects.all().select_related('document')
 
@@ -332,13 +368,28 @@ class PartViewSet(DocumentPermissionMixin, ModelViewSet):
         serializer = LineOrderSerializer(document_part.lines.all(), many=True)
         return Response({'status': 'done', 'lines': serializer.data}, status=200)
 
+    def lock_transform(self, document_part):
+        """
+        Only one rotation or crop of a part at a time, they would both move the polygons.
+        The lock is released by the task.
+        """
+        return redis_.set('transform-%d' % document_part.pk, 1, nx=True, ex=3600)
+
+    def transform_conflict(self):
+        return Response({'error': "The image is already being rotated or cropped."},
+                        status=status.HTTP_409_CONFLICT)
+
     @action(detail=True, methods=['post'])
     def rotate(self, request, document_pk=None, pk=None):
         document_part = DocumentPart.objects.get(pk=pk)
         angle = self.request.data.get('angle')
         if angle:
-            document_part.rotate(angle)
-            return Response({'status': 'done'}, status=200)
+            if not self.lock_transform(document_part):
+                return self.transform_conflict()
+            # images, thumbnails and polygons are updated in the background,
+            # a part:rotated event is sent when it's done.
+            rotate.delay(instance_pk=document_part.pk, user_pk=request.user.pk, angle=angle)
+            return Response({'status': 'pending'}, status=202)
         else:
             return Response({'error': "Post an angle."},
                             status=status.HTTP_400_BAD_REQUEST)
@@ -354,13 +405,139 @@ class PartViewSet(DocumentPermissionMixin, ModelViewSet):
             and y1 is not None
             and x2 is not None
             and y2 is not None):
-            document_part.crop(x1, y1, x2, y2)
-            return Response({'status': 'done'}, status=200)
+            if not self.lock_transform(document_part):
+                return self.transform_conflict()
+            crop.delay(instance_pk=document_part.pk, user_pk=request.user.pk,
+                       x1=x1, y1=y1, x2=x2, y2=y2)
+            return Response({'status': 'pending'}, status=202)
         else:
             return Response({'error': "Post corners as x1, y1 (top left) and x2, y2 (bottom right)."},
                             status=status.HTTP_400_BAD_REQUEST)
 
 
+    @action(detail=True, methods=['get'], url_path='iiif/info.json')
+    def iiif_info(self, request, document_pk=None, pk=None):
+        document_part = self.get_object()
+        url = request.build_absolute_uri(reverse('api:part-detail', kwargs={
+            'document_pk': document_pk, 'pk': pk})) + 'iiif'
+        return Response(tiles.info(url, document_part.image.width, document_part.image.height,
+                                   settings.IIIF_MAX_WIDTH, settings.IIIF_MAX_AREA))
+
+    @action(detail=True, methods=['get'],
+            url_path=(r'iiif/(?P<region>[^/]+)/(?P<size>[^/]+)/(?P<rotation>\d+)/'
+                      r'(?P<quality>\w+)\.(?P<extension>jpg|png)'))
+    def iiif(self, request, document_pk=None, pk=None,
+             region=None, size=None, rotation=None, quality=None, extension=None):
+        """
+        IIIF Image API (level 1) requests served from the pyramid of tiles of the image.
+        """
+        document_part = self.get_object()
+        width, height = document_part.image.width, document_part.image.height
+        base = tiles.tiles_base(document_part.image.path)
+        if not os.path.exists(base + '.dzi'):
+            # parts imported before the tiles existed, generated once by a task
+            if redis_.set('tiles-%d' % document_part.pk, 1, nx=True, ex=60 * 60):
+                generate_part_tiles.delay(instance_pk=document_part.pk)
+            response = Response({'error': 'The tiles of the image are being generated.'},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response['Retry-After'] = 10
+            return response
+
+        try:
+            region = tiles.parse_region(region, width, height)
+            size = tiles.parse_size(size, region[2], region[3],
+                                    settings.IIIF_MAX_WIDTH, settings.IIIF_MAX_AREA)
+            if int(rotation) % 90 or quality not in ('default', 'color', 'gray'):
+                raise tiles.TileRequestError('Unsupported rotation or quality.')
+        except tiles.TileRequestError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        im = tiles.render_region(base, width, height, region, size)
+        if int(rotation):
+            im = im.rotate(-int(rotation), expand=True)
+        if quality == 'gray':
+            im = im.convert('L')
+
+        response = HttpResponse(content_type=extension == 'png' and 'image/png' or 'image/jpeg')
+        im.save(response, format=extension == 'png' and 'PNG' or 'JPEG')
+        return response
+
+
+class ImportUploadViewSet(DocumentPermissionMixin,
+                          mixins.CreateModelMixin,
+                          mixins.RetrieveModelMixin,
+                          mixins.DestroyModelMixin,
+                          GenericViewSet):
+    """
+    Resumable upload of the file of an import:
+    POST {filename, size, name, override} to create the upload,
+    then PUT the chunks in order as the raw body of requests with a Content-Range header
+    (bytes <first>-<last>/<size>). A chunk not starting at the current offset is refused (409),
+    GET returns the offset to resume from after a failure.
+    The file is validated and its import queued once the last chunk is received.
+    """
+    queryset = ImportUpload.objects.all()
+    serializer_class = ImportUploadSerializer
+
+    def get_queryset(self):
+        return (super().get_queryset()
+                .filter(document=self.kwargs['document_pk'], created_by=self.request.user))
+
+    def create(self, request, document_pk=None):
+        # unlike the other actions, the creation doesn't go through get_queryset
+        if not Document.objects.for_user(request.user).filter(pk=document_pk).exists():
+            raise PermissionDenied
+        return super().create(request, document_pk=document_pk)
+
+    def perform_create(self, serializer):
+        serializer.save(document_id=self.kwargs['document_pk'], created_by=self.request.user)
+
+    def update(self, request, document_pk=None, pk=None):
+        upload = self.get_object()
+        match = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not match:
+            return Response({'status': 'error', 'error': 'Invalid or missing Content-Range header.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        first, last, size = [int(g) for g in match.groups()]
+        if size != upload.size or last < first or request.stream is None:
+            return Response({'status': 'error', 'error': 'Invalid Content-Range header.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if last >= upload.size:
+            return Response({'status': 'error', 'error': 'The chunk goes beyond the size of the file.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            offset = upload.append(request.stream, first, last - first + 1)
+        except UploadConflict as e:
+            return Response({'status': 'error', 'error': str(e), 'offset': upload.offset},
+                            status=status.HTTP_409_CONFLICT)
+
+        if offset < upload.size:
+            return Response(self.get_serializer(upload).data)
+        return self.complete(upload)
+
+    def complete(self, upload):
+        document = upload.document
+        with upload.assembled_file() as upload_file:
+            form = ImportForm(document, self.request.user,
+                              {'name': upload.name, 'override': upload.override},
+                              {'upload_file': upload_file})
+            if not form.is_valid():
+                upload.delete()
+                return Response({'status': 'error', 'error': json.dumps(form.errors)},
+                                status=status.HTTP_400_BAD_REQUEST)
+            # moves the file to the storage
+            form.save()
+        upload.delete()
+        try:
+            form.process()
+        except ParseError:
+            return Response({'status': 'error',
+                             'error': "Incorrectly formatted file, couldn't parse it."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({'status': 'ok', 'import': form.instance.pk})
+
+
 class DocumentTranscriptionViewSet(ModelViewSet):
     # Note: there is no dedicated Transcription viewset, it's always in the context of a Document
     queryset = Transcription.objects.all()
@@ -386,7 +563,7 @@ class LineTypeViewSet(ModelViewSet):
     serializer_class = LineTypeSerializer
 
 
-class BlockViewSet(DocumentPermissionMixin, ModelViewSet):
+class BlockViewSet(DocumentPermissionMixin, PartChildMixin, ModelViewSet):
     queryset = Block.objects.select_related('typology')
     serializer_class = BlockSerializer
 
@@ -396,7 +573,7 @@ class BlockViewSet(DocumentPermissionMixin, ModelViewSet):
                 .filter(document_part__document=self.kwargs['document_pk']))
 
 
-class LineViewSet(DocumentPermissionMixin, ModelViewSet):
+class LineViewSet(DocumentPermissionMixin, PartChildMixin, ModelViewSet):
     queryset = (Line.objects.select_related('block')
                             .select_related('typology'))
 
@@ -417,6 +594,7 @@ class LineViewSet(DocumentPermissionMixin, ModelViewSet):
         serializer = LineSerializer(data=lines, many=True)
         serializer.is_valid(raise_exception=True)
         serializer.save()
+        self.touch_part()
         return Response({'status': 'ok', 'lines': serializer.data})
 
     @action(detail=False, methods=['put'])
@@ -426,6 +604,7 @@ class LineViewSet(DocumentPermissionMixin, ModelViewSet):
         serializer = LineSerializer(qs, data=lines, partial=True, many=True)
         serializer.is_valid(raise_exception=True)
         serializer.save()
+        self.touch_part()
         return Response({'status': 'ok', 'lines': serializer.data}, status=200)
 
     @action(detail=False, methods=['post'])
@@ -433,6 +612,7 @@ class LineViewSet(DocumentPermissionMixin, ModelViewSet):
         deleted_lines = request.data.get("lines")
         qs = Line.objects.filter(pk__in=deleted_lines)
         qs.delete()
+        self.touch_part()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, methods=['post'])
@@ -442,6 +622,7 @@ class LineViewSet(DocumentPermissionMixin, ModelViewSet):
         serializer = LineOrderSerializer(qs, data=data, many=True)
         if serializer.is_valid():
             resp = serializer.save()
+            self.touch_part()
             return Response(resp, status=200)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -477,6 +658,11 @@ class LineTranscriptionViewSet(DocumentPermissionMixin, ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(version_author=self.request.user.username)
 
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        # the remaining versions don't tell the cached exports that it is gone
+        DocumentPart(pk=self.kwargs['part_pk']).touch()
+
     def update(self, request, document_pk=None, part_pk=None, pk=None, partial=False):
         instance = self.get_object()
         try:
@@ -539,7 +725,8 @@ class LineTranscriptionViewSet(DocumentPermissionMixin, ModelViewSet):
     def bulk_delete(self, request, document_pk=None, part_pk=None, pk=None):
         lines = request.data.get("lines")
         qs = LineTranscription.objects.filter(pk__in=lines)
-        qs.update(content='')
+        # bulk updates bypass auto_now, the version date invalidates the cached exports
+        qs.update(content='', version_updated_at=timezone.now())
         return Response(status=status.HTTP_204_NO_CONTENT, )
 
 
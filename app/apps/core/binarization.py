@@ -0,0 +1,95 @@
+"""
+Memory bounded binarization of (very) large images.
+
+nlbin works on several float64 copies of the whole image, a 600dpi double page
+scan needs several Gb of memory. Above a memory limit the image is cut in
+overlapping tiles binarized independently, the overlap being cropped when the
+tiles are stitched back together so that the local normalization of nlbin
+doesn't produce visible seams.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import current_process
+
+from PIL import Image
+from kraken.binarization import nlbin
+from kraken.lib.util import is_bitonal
+
+# approximate peak memory used by nlbin per pixel of the image (float64 arrays)
+NLBIN_BYTES_PER_PIXEL = 48
+MIN_TILE_SIZE = 512
+
+
+def get_tile_size(memory_limit, overlap):
+    """The side of the square tiles (without overlap) fitting in memory_limit bytes."""
+    side = int(math.sqrt(memory_limit / NLBIN_BYTES_PER_PIXEL))
+    return max(side - 2 * overlap, MIN_TILE_SIZE)
+
+
+def make_tiles(width, height, tile_size, overlap):
+    """
+    Returns a list of (box, inner) tuples,
+    box being the area to binarize (with the overlap)
+    and inner the area of the result to keep, relative to the image.
+    """
+    tiles = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            inner = (x, y, min(x + tile_size, width), min(y + tile_size, height))
+            box = (max(inner[0] - overlap, 0), max(inner[1] - overlap, 0),
+                   min(inner[2] + overlap, width), min(inner[3] + overlap, height))
+            tiles.append((box, inner))
+    return tiles
+
+
+def binarize_tile(tile, threshold=None):
+    lo, hi = tile.getextrema()
+    if lo == hi:
+        # nlbin refuses uniform images (Image is empty), happens in margins
+        return Image.new('L', tile.size, 255 if lo > 127 else 0)
+    if threshold is not None:
+        return nlbin(tile, threshold)
+    return nlbin(tile)
+
+
+def binarize(im, threshold=None, memory_limit=None, overlap=128, executor=None, processes=1):
+    """
+    Binarizes the PIL image im with nlbin.
+    If memory_limit (in bytes) is given and the image doesn't fit in it, it is binarized by tiles,
+    in parallel if a (process pool) executor is given, the limit is then shared
+    by its processes workers.
+    """
+    if is_bitonal(im):
+        return im
+
+    if memory_limit is None or im.width * im.height * NLBIN_BYTES_PER_PIXEL <= memory_limit:
+        if threshold is not None:
+            return nlbin(im, threshold)
+        return nlbin(im)
+
+    im = im.convert('L')
+    tile_size = get_tile_size(memory_limit / processes, overlap)
+    tiles = make_tiles(im.width, im.height, tile_size, overlap)
+    crops = (im.crop(box) for box, inner in tiles)
+    if executor:
+        results = executor.map(binarize_tile, crops, repeat(threshold))
+    else:
+        results = map(binarize_tile, crops, repeat(threshold))
+
+    res = Image.new('L', im.size, 255)
+    for (box, inner), tile in zip(tiles, results):
+        # only keep the tile without its overlap
+        res.paste(tile.crop((inner[0] - box[0], inner[1] - box[1],
+                             inner[2] - box[0], inner[3] - box[1])),
+                  inner[:2])
+        tile.close()
+    return res
+
+
+def make_executor(processes):
+    if processes < 2:
+        return None
+    # # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
+    current_process().daemon = False
+    return ProcessPoolExecutor(max_workers=processes)
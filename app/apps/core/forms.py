@@ -264,10 +264,18 @@ class BinarizeForm(BootstrapFormMixin, DocumentProcessFormBase):
             self.parts[0].bw_image = self.cleaned_data['bw_image']
             self.parts[0].save()
         else:
+            to_binarize = []
             for part in parts:
-                part.task('binarize',
-                          user_pk=self.user.pk,
-                          threshold=self.cleaned_data.get('threshold'))
+                if part.converted:
+                    to_binarize.append(part)
+                else:
+                    # needs to be converted first
+                    part.task('binarize',
+                              user_pk=self.user.pk,
+                              threshold=self.cleaned_data.get('threshold'))
+            if to_binarize:
+                self.document.binarize_parts(to_binarize, user=self.user,
+                                             threshold=self.cleaned_data.get('threshold'))
 
 
 class SegmentForm(BootstrapFormMixin, DocumentProcessFormBase):
@@ -363,10 +371,18 @@ class TranscribeForm(BootstrapFormMixin, DocumentProcessFormBase):
             ocr_model_document.executed_on = timezone.now()
             ocr_model_document.save()
 
+        to_transcribe = []
         for part in self.cleaned_data.get('parts'):
-            part.task('transcribe',
-                      user_pk=self.user.pk,
-                      model_pk=model.pk)
+            if part.segmented:
+                to_transcribe.append(part)
+            else:
+                # needs to be segmented first
+                part.task('transcribe',
+                          user_pk=self.user.pk,
+                          model_pk=model.pk)
+
+        if to_transcribe:
+            self.document.transcribe_parts(to_transcribe, model, user=self.user)
 
 
 class TrainMixin():
@@ -0,0 +1,58 @@
+"""
+Affine transformations of the polygons (baselines, masks, boxes) of a DocumentPart.
+
+All the polygons of a page are concatenated in a single numpy array
+so that rotating or cropping a page is one matrix product
+instead of building a shapely geometry per line.
+"""
+import math
+
+import numpy as np
+
+
+def rotation_matrix(angle, center, offset=(0, 0)):
+    """
+    The 2x3 matrix rotating points by angle (in degrees) around center,
+    then translating them by -offset.
+    Same convention as shapely.affinity.rotate (counter clockwise in a y up space).
+    """
+    theta = math.radians(angle)
+    cos, sin = math.cos(theta), math.sin(theta)
+    cx, cy = center
+    return np.array([
+        [cos, -sin, cx - cos * cx + sin * cy - offset[0]],
+        [sin, cos, cy - sin * cx - cos * cy - offset[1]],
+    ])
+
+
+def translation_matrix(dx, dy):
+    return np.array([
+        [1, 0, dx],
+        [0, 1, dy],
+    ], dtype=float)
+
+
+def transform_polygons(polygons, matrix):
+    """
+    polygons: a list of polygons (lists of [x, y] points), None or empty ones are kept as is.
+    matrix: a 2x3 affine matrix.
+
+    Returns the list of transformed polygons, coordinates being rounded to integers
+    (truncating would turn the float errors of a 90° rotation into off by one pixels).
+    """
+    indexes = [i for i, poly in enumerate(polygons) if poly]
+    if not indexes:
+        return list(polygons)
+
+    lengths = [len(polygons[i]) for i in indexes]
+    points = np.concatenate([np.asarray(polygons[i], dtype=float).reshape(-1, 2)
+                             for i in indexes])
+    transformed = points @ matrix[:, :2].T + matrix[:, 2]
+    transformed = np.rint(transformed).astype(int).tolist()
+
+    result = list(polygons)
+    start = 0
+    for i, length in zip(indexes, lengths):
+        result[i] = transformed[start:start + length]
+        start += length
+    return result
@@ -0,0 +1,367 @@
+import functools
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.template import loader
+from django.test.utils import (setup_test_environment, teardown_test_environment,
+                               override_settings)
+from django.urls import reverse
+
+from core.ordering import reading_order, line_origin_pt, poly_origin_pt, avg_line_height_block
+from core.tests.factory import CoreFactory
+from imports import export
+from imports.parsers import make_parser
+
+BENCHMARKS = ['recalculate_ordering', 'make_masks',
+              'export_text', 'export_alto', 'export_pagexml',
+              # rendering of the pages through the templates or the writers used by the export
+              'render_alto_template', 'render_alto', 'render_pagexml_template', 'render_pagexml',
+              'api',
+              'import_alto', 'import_pagexml',
+              'segmentation_postprocessing',
+              # ordering of the lines of synthetic pages, with the legacy comparator as a reference
+              'reading_order', 'reading_order_legacy']
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of the process to its current RSS (linux only),
+    returns whether it could.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """The peak RSS of the process since the last reset_peak_rss, in bytes."""
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # since the start of the process, ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def max_rss_children():
+    """The RSS of the biggest child process so far, in bytes, it can't be reset."""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def legacy_reading_order(lines, blocks, origin, rtl=False):
+    """
+    The cmp_to_key comparator DocumentPart.recalculate_ordering used to rely on,
+    kept as a reference for the benchmark.
+    """
+    def distance(x, y):
+        return math.sqrt(sum([(a - b) ** 2 for a, b in zip(x, y)]))
+
+    origins = {}
+
+    def origin_pt(i):
+        if i not in origins:
+            baseline, mask, _ = lines[i]
+            origins[i] = tuple(line_origin_pt(baseline, mask, origin, rtl=rtl))
+        return origins[i]
+
+    by_block = {}
+    for i, (_, _, block) in enumerate(lines):
+        by_block.setdefault(block or 0, []).append(i)
+    avg_heights = {pk: avg_line_height_block(np.array([origin_pt(i) for i in idx]))
+                   for pk, idx in by_block.items()}
+
+    def cmp_lines(a, b):
+        block_a, block_b = lines[a][2], lines[b][2]
+        if block_a != block_b:
+            pt1 = poly_origin_pt(blocks[block_a], origin) if block_a else origin_pt(a)
+            pt2 = poly_origin_pt(blocks[block_b], origin) if block_b else origin_pt(b)
+            return distance(pt1, origin) - distance(pt2, origin)
+        pt1, pt2 = origin_pt(a), origin_pt(b)
+        if abs(pt1[1] - pt2[1]) < avg_heights[block_a or 0]:
+            return distance(pt1, origin) - distance(pt2, origin)
+        return pt1[1] - pt2[1]
+
+    return sorted(range(len(lines)), key=functools.cmp_to_key(cmp_lines))
+
+
+def make_page(n_lines, n_columns=2, orphans=0.05, line_height=40, width=2000, seed=0):
+    """
+    A synthetic page of n_lines baselines spread over n_columns blocks,
+    with a small ratio of orphan lines in the margin.
+    """
+    rng = random.Random(seed)
+    column_width = width // n_columns
+    per_column = max(1, n_lines // n_columns)
+    blocks, lines = {}, []
+    for c in range(n_columns):
+        pk = c + 1
+        x0 = c * column_width + 50
+        blocks[pk] = [[x0, 50], [x0 + column_width - 100, 50],
+                      [x0 + column_width - 100, 50 + per_column * line_height],
+                      [x0, 50 + per_column * line_height]]
+        for i in range(per_column):
+            y = 80 + i * line_height + rng.randint(-5, 5)
+            if rng.random() < orphans:
+                # margin note
+                lines.append(([[5, y], [45, y]], None, None))
+            else:
+                x = x0 + rng.randint(0, 20)
+                lines.append(([[x, y], [x + column_width - 150, y + rng.randint(-3, 3)]],
+                              None, pk))
+    rng.shuffle(lines)
+    return lines, blocks
+
+
+class Benchmark:
+    """
+    Runs the hot paths of the processing pipeline on a synthetic document
+    made by CoreFactory.make_synthetic_document and collects for each of them
+    the wall time, the number of database queries and the peak RSS of the process
+    during the step (only since its start if peak_rss_per_step is false, outside of linux).
+    The biggest child process so far is also reported for the steps using a pool of processes.
+    """
+
+    def __init__(self, factory, parts=2, lines=100, transcriptions=1, repeat=1, tmp_dir=None,
+                 ordering_lines=1000, columns=2, rtl=False):
+        self.factory = factory
+        self.repeat = repeat
+        self.tmp_dir = tmp_dir or tempfile.mkdtemp()
+        self.config = {'parts': parts, 'lines': lines, 'transcriptions': transcriptions,
+                       'ordering_lines': ordering_lines, 'columns': columns, 'rtl': rtl}
+        self.results = []
+        self.peak_rss_per_step = False
+
+    def measure(self, name, func, *args, **kwargs):
+        times, queries, peaks = [], [], []
+        for _ in range(self.repeat):
+            counter = QueryCounter()
+            self.peak_rss_per_step = reset_peak_rss()
+            start = time.perf_counter()
+            with connection.execute_wrapper(counter):
+                func(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+            peaks.append(peak_rss())
+            queries.append(counter.count)
+        self.results.append({
+            'name': name,
+            'wall_time': min(times),
+            'wall_times': times,
+            'queries': queries[-1],
+            'peak_rss': max(peaks),
+            'max_rss_children': max_rss_children(),
+        })
+        return self.results[-1]
+
+    def setUp(self):
+        self.pages = [make_page(self.config['ordering_lines'], n_columns=self.config['columns'],
+                                seed=part)
+                      for part in range(self.config['parts'])]
+        self.orders = {}
+        start = time.perf_counter()
+        self.document = self.factory.make_synthetic_document(**self.config)
+        self.setup_time = time.perf_counter() - start
+        self.parts = list(self.document.parts.all())
+        self.part_pks = [part.pk for part in self.parts]
+        self.transcription = self.document.transcriptions.first()
+        self.region_types = [t.pk for t in self.document.valid_block_types.all()]
+        self.client = Client()
+        self.client.force_login(self.document.owner)
+
+    def export_path(self, file_format):
+        return os.path.join(self.tmp_dir, 'export_%s.%s' % (
+            file_format, file_format == export.TEXT_FORMAT and 'txt' or 'zip'))
+
+    def recalculate_ordering(self):
+        for part in self.parts:
+            part.recalculate_ordering()
+
+    def make_masks(self):
+        for part in self.parts:
+            part.make_masks()
+
+    def export(self, file_format):
+        # lines of the synthetic document don't have a region type
+        if file_format == export.TEXT_FORMAT:
+            export.write_text(self.export_path(file_format), self.transcription,
+                              self.part_pks, self.region_types,
+                              include_orphans=True, include_undefined=True)
+        else:
+            export.write_xml(self.export_path(file_format), file_format,
+                             self.document, self.part_pks, self.transcription,
+                             self.region_types,
+                             include_orphans=True, include_undefined=True)
+
+    def render_xml(self, file_format, template=False):
+        if template:
+            tplt = loader.get_template(export.XML_TEMPLATES[file_format])
+            for part in self.parts:
+                export.render_xml_page(tplt, self.document, part, self.transcription,
+                                       self.region_types,
+                                       include_orphans=True, include_undefined=True)
+        else:
+            writer = export.XML_WRITERS[file_format](self.document, self.transcription,
+                                                     self.region_types,
+                                                     include_orphans=True, include_undefined=True)
+            for part in self.parts:
+                writer.render(part)
+
+    def import_(self, file_format):
+        with open(self.export_path(file_format), 'rb') as fh:
+            parser = make_parser(self.document, fh, name='benchmark %s' % file_format)
+            for part in parser.parse(override=True):
+                pass
+
+    def api(self):
+        kwargs = {'document_pk': self.document.pk}
+        uris = [reverse('api:document-detail', kwargs={'pk': self.document.pk}),
+                reverse('api:part-list', kwargs=kwargs)]
+        for part in self.parts:
+            kwargs = {'document_pk': self.document.pk, 'part_pk': part.pk}
+            uris += [reverse('api:part-detail', kwargs={'document_pk': self.document.pk,
+                                                        'pk': part.pk}),
+                     reverse('api:line-list', kwargs=kwargs),
+                     reverse('api:linetranscription-list', kwargs=kwargs) +
+                     '?transcription=%d' % self.transcription.pk]
+        for uri in uris:
+            response = self.client.get(uri)
+            assert response.status_code == 200, '%s: %d' % (uri, response.status_code)
+
+    def segmentation_postprocessing(self, results):
+        for part, res in zip(self.parts, results):
+            part.save_segmentation(res, steps='both')
+
+    def segmentation_results(self):
+        # what kraken would have returned for the current segmentation
+        results = []
+        for part in self.parts:
+            results.append({
+                'regions': {'text': [block.box for block in part.blocks.all()]},
+                'lines': [{'baseline': line.baseline, 'boundary': line.mask, 'script': 'default'}
+                          for line in part.lines.all()]
+            })
+            part.lines.all().delete()
+            part.blocks.all().delete()
+        return results
+
+    def reading_order(self, legacy=False):
+        order = legacy and legacy_reading_order or reading_order
+        origin = [2000 if self.config['rtl'] else 0, 0]
+        self.orders[legacy] = [list(order(lines, blocks, origin, rtl=self.config['rtl']))
+                               for lines, blocks in self.pages]
+
+    def run(self, only=None):
+        self.setUp()
+        only = only or BENCHMARKS
+        for name in BENCHMARKS:
+            if name not in only:
+                continue
+            if name.startswith('export_'):
+                self.measure(name, self.export, name.split('_', 1)[1])
+            elif name.startswith('render_'):
+                file_format = name.split('_')[1]
+                self.measure(name, self.render_xml, file_format,
+                             template=name.endswith('_template'))
+            elif name.startswith('import_'):
+                # imports what the export wrote
+                file_format = name.split('_', 1)[1]
+                if not os.path.exists(self.export_path(file_format)):
+                    self.export(file_format)
+                self.measure(name, self.import_, file_format)
+            elif name.startswith('reading_order'):
+                self.measure(name, self.reading_order, legacy=name.endswith('_legacy'))
+                if len(self.orders) == 2:
+                    # both were measured
+                    self.results[-1]['same_order'] = self.orders[False] == self.orders[True]
+            elif name == 'segmentation_postprocessing':
+                results = self.segmentation_results()
+                self.measure(name, self.segmentation_postprocessing, results)
+            else:
+                self.measure(name, getattr(self, name))
+
+        return {
+            'config': dict(self.config, repeat=self.repeat),
+            'platform': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+                'peak_rss_per_step': self.peak_rss_per_step,
+            },
+            'setup_time': self.setup_time,
+            'results': self.results,
+        }
+
+
+class Command(BaseCommand):
+    help = ('Times the hot paths of the processing pipeline on a synthetic document '
+            'in a throw away test database and outputs the results as json.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--parts', type=int, default=2)
+        parser.add_argument('-l', '--lines', type=int, default=100,
+                            help='Number of lines per part.')
+        parser.add_argument('-t', '--transcriptions', type=int, default=1,
+                            help='Number of transcriptions per line.')
+        parser.add_argument('-r', '--repeat', type=int, default=1)
+        parser.add_argument('--ordering-lines', type=int, default=1000,
+                            help='Number of lines per synthetic page of the reading order benchmarks.')
+        parser.add_argument('-c', '--columns', type=int, default=2,
+                            help='Number of columns per synthetic page of the reading order benchmarks.')
+        parser.add_argument('--rtl', action='store_true')
+        parser.add_argument('--only', nargs='+', choices=BENCHMARKS)
+        parser.add_argument('-o', '--output', help='Writes the json to this file.')
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        tmp_dir = tempfile.mkdtemp()
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, keepdb=options['keepdb'])
+        try:
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                benchmark = Benchmark(CoreFactory(flush_redis=False),
+                                      parts=options['parts'],
+                                      lines=options['lines'],
+                                      transcriptions=options['transcriptions'],
+                                      repeat=options['repeat'],
+                                      tmp_dir=tmp_dir,
+                                      ordering_lines=options['ordering_lines'],
+                                      columns=options['columns'],
+                                      rtl=options['rtl'])
+                report = benchmark.run(only=options['only'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output)
+        else:
+            self.stdout.write(output)
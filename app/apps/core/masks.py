@@ -0,0 +1,75 @@
+"""
+Calculation of the masks (polygons) of the lines of a DocumentPart from their baselines.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import current_process
+
+from PIL import Image
+from kraken.lib.segmentation import calculate_polygonal_environment
+
+SCALE = (1200, 0)
+
+
+def make_jobs(lines, to_calc, block_boxes, chunk_size=None):
+    """
+    lines: a list of (pk, baseline, block_pk) for all the lines of the part.
+    to_calc: the set of line pks to calculate a mask for.
+    block_boxes: a dict of block_pk -> box.
+
+    Returns a list of (pks, baselines, context) jobs.
+    Lines of the same block are sent together to kraken, which already leaves a line out
+    of the environment of the other lines of the same call, so the context of a job is only
+    the baselines of all the other lines of the part plus the box of the block.
+    """
+    groups = {}
+    for pk, baseline, block_pk in lines:
+        if pk in to_calc and baseline:
+            groups.setdefault(block_pk, []).append((pk, baseline))
+
+    jobs = []
+    for block_pk, group in groups.items():
+        size = chunk_size or len(group)
+        for i in range(0, len(group), size):
+            chunk = group[i:i + size]
+            pks = [pk for pk, _ in chunk]
+            excluded = set(pks)
+            context = [baseline for pk, baseline, _ in lines if baseline and pk not in excluded]
+            if block_pk and block_boxes.get(block_pk):
+                box = list(block_boxes[block_pk])
+                context.append(box + [box[0]])  # close it
+            jobs.append((pks, [baseline for _, baseline in chunk], context))
+    return jobs
+
+
+def calculate_masks(im, jobs, topline=False):
+    """Returns a dict of line pk -> mask (or None if kraken failed)."""
+    masks = {}
+    for pks, baselines, context in jobs:
+        polygons = calculate_polygonal_environment(
+            im,
+            baselines,
+            suppl_obj=context,
+            scale=SCALE,
+            topline=topline)
+        masks.update(zip(pks, polygons))
+    return masks
+
+
+def calculate_masks_from_file(path, jobs, topline=False):
+    with Image.open(path) as im:
+        return calculate_masks(im.convert('L'), jobs, topline=topline)
+
+
+def calculate_masks_parallel(path, jobs, topline=False, processes=2):
+    # # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
+    current_process().daemon = False
+
+    batches = [batch for batch in (jobs[i::processes] for i in range(processes)) if batch]
+    masks = {}
+    with ProcessPoolExecutor(max_workers=len(batches)) as executor:
+        for result in executor.map(calculate_masks_from_file,
+                                   [path] * len(batches),
+                                   batches,
+                                   [topline] * len(batches)):
+            masks.update(result)
+    return masks
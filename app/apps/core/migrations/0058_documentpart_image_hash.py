@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2021-10-20 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0057_auto_20210730_1449'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentpart',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,113 @@
+"""
+Process level cache of deserialized kraken models.
+
+Each celery worker process keeps the last used models in memory so that
+segmenting or transcribing every part of a document doesn't load the same
+.mlmodel file over and over again.
+"""
+import logging
+import os.path
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from kraken.lib import vgsl, models as kraken_models
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """
+    A LRU cache keyed by (path, mtime, size) of the model file,
+    a model overwritten in place (by a training for example) is thus reloaded.
+
+    max_size is the memory budget in bytes, the in memory footprint of a model
+    is estimated with the size of its file.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key -> (model, size, load_time)
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_time = 0.0
+
+    @property
+    def current_size(self):
+        return sum(size for _, size, _ in self.entries.values())
+
+    def make_key(self, path):
+        stat = os.stat(path)
+        return (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+    def evict(self, needed=0):
+        while self.entries and self.current_size + needed > self.max_size:
+            key, _ = self.entries.popitem(last=False)
+            self.evictions += 1
+            logger.debug('Evicted model %s from cache.', key[0])
+
+    def get(self, path, loader):
+        key = self.make_key(path)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                model, size, load_time = self.entries[key]
+                self.hits += 1
+                self.saved_time += load_time
+                logger.info('Model cache hit for %s (%s).', path, self.stats_display())
+                return model
+
+            self.misses += 1
+            # drop stale versions of the same file
+            for stale in [k for k in self.entries if k[0] == key[0]]:
+                del self.entries[stale]
+
+            start = time.time()
+            model = loader(path)
+            load_time = time.time() - start
+            size = key[2]
+
+            if self.max_size is None or size <= self.max_size:
+                if self.max_size is not None:
+                    self.evict(needed=size)
+                self.entries[key] = (model, size, load_time)
+            logger.info('Model cache miss for %s, loaded in %.2fs (%s).',
+                        path, load_time, self.stats_display())
+            return model
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'saved_time': self.saved_time,
+            'entries': len(self.entries),
+            'size': self.current_size,
+        }
+
+    def stats_display(self):
+        return 'hits: {hits}, misses: {misses}, load time saved: {saved_time:.2f}s'.format(
+            **self.stats())
+
+
+def get_cache_size():
+    # setting is in Mb
+    return int(getattr(settings, 'KRAKEN_MODEL_CACHE_SIZE', 1024)) * 1024 * 1024
+
+
+model_cache = ModelCache(max_size=get_cache_size())
+
+
+def load_segmentation_model(path):
+    return model_cache.get(path, vgsl.TorchVGSLModel.load_model)
+
+
+def load_recognition_model(path):
+    return model_cache.get(path, kraken_models.load_any)
@@ -1,5 +1,3 @@
-import functools
-import itertools
 import json
 import logging
 import math
@@ -10,9 +8,6 @@ import subprocess
 import time
 import uuid
 from datetime import datetime
-import numpy as np
-from sklearn import preprocessing
-from sklearn.cluster import DBSCAN
 
 from PIL import Image
 from celery.task.control import inspect, revoke
@@ -22,29 +17,36 @@ from django.contrib.postgres.fields import JSONField
 from django.core.files.uploadedfile import File
 from django.core.validators import FileExtensionValidator
 from django.db import models, transaction
-from django.db.models import Q, Prefetch
+from django.db.models import Q, Prefetch, Max
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from django.forms import ValidationError
 from django.template.defaultfilters import slugify
+from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
+from django_cleanup import cleanup
 from django_prometheus.models import ExportModelOperationsMixin
 from django_redis import get_redis_connection
 from easy_thumbnails.files import get_thumbnailer
 from kraken import blla, rpred
-from kraken.binarization import nlbin
-from kraken.lib import vgsl, models as kraken_models
-from kraken.lib.segmentation import calculate_polygonal_environment
 from kraken.lib.util import is_bitonal
 from ordered_model.models import OrderedModel
-from shapely import affinity
 from shapely.geometry import Polygon, LineString
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
 
 from celery import chain
 from core.tasks import (segtrain, train, binarize,
                         lossless_compression, convert, segment, transcribe,
-                        generate_part_thumbnails)
+                        transcribe_document, binarize_document,
+                        generate_part_thumbnails, update_client_state)
+from core.masks import make_jobs, calculate_masks, calculate_masks_parallel
+from core.model_cache import load_segmentation_model, load_recognition_model
+from core.binarization import binarize as binarize_image
+from core.geometry import rotation_matrix, translation_matrix, transform_polygons
+from core.ordering import reading_order
+from core.tiles import generate_tiles, delete_tiles
 from core.utils import ColorField
 from core.validators import JSONSchemaValidator
 from users.consumers import send_event
@@ -368,11 +370,65 @@ class Document(ExportModelOperationsMixin('Document'), models.Model):
     def training_model(self):
         return self.ocr_models.filter(training=True).first()
 
+    def transcribe_parts(self, parts, model, user=None, text_direction=None):
+        """
+        Transcribes the given (already segmented) parts with a single task.
+        """
+        part_pks = []
+        for part in parts:
+            if not part.tasks_finished():
+                raise AlreadyProcessingException
+            part_pks.append(part.pk)
+
+        for pk in part_pks:
+            redis_.set('process-%d' % pk, json.dumps({transcribe.name: {"status": "pending",
+                                                                         "shared": True}}))
+            update_client_state(pk, transcribe.name, 'pending', document_pk=self.pk)
+
+        transcribe_document.delay(document_pk=self.pk,
+                                  part_pks=part_pks,
+                                  model_pk=model.pk,
+                                  user_pk=user and user.pk or None,
+                                  text_direction=text_direction,
+                                  report_label='Transcribe in %s' % self.name)
+
+    def binarize_parts(self, parts, user=None, threshold=None):
+        """
+        Binarizes the given parts with a single task sharing a pool of processes.
+        """
+        part_pks = []
+        for part in parts:
+            if not part.tasks_finished():
+                raise AlreadyProcessingException
+            part_pks.append(part.pk)
+
+        for pk in part_pks:
+            redis_.set('process-%d' % pk, json.dumps({binarize.name: {"status": "pending",
+                                                                       "shared": True}}))
+            update_client_state(pk, binarize.name, 'pending', document_pk=self.pk)
+
+        binarize_document.delay(document_pk=self.pk,
+                                part_pks=part_pks,
+                                user_pk=user and user.pk or None,
+                                threshold=threshold,
+                                report_label='Binarize in %s' % self.name)
+
 
 def document_images_path(instance, filename):
     return 'documents/{0}/{1}'.format(instance.document.pk, filename)
 
 
+def image_lock(name):
+    """
+    Serializes the deletion of a stored image (see delete_thumbnails)
+    with the checks of the parts starting to share it (see DocumentPart.twin_image_kept).
+    """
+    return redis_.lock('image-lock-%s' % name, timeout=60)
+
+
+# its images can be shared with other parts, they are deleted by the part itself
+# once no part uses them anymore, cf DocumentPart.save and delete_thumbnails
+@cleanup.ignore
 class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
     """
     Represents a physical part of a larger document that is usually a page
@@ -381,6 +437,8 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
     image = models.ImageField(upload_to=document_images_path)
     original_filename = models.CharField(max_length=1024, blank=True)
     image_file_size = models.BigIntegerField()
+    # sha256 of the image as it was uploaded or imported, identical images are stored once
+    image_hash = models.CharField(max_length=64, blank=True, db_index=True)
     source = models.CharField(max_length=1024, blank=True)
     bw_backend = models.CharField(max_length=128, default='kraken')
     bw_image = models.ImageField(upload_to=document_images_path,
@@ -443,6 +501,80 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
         else:
             return True
 
+    def find_twin_image(self, image_hash):
+        """
+        Returns the name of a stored image of the document identical to the one of hash image_hash,
+        rotated or cropped images don't have a hash anymore.
+        The part using it has to check that it is still there once saved (twin_image_kept).
+        """
+        if not image_hash:
+            return None
+        storage = self.image.storage
+        names = (DocumentPart.objects
+                 .filter(document_id=self.document_id, image_hash=image_hash)
+                 .exclude(pk=self.pk)
+                 .exclude(image='')
+                 .values_list('image', flat=True)
+                 .distinct())
+        for name in names:
+            if storage.exists(name):
+                return name
+        return None
+
+    def store_image(self, name, content, image_hash):
+        """
+        Saves content as the image of the part unless an identical one is already stored,
+        in which case both parts share the same file. Doesn't save the part itself.
+        """
+        if (image_hash and image_hash == self.image_hash
+                and self.image and self.image.storage.exists(self.image.name)):
+            # re-importing the same image
+            pass
+        else:
+            twin = self.find_twin_image(image_hash)
+            if twin:
+                self.image = twin
+                # checked by save()
+                self._twin_content = (name, content)
+            else:
+                self.image.save(name, content, save=False)
+        self.image_hash = image_hash
+        self.image_file_size = self.image.size
+
+    def twin_image_kept(self):
+        """
+        Whether the image shared with other parts is still stored, to be called once the part
+        is saved. The last part using it could have been deleted after the image was found,
+        its files being deleted before this part was visible to it.
+        """
+        with image_lock(self.image.name):
+            return self.image.storage.exists(self.image.name)
+
+    def file_is_shared(self, name):
+        return (DocumentPart.objects
+                .exclude(pk=self.pk)
+                .filter(Q(image=name) | Q(bw_image=name))
+                .exists())
+
+    def own_image(self):
+        """
+        Gives the part its own copy of its images if they are shared with other parts,
+        to be called before modifying them in place. Doesn't save the part.
+        """
+        storage = self.image.storage
+        copies = {}
+        for field_name in ('image', 'bw_image'):
+            field = getattr(self, field_name)
+            if not field or not self.file_is_shared(field.name):
+                continue
+            # the binarized image of a bitonal image is the image itself
+            if field.name not in copies:
+                with storage.open(field.name) as fh:
+                    copies[field.name] = storage.save(field.name, fh)
+            setattr(self, field_name, copies[field.name])
+            # the copy is deleted by save() if it is replaced in turn (rotate)
+            self.__dict__.setdefault('_stored_images', {})[field_name] = copies[field.name]
+
     @property
     def segmented(self):
         return self.lines.count() > 0
@@ -470,117 +602,66 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
         transcribed = LineTranscription.objects.filter(line__document_part=self).count()
         self.transcription_progress = min(int(transcribed / total * 100), 100)
 
+    def touch(self):
+        """
+        Marks the part as updated after its lines or blocks were changed,
+        it invalidates its cached exports.
+        """
+        self.updated_at = timezone.now()
+        DocumentPart.objects.filter(pk=self.pk).update(updated_at=self.updated_at)
+
     def recalculate_ordering(self, read_direction=None):
         """
         Re-order the lines of the DocumentPart depending on read direction.
         """
         read_direction = read_direction or self.document.read_direction
+        rtl = read_direction == Document.READ_DIRECTION_RTL
         # imgbox = ((0, 0), (self.image.width, self.image.height))
+        origin_box = [self.image.width if rtl else 0, 0]
 
-        origin_box = [self.image.width if read_direction == Document.READ_DIRECTION_RTL else 0, 0]
-
-        def distance(x, y):
-            return math.sqrt(sum([(a - b) ** 2 for a, b in zip(x, y)]))
-
-        def poly_origin_pt(shape):
-            return min(shape, key=lambda pt: distance(pt, origin_box))
-
-        def baseline_origin_pt(baseline_, read_direction_):
-            return baseline_[-1 if read_direction_ == Document.READ_DIRECTION_RTL else 0]
-
-        def line_origin_pt(line_, read_direction_):
-            return baseline_origin_pt(line_.baseline, read_direction_) if line_.baseline else poly_origin_pt(line_.mask)
-
-        def line_block_pk(line_):
-            return line_.block.pk if line_.block else 0
-
-        def avg_line_height_column(y_origins_np, line_labels):
-            """"Return the min of the averages line heights of the columns"""
-            labels = np.unique(line_labels)
-            line_heights_list = []
-            for label in labels:
-                y_origins_column = y_origins_np[line_labels == label]
-                column_height = (y_origins_column.max() - y_origins_column.min()) / y_origins_column.size
-                line_heights_list.append(column_height)
-            return min(line_heights_list)
-
-        def avg_line_height_block(lines_in_block, read_direction_):
-            """Returns the average line height in the block taking into account devising number of columns
-            based on x lines origins clustering. Key parameters of the algorithm:
-            x_cluster: tolerance used to gather lines in a column
-            line_height_decrease: scaling factor to avoid over gathering of lines"""
-            x_cluster, line_height_decrease = 0.1, 0.8
-
-            origins_np = np.array(list(map(lambda l: line_origin_pt(l, read_direction_), lines_in_block)))
-
-            # Devise the number of columns by performing DBSCAN clustering on x coordinate of line origins
-            x_origins_np = origins_np[:, 0].reshape(-1, 1)
-            scaler = preprocessing.MinMaxScaler()
-            scaler.fit(x_origins_np)
-            x_scaled = scaler.transform(x_origins_np)
-            clustering = DBSCAN(eps=x_cluster)
-            clustering.fit(x_scaled)
-
-            # Compute the average line size based on the guessed number of columns
-            y_origins_np = origins_np[:, 1]
-            return avg_line_height_column(y_origins_np, clustering.labels_) * line_height_decrease
-
-        def avg_lines_heights_dict(lines, read_direction_):
-            """Returns a dictionary with block.pk (or 0 if None) as keys and average lines height
-            in the block as values"""
-            sorted_by_block = sorted(lines, key=line_block_pk)
-            organized_by_block = itertools.groupby(sorted_by_block, key=line_block_pk)
-
-            avg_heights = {}
-            for block_pk, lines_in_block in organized_by_block:
-                avg_heights[block_pk] = avg_line_height_block(lines_in_block, read_direction_)
-            return avg_heights
-
-        # fetch all lines and regroup them by block
-        qs = self.lines.select_related('block').all()
-        ls = list(qs)
-        if len(ls) == 0:
+        lines = list(self.lines.values_list('pk', 'order', 'baseline', 'mask', 'block'))
+        if len(lines) == 0:
             return
+        blocks = dict(self.blocks.values_list('pk', 'box'))
+
+        order = reading_order([(baseline, mask, block) for _, _, baseline, mask, block in lines],
+                              blocks, origin_box, rtl=rtl)
+        to_update = [Line(pk=lines[index][0], order=new_order)
+                     for new_order, index in enumerate(order)
+                     if lines[index][1] != new_order]
+        if to_update:
+            Line.objects.bulk_update(to_update, ['order'])
+            self.touch()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_images = instance.image_names()
+        return instance
 
-        dict_avg_heights = avg_lines_heights_dict(ls, read_direction)
-
-        def cmp_lines(a, b):
-            # cache origin pts for efficiency
-            if not hasattr(a, 'origin_pt'):
-                a.origin_pt = line_origin_pt(a, read_direction)
-            if not hasattr(b, 'origin_pt'):
-                b.origin_pt = line_origin_pt(b, read_direction)
-
-            try:
-                if a.block != b.block:
-                    pt1 = poly_origin_pt(a.block.box) if a.block else a.origin_pt
-                    pt2 = poly_origin_pt(b.block.box) if b.block else b.origin_pt
-
-                    # when comparing blocks we can use the distance
-                    return distance(pt1, origin_box) - distance(pt2, origin_box)
-                else:
-                    pt1 = a.origin_pt
-                    pt2 = b.origin_pt
-
-                    # # 2 lines more or less on the same level
-                    avg_height = dict_avg_heights[line_block_pk(a)]
-                    if abs(pt1[1] - pt2[1]) < avg_height:
-                        return distance(pt1, origin_box) - distance(pt2, origin_box)
-                return pt1[1] - pt2[1]
-            except TypeError:  # invalid line
-                return 0
-
-        # sort depending on the distance to the origin
-        ls.sort(key=functools.cmp_to_key(lambda a, b: cmp_lines(a, b)))
-        # one query / line, super gory
-        for order, line in enumerate(ls):
-            if line.order != order:
-                line.order = order
-                line.save()
+    def image_names(self):
+        # the names of the (non deferred) image fields
+        return {field_name: getattr(self, field_name).name
+                for field_name in ('image', 'bw_image') if field_name in self.__dict__}
 
     def save(self, *args, **kwargs):
         new = self.pk is None
+        stored = self.__dict__.get('_stored_images', {})
         instance = super().save(*args, **kwargs)
+        twin_content = self.__dict__.pop('_twin_content', None)
+        if twin_content and not self.twin_image_kept():
+            # stores its own copy after all
+            name, content = twin_content
+            content.seek(0)
+            self.image.save(name, content, save=False)
+            super().save(update_fields=['image'])
+        self._stored_images = self.image_names()
+        replaced = [self._meta.get_field(field_name).attr_class(
+                        self, self._meta.get_field(field_name), name)
+                    for field_name, name in stored.items()
+                    if name and name != self._stored_images.get(field_name, name)]
+        if replaced:
+            transaction.on_commit(lambda: delete_unused_images(replaced))
         if new:
             self.task('convert', user_pk=self.document.owner and self.document.owner.pk or None)
             send_event('document', self.document.pk, "part:new", {"id": self.pk})
@@ -654,7 +735,11 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
 
         for task_name, task in self.tasks.items():
             if task_name not in uncancelable:
-                if 'task_id' in task:  # if not, it is still pending
+                if task.get('shared'):
+                    # the task processes other parts as well, it skips this one when it gets to it
+                    if task['status'] in ['pending', 'task_prerun']:
+                        redis_.set('canceled-%d' % self.pk, 1, ex=24 * 60 * 60)
+                elif 'task_id' in task:  # if not, it is still pending
                     revoke(task['task_id'], terminate=True)
                 redis_.set('process-%d' % self.pk, json.dumps({task_name: {"status": "canceled"}}))
 
@@ -714,8 +799,8 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
             if error:
                 raise RuntimeError("Error trying to convert file(%s) to png.")
 
+            # the original image is deleted by save() unless another part shares it
             self.image = new_name.split(settings.MEDIA_ROOT)[1][1:]
-            os.remove(old_name)
 
         if self.workflow_state < self.WORKFLOW_STATE_CONVERTED:
             self.workflow_state = self.WORKFLOW_STATE_CONVERTED
@@ -743,7 +828,11 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
         else:
             os.rename(opti_name, self.image.file.name)
 
-    def binarize(self, threshold=None):
+    def binarize(self, threshold=None, executor=None, processes=1):
+        """
+        Images bigger than settings.BINARIZATION_MEMORY_LIMIT are binarized by tiles,
+        spread over the processes of the executor if one is given.
+        """
         fname = os.path.basename(self.image.file.name)
         # should be formatted to png already by lossless_compression but better safe than sorry
         form = None
@@ -754,13 +843,16 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
             form = 'png'
             fname = '%s.%s' % (f_, form)
         bw_file_name = 'bw_' + fname
+        if self.file_is_shared(self.image.name):
+            # the parts sharing the image may be binarized differently
+            bw_file_name = 'bw_%d_%s' % (self.pk, fname)
         bw_file = os.path.join(os.path.dirname(self.image.file.name), bw_file_name)
+        memory_limit = getattr(settings, 'BINARIZATION_MEMORY_LIMIT', 0) * 1024 * 1024
         with Image.open(self.image.path) as im:
-            # threshold, zoom, escale, border, perc, range, low, high
-            if threshold is not None:
-                res = nlbin(im, threshold)
-            else:
-                res = nlbin(im)
+            res = binarize_image(im, threshold=threshold,
+                                 memory_limit=memory_limit or None,
+                                 overlap=getattr(settings, 'BINARIZATION_TILE_OVERLAP', 128),
+                                 executor=executor, processes=processes)
             res.save(bw_file, format=form)
 
         self.bw_image = document_images_path(self, bw_file_name)
@@ -778,7 +870,7 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
             model_path = model.file.path
         else:
             model_path = settings.KRAKEN_DEFAULT_SEGMENTATION_MODEL
-        model_ = vgsl.TorchVGSLModel.load_model(model_path)
+        model_ = load_segmentation_model(model_path)
         # TODO: check model_type [None, 'recognition', 'segmentation']
         #    &  seg_type [None, 'bbox', 'baselines']
 
@@ -809,34 +901,7 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
                 self.blocks.all().delete()
 
             res = blla.segment(im, **options)
-
-            if steps in ['regions', 'both']:
-                block_types = {t.name: t for t in self.document.valid_block_types.all()}
-                for region_type, regions in res['regions'].items():
-                    for region in regions:
-                        Block.objects.create(
-                            document_part=self,
-                            typology=block_types.get(region_type),
-                            box=region)
-
-            regions = self.blocks.all()
-            if steps in ['lines', 'both']:
-                line_types = {t.name: t for t in self.document.valid_line_types.all()}
-                for line in res['lines']:
-                    mask = line['boundary'] if line['boundary'] is not None else None
-                    baseline = line['baseline']
-
-                    # calculate if the center of the line is contained in one of the region
-                    # (pick the first one that matches)
-                    center = LineString(baseline).interpolate(0.5, normalized=True)
-                    region = next((r for r in regions if Polygon(r.box).contains(center)), None)
-
-                    Line.objects.create(
-                        document_part=self,
-                        typology=line_types.get(line['script']),
-                        block=region,
-                        baseline=baseline,
-                        mask=mask)
+            self.save_segmentation(res, steps=steps)
 
         im.close()
 
@@ -844,56 +909,160 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
         self.save()
         self.recalculate_ordering(read_direction=read_direction)
 
-    def transcribe(self, model, text_direction=None):
+    def save_segmentation(self, res, steps='both'):
+        """
+        Creates the blocks and lines of a kraken segmentation result,
+        lines are attached to the first region containing their center.
+        """
+        if steps in ['regions', 'both']:
+            block_types = {t.name: t for t in self.document.valid_block_types.all()}
+            # bypasses OrderedModel.save() so orders and ids are set up front
+            order = self.blocks.aggregate(max_order=Max('order'))['max_order']
+            order = -1 if order is None else order
+            blocks = []
+            for region_type, regions in res['regions'].items():
+                for region in regions:
+                    order += 1
+                    block = Block(document_part=self,
+                                  typology=block_types.get(region_type),
+                                  box=region,
+                                  order=order)
+                    block.make_external_id()
+                    blocks.append(block)
+            Block.objects.bulk_create(blocks)
+
+        if steps in ['lines', 'both']:
+            regions = list(self.blocks.all())
+            polygons = [Polygon(r.box) for r in regions]
+            tree = STRtree(polygons) if polygons else None
+            polygons_index = {id(p): i for i, p in enumerate(polygons)}
+
+            line_types = {t.name: t for t in self.document.valid_line_types.all()}
+            order = self.lines.aggregate(max_order=Max('order'))['max_order']
+            order = -1 if order is None else order
+            lines = []
+            for line in res['lines']:
+                mask = line['boundary'] if line['boundary'] is not None else None
+                baseline = line['baseline']
+
+                # calculate if the center of the line is contained in one of the region
+                # (pick the first one that matches)
+                region = None
+                if tree is not None:
+                    center = LineString(baseline).interpolate(0.5, normalized=True)
+                    # shapely<2 returns geometries, shapely>=2 returns indexes
+                    candidates = sorted(polygons_index[id(c)] if isinstance(c, BaseGeometry)
+                                        else int(c) for c in tree.query(center))
+                    region = next((regions[i] for i in candidates
+                                   if polygons[i].contains(center)), None)
+
+                order += 1
+                line_ = Line(document_part=self,
+                             typology=line_types.get(line['script']),
+                             block=region,
+                             baseline=baseline,
+                             mask=mask,
+                             order=order)
+                line_.make_external_id()
+                lines.append(line_)
+            Line.objects.bulk_create(lines)
+
+    def transcribe(self, model, text_direction=None, image=None):
+        """
+        image: an already opened PIL image of the part to avoid decoding it again.
+        """
         trans, created = Transcription.objects.get_or_create(
             name='kraken:' + model.name,
             document=self.document)
-        model_ = kraken_models.load_any(model.file.path)
-        lines = self.lines.all()
+        model_ = load_recognition_model(model.file.path)
+        lines = list(self.lines.all())
         text_direction = (text_direction
                           or (self.document.main_script
                               and self.document.main_script.text_direction)
                           or 'horizontal-lr')
 
-        with Image.open(self.image.file.name) as im:
-            for line in lines:
-                if not line.baseline:
-                    bounds = {
-                        'boxes': [line.box],
-                        'text_direction': text_direction,
-                        'type': 'baselines',
-                        # 'script_detection': True
-                    }
-                else:
-                    bounds = {
-                        'lines': [{'baseline': line.baseline,
-                                   'boundary': line.mask,
-                                   'text_direction': text_direction,
-                                   'script': 'default'}],  # self.document.main_script.name
-                        'type': 'baselines',
-                        # 'selfcript_detection': True
-                    }
-                it = rpred.rpred(
-                    model_, im,
-                    bounds=bounds,
-                    pad=16,  # TODO: % of the image?
-                    bidi_reordering=True)
-                lt, created = LineTranscription.objects.get_or_create(
-                    line=line, transcription=trans)
-                for pred in it:
-                    lt.content = pred.prediction
-                    lt.graphs = [{
-                        'c': letter,
-                        'poly': poly,
-                        'confidence': float(confidence)
-                    } for letter, poly, confidence in zip(
-                        pred.prediction, pred.cuts, pred.confidences)]
-                lt.save()
+        baseline_lines = [line for line in lines if line.baseline]
+        box_lines = [line for line in lines if not line.baseline]
+        if image is None:
+            with Image.open(self.image.file.name) as im:
+                predictions = self.recognize_lines(model_, im, baseline_lines, box_lines,
+                                                   text_direction)
+        else:
+            predictions = self.recognize_lines(model_, image, baseline_lines, box_lines,
+                                               text_direction)
+
+        existing = {lt.line_id: lt for lt in LineTranscription.objects.filter(
+            transcription=trans, line__document_part=self)}
+        to_create, to_update = [], []
+        now = timezone.now()
+        for line in lines:
+            lt = existing.get(line.pk)
+            if lt is None:
+                lt = LineTranscription(line=line, transcription=trans)
+                to_create.append(lt)
+            else:
+                # bulk_update bypasses auto_now
+                lt.version_updated_at = now
+                to_update.append(lt)
+
+            pred = predictions.get(line.pk)
+            if pred is not None:
+                lt.content = pred.prediction
+                lt.graphs = [{
+                    'c': letter,
+                    'poly': poly,
+                    'confidence': float(confidence)
+                } for letter, poly, confidence in zip(
+                    pred.prediction, pred.cuts, pred.confidences)]
+
+        with transaction.atomic():
+            LineTranscription.objects.bulk_create(to_create)
+            LineTranscription.objects.bulk_update(
+                to_update, ['content', 'graphs', 'version_updated_at'])
 
         self.workflow_state = self.WORKFLOW_STATE_TRANSCRIBING
         self.calculate_progress()
         self.save()
 
+    def recognize_lines(self, model_, im, baseline_lines, box_lines, text_direction):
+        """
+        Runs all the lines of the page through a single recognizer pass,
+        one for baselines and one for boxes since kraken can't mix them.
+        Returns a dict of line pk -> kraken ocr record.
+        """
+        predictions = {}
+        if baseline_lines:
+            bounds = {
+                'lines': [{'baseline': line.baseline,
+                           'boundary': line.mask,
+                           'text_direction': text_direction,
+                           'script': 'default'}  # self.document.main_script.name
+                          for line in baseline_lines],
+                'type': 'baselines',
+                # 'script_detection': True
+            }
+            it = rpred.rpred(
+                model_, im,
+                bounds=bounds,
+                pad=16,  # TODO: % of the image?
+                bidi_reordering=True)
+            # kraken yields exactly one record per line, in order
+            predictions.update(zip((line.pk for line in baseline_lines), it))
+        if box_lines:
+            bounds = {
+                'boxes': [line.box for line in box_lines],
+                'text_direction': text_direction,
+                'type': 'box',
+                # 'script_detection': True
+            }
+            it = rpred.rpred(
+                model_, im,
+                bounds=bounds,
+                pad=16,
+                bidi_reordering=True)
+            predictions.update(zip((line.pk for line in box_lines), it))
+        return predictions
+
     def chain_tasks(self, *tasks):
         redis_.set('process-%d' % self.pk, json.dumps({tasks[-1].name: {"status": "pending"}}))
         chain(*tasks).delay()
@@ -934,34 +1103,39 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
         return tasks
 
     def make_masks(self, only=None):
-        im = Image.open(self.image).convert('L')
-        lines = list(self.lines.all())  # needs to store the qs result
-        to_calc = [l for l in lines if (only and l.pk in only) or (only is None)]
+        lines = list(self.lines.select_related('block'))  # needs to store the qs result
+        to_calc = [l for l in lines
+                   if ((only and l.pk in only) or (only is None)) and l.baseline]
+
+        if self.document.line_offset == Document.LINE_OFFSET_TOPLINE:
+            topline = True
+        elif self.document.line_offset == Document.LINE_OFFSET_CENTERLINE:
+            topline = None
+        else:
+            topline = False
+
+        processes = getattr(settings, 'KRAKEN_MASKS_PROCESSES', 0)
+        parallel = (processes > 1 and
+                    len(to_calc) >= getattr(settings, 'KRAKEN_MASKS_PARALLEL_MIN_LINES', 100))
+        jobs = make_jobs([(l.pk, l.baseline, l.block_id) for l in lines],
+                         {l.pk for l in to_calc},
+                         {l.block_id: l.block.box for l in lines if l.block},
+                         chunk_size=parallel and math.ceil(len(to_calc) / processes) or None)
+        if parallel:
+            masks = calculate_masks_parallel(self.image.path, jobs,
+                                             topline=topline, processes=processes)
+        else:
+            with Image.open(self.image.path) as im:
+                masks = calculate_masks(im.convert('L'), jobs, topline=topline)
 
+        to_update = []
         for line in to_calc:
-            context = [l.baseline for l in lines if l.pk != line.pk]
-            if line.block:
-                poly = line.block.box
-                poly.append(line.block.box[0])  # close it
-                context.append(poly)
-
-            if self.document.line_offset == Document.LINE_OFFSET_TOPLINE:
-                topline = True
-            elif self.document.line_offset == Document.LINE_OFFSET_CENTERLINE:
-                topline = None
-            else:
-                topline = False
-
-            mask = calculate_polygonal_environment(
-                im,
-                [line.baseline],
-                suppl_obj=context,
-                scale=(1200, 0),
-                topline=topline
-            )
-            if mask[0]:
-                line.mask = mask[0]
-                line.save()
+            if masks.get(line.pk):
+                line.mask = masks[line.pk]
+                to_update.append(line)
+        if to_update:
+            Line.objects.bulk_update(to_update, ['mask'])
+            self.touch()
 
         return to_calc
 
@@ -988,6 +1162,12 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
                 new_name = f'{name}_rot{new_angle}{ext}'
             return new_name
 
+        # the old image and its pyramid are still used if another part shares them
+        self.own_image()
+        self.image_hash = ''
+        # the pyramid of the old image is useless now
+        self.delete_tiles()
+
         # rotate image
         with Image.open(self.image.file.name) as im:
             # store center point while it's open with old bounds
@@ -1015,23 +1195,8 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
 
         self.save()
 
-        get_thumbnailer(self.image).get_thumbnail(settings.THUMBNAIL_ALIASES['']['large'])
-
-        # rotate lines
-        for line in self.lines.all():
-            if line.baseline:
-                poly = affinity.rotate(LineString(line.baseline), angle, origin=center)
-                line.baseline = [(int(x - offset[0]), int(y - offset[1])) for x, y in poly.coords]
-            if line.mask:
-                poly = affinity.rotate(Polygon(line.mask), angle, origin=center)
-                line.mask = [(int(x - offset[0]), int(y - offset[1])) for x, y in poly.exterior.coords]
-            line.save()
-
-        # rotate regions
-        for region in self.blocks.all():
-            poly = affinity.rotate(Polygon(region.box), angle, origin=center)
-            region.box = [(int(x - offset[0]), int(y - offset[1])) for x, y in poly.exterior.coords]
-            region.save()
+        # rotate lines and regions
+        self.transform(rotation_matrix(angle, center, offset=offset))
 
     def crop(self, x1, y1, x2, y2):
         """
@@ -1039,27 +1204,64 @@ class DocumentPart(ExportModelOperationsMixin('DocumentPart'), OrderedModel):
         by top left (x1, y1) and bottom right (x2, y2) points.
         Moves the lines and regions accordingly.
         """
+        self.own_image()
+        self.image_hash = ''
+        self.delete_tiles()
+
         with Image.open(self.image.file.name) as im:
             cim = im.crop((x1, y1, x2, y2))
             cim.save(self.image.file.name)
             cim.close()
 
         if self.bw_image:
-            with Image.open(self.image.file.name) as im:
+            with Image.open(self.bw_image.file.name) as im:
                 cim = im.crop((x1, y1, x2, y2))
-                cim.save(self.image.file.name)
+                cim.save(self.bw_image.file.name)
                 cim.close()
 
-        for line in self.lines.all():
-            if line.baseline:
-                line.baseline = [(int(x - x1), int(y - y1)) for x, y in line.baseline]
-            if line.mask:
-                line.mask = [(int(x - x1), int(y - y1)) for x, y in line.mask]
-            line.save()
+        # the image changed but not its name
+        self.save()
 
-        for region in self.blocks.all():
-            region.box = [(int(x - x1), int(y - y1)) for x, y in region.box]
-            region.save()
+        self.transform(translation_matrix(-x1, -y1))
+
+    def transform(self, matrix):
+        """
+        Applies the 2x3 affine matrix to all the baselines, masks and boxes of the part
+        in one go, and saves them with a query per model.
+        """
+        lines = list(self.lines.only('pk', 'baseline', 'mask'))
+        baselines = transform_polygons([line.baseline for line in lines], matrix)
+        masks = transform_polygons([line.mask for line in lines], matrix)
+        for line, baseline, mask in zip(lines, baselines, masks):
+            line.baseline, line.mask = baseline, mask
+
+        blocks = list(self.blocks.only('pk', 'box'))
+        boxes = transform_polygons([block.box for block in blocks], matrix)
+        for block, box in zip(blocks, boxes):
+            block.box = box
+
+        with transaction.atomic():
+            Line.objects.bulk_update(lines, ['baseline', 'mask'])
+            Block.objects.bulk_update(blocks, ['box'])
+
+    def generate_thumbnails(self):
+        """
+        (Re)generates the thumbnails of the image,
+        the ones of a rotated image don't exist yet since its name changed.
+        """
+        thumbnailer = get_thumbnailer(self.image)
+        return {alias: thumbnailer.get_thumbnail(config).url
+                for alias, config in settings.THUMBNAIL_ALIASES[''].items()}
+
+    def generate_tiles(self):
+        """
+        Generates the deep zoom pyramid of tiles of the image,
+        the api serves regions of the image from it.
+        """
+        return generate_tiles(self.image.path)
+
+    def delete_tiles(self):
+        delete_tiles(self.image.path)
 
     def enforce_line_order(self):
         # django-ordered-model doesn't care about unicity and linearity...
@@ -1460,9 +1662,23 @@ class OcrModelRight(models.Model):
         ]
 
 
+def delete_unused_images(files):
+    """
+    Deletes the image files (with their thumbnails and tiles) no part uses anymore,
+    the ones still used by other parts are kept (see DocumentPart.store_image).
+    """
+    for name, field in {field.name: field for field in files}.items():
+        # a part starting to share it checks that it's still there under the same lock
+        with image_lock(name):
+            if DocumentPart.objects.filter(Q(image=name) | Q(bw_image=name)).exists():
+                continue
+            get_thumbnailer(field).delete_thumbnails()
+            delete_tiles(field.path)
+            field.storage.delete(name)
+
+
 @receiver(pre_delete, sender=DocumentPart, dispatch_uid='thumbnails_delete_signal')
 def delete_thumbnails(sender, instance, using, **kwargs):
-    thumbnailer = get_thumbnailer(instance.image)
-    thumbnailer.delete_thumbnails()
-    thumbnailer = get_thumbnailer(instance.bw_image)
-    thumbnailer.delete_thumbnails()
+    files = [field for field in (instance.image, instance.bw_image) if field]
+    # checked once the transaction is over since parts sharing files are often deleted together
+    transaction.on_commit(lambda: delete_unused_images(files))
@@ -0,0 +1,103 @@
+"""
+Reading order of the lines of a DocumentPart.
+
+Everything is computed on numpy arrays from plain python data (no model instances)
+so that the ordering of a page costs a couple of vectorized passes
+instead of a python comparison function called O(n log n) times.
+"""
+import numpy as np
+from sklearn import preprocessing
+from sklearn.cluster import DBSCAN
+
+ORPHAN = 0  # 'block' of lines without a block
+
+
+def distances(points, origin):
+    return np.hypot(points[:, 0] - origin[0], points[:, 1] - origin[1])
+
+
+def poly_origin_pt(poly, origin):
+    """The point of the polygon the closest to the origin."""
+    pts = np.asarray(poly, dtype=float)
+    return pts[np.argmin(distances(pts, origin))]
+
+
+def line_origin_pt(baseline, mask, origin, rtl=False):
+    if baseline:
+        return baseline[-1 if rtl else 0]
+    return poly_origin_pt(mask, origin)
+
+
+def avg_line_height_block(origins, x_cluster=0.1, line_height_decrease=0.8):
+    """
+    Returns the average line height in the block taking into account devising number of columns
+    based on x lines origins clustering. Key parameters of the algorithm:
+    x_cluster: tolerance used to gather lines in a column
+    line_height_decrease: scaling factor to avoid over gathering of lines
+    """
+    # Devise the number of columns by performing DBSCAN clustering on x coordinate of line origins
+    x_scaled = preprocessing.MinMaxScaler().fit_transform(origins[:, 0].reshape(-1, 1))
+    labels = DBSCAN(eps=x_cluster).fit(x_scaled).labels_
+
+    # Compute the average line size based on the guessed number of columns,
+    # keep the min of the averages line heights of the columns
+    heights = []
+    for label in np.unique(labels):
+        y_origins = origins[labels == label, 1]
+        heights.append((y_origins.max() - y_origins.min()) / y_origins.size)
+    return min(heights) * line_height_decrease
+
+
+def reading_order(lines, blocks, origin, rtl=False):
+    """
+    lines: a list of (baseline, mask, block_pk) tuples, block_pk being None for orphan lines.
+    blocks: a dict of block_pk -> box.
+    origin: the corner of the image the reading starts from.
+
+    Returns the indexes of the lines in reading order:
+    - blocks are sorted by the distance of their closest point to the origin,
+      an orphan line is ordered as if it was a block of its own,
+    - inside a block, lines are grouped in rows, a line starting less than the average
+      line height of the block below the previous one belongs to the same row,
+    - rows are sorted from top to bottom and lines inside a row by distance to the origin.
+    Lines without any valid geometry end up last.
+    """
+    n = len(lines)
+    if not n:
+        return np.array([], dtype=int)
+    origin = np.asarray(origin, dtype=float)
+
+    origins = np.full((n, 2), np.nan)
+    for i, (baseline, mask, block) in enumerate(lines):
+        try:
+            origins[i] = line_origin_pt(baseline, mask, origin, rtl=rtl)
+        except (TypeError, ValueError, IndexError):
+            pass  # invalid line
+    valid = ~np.isnan(origins).any(axis=1)
+    dist = np.where(valid, distances(origins, origin), np.inf)
+
+    block_pks = np.array([block or ORPHAN for _, _, block in lines])
+    heights = np.zeros(n)
+    for pk in np.unique(block_pks[valid]):
+        in_block = valid & (block_pks == pk)
+        heights[in_block] = avg_line_height_block(origins[in_block])
+
+    block_dist = {pk: distances(np.asarray(box, dtype=float), origin).min()
+                  for pk, box in blocks.items() if box}
+    orphans = np.array([pk == ORPHAN or pk not in block_dist for pk in block_pks])
+    group_ids = np.where(orphans, -np.arange(1, n + 1), block_pks)
+    group_keys = np.where(orphans, dist,
+                          [block_dist.get(pk, np.inf) for pk in block_pks])
+    group_keys = np.where(valid, group_keys, np.inf)
+    y = np.where(valid, origins[:, 1], np.inf)
+
+    # sort by block then from top to bottom
+    by_block = np.lexsort((y, group_ids, group_keys))
+    ys, hs, gs = y[by_block], heights[by_block], group_ids[by_block]
+    new_row = np.ones(n, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        new_row[1:] = (gs[1:] != gs[:-1]) | ~(np.abs(np.diff(ys)) < hs[1:])
+    rows = np.cumsum(new_row)
+
+    # rows keep their order, lines inside a row are sorted by distance
+    return by_block[np.lexsort((dist[by_block], rows))]
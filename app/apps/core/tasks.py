@@ -4,7 +4,9 @@ import logging
 import numpy as np
 import os.path
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from itertools import groupby
+from PIL import Image
 
 from django.apps import apps
 from django.conf import settings
@@ -20,6 +22,8 @@ from easy_thumbnails.files import get_thumbnailer
 from kraken.lib import train as kraken_train
 
 
+from core.binarization import make_executor
+from core.model_cache import load_recognition_model
 from users.consumers import send_event
 
 logger = logging.getLogger(__name__)
@@ -27,12 +31,13 @@ User = get_user_model()
 redis_ = get_redis_connection()
 
 
-def update_client_state(part_id, task, status, task_id=None, data=None):
-    DocumentPart = apps.get_model('core', 'DocumentPart')
-    part = DocumentPart.objects.get(pk=part_id)
+def update_client_state(part_id, task, status, task_id=None, data=None, document_pk=None):
+    if document_pk is None:
+        DocumentPart = apps.get_model('core', 'DocumentPart')
+        document_pk = DocumentPart.objects.values_list('document', flat=True).get(pk=part_id)
     task_name = task.split('.')[-1]
-    send_event('document', part.document.pk, "part:workflow", {
-        "id": part.pk,
+    send_event('document', document_pk, "part:workflow", {
+        "id": part_id,
         "process": task_name,
         "status": status,
         "task_id": task_id,
@@ -61,13 +66,28 @@ def generate_part_thumbnails(instance_pk=None, user_pk=None, **kwargs):
         logger.error('Trying to compress innexistant DocumentPart : %d', instance_pk)
         return
 
-    aliases = {}
-    thbnr = get_thumbnailer(part.image)
-    for alias, config in settings.THUMBNAIL_ALIASES[''].items():
-        aliases[alias] = thbnr.get_thumbnail(config).url
+    aliases = part.generate_thumbnails()
+    if getattr(settings, 'TILES_ENABLE', True):
+        part.generate_tiles()
     return aliases
 
 
+@shared_task(autoretry_for=(MemoryError,), default_retry_delay=60)
+def generate_part_tiles(instance_pk=None, **kwargs):
+    """Generates the missing pyramid of tiles of a part, queued by the iiif api."""
+    try:
+        DocumentPart = apps.get_model('core', 'DocumentPart')
+        part = DocumentPart.objects.get(pk=instance_pk)
+    except DocumentPart.DoesNotExist:
+        logger.error('Trying to generate the tiles of innexistant DocumentPart : %d', instance_pk)
+        return
+
+    try:
+        part.generate_tiles()
+    finally:
+        redis_.delete('tiles-%d' % instance_pk)
+
+
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=3 * 60)
 def convert(instance_pk=None, user_pk=None, **kwargs):
     if user_pk:
@@ -144,6 +164,74 @@ def binarize(instance_pk=None, user_pk=None, binarizer=None, threshold=None, **k
                         id="binarization-success", level='success')
 
 
+@shared_task(bind=True, default_retry_delay=10 * 60)
+def binarize_document(task, document_pk=None, part_pks=None, user_pk=None, threshold=None, **kwargs):
+    """
+    Binarizes several parts of a document,
+    the tiles of the big images are spread over a single pool of processes.
+    Only the parts which ran out of memory are retried.
+    """
+    task_name = 'core.tasks.binarize'
+    done = set()
+    try:
+        if user_pk:
+            try:
+                user = User.objects.get(pk=user_pk)
+                # If quotas are enforced, assert that the user still has free CPU minutes
+                if not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() != None:
+                    assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+            except User.DoesNotExist:
+                user = None
+        else:
+            user = None
+
+        DocumentPart = apps.get_model('core', 'DocumentPart')
+        parts = (DocumentPart.objects
+                 .filter(document=document_pk, pk__in=part_pks)
+                 .select_related('document')
+                 .order_by('order'))
+
+        processes = getattr(settings, 'BINARIZATION_PROCESSES', 1)
+        executor = make_executor(processes)
+        error = None
+        out_of_memory = []
+        try:
+            for part in parts:
+                if part_canceled(part):
+                    # its state was already set by cancel_tasks()
+                    done.add(part.pk)
+                    continue
+
+                update_part_task_state(part, task_name, 'task_prerun', task_id=task.request.id)
+                try:
+                    part.binarize(threshold=threshold, executor=executor, processes=processes)
+                except Exception as e:
+                    update_part_task_state(part, task_name, 'task_failure', task_id=task.request.id)
+                    logger.exception(e)
+                    error = e
+                    if isinstance(e, MemoryError):
+                        out_of_memory.append(part.pk)
+                else:
+                    update_part_task_state(part, task_name, 'task_success', task_id=task.request.id)
+                done.add(part.pk)
+        finally:
+            if executor:
+                executor.shutdown()
+    finally:
+        fail_remaining_parts(part_pks, done, task_name, task_id=task.request.id)
+
+    if out_of_memory:
+        retry_parts(task, out_of_memory, task_name)
+    if error is not None:
+        if user:
+            user.notify(_("Something went wrong during the binarization!"),
+                        id="binarization-error", level='danger')
+        raise error
+    elif user:
+        user.notify(_("Binarization done!"),
+                    id="binarization-success", level='success')
+
+
 def make_segmentation_training_data(part):
     data = {
         'image': part.image.path,
@@ -381,6 +469,95 @@ def recalculate_masks(instance_pk=None, user_pk=None, only=None, **kwargs):
     })
 
 
+def transform_failed(part, user_pk, event, error):
+    """
+    The editor reloads the part in any case, what was done before the error is kept.
+    """
+    logger.exception(error)
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+            user.notify(_("Something went wrong while transforming the image!"),
+                        id="transform-error", level='danger')
+        except User.DoesNotExist:
+            pass
+    send_event('document', part.document_id, event, {
+        "id": part.pk,
+        "error": str(error)
+    })
+
+
+def transform_done(part, event, **data):
+    # the tiles are generated by a task of their own which can be retried, unlike the transforms
+    if getattr(settings, 'TILES_ENABLE', True):
+        redis_.set('tiles-%d' % part.pk, 1, ex=60 * 60)
+        generate_part_tiles.delay(instance_pk=part.pk)
+    send_event('document', part.document_id, event, dict(data, id=part.pk))
+
+
+def transform_thumbnails(part):
+    # the transform is done, failing to generate the thumbnails doesn't undo it
+    if not getattr(settings, 'THUMBNAIL_ENABLE', True):
+        return {}
+    try:
+        return part.generate_thumbnails()
+    except Exception as e:
+        logger.exception(e)
+        return {}
+
+
+@shared_task
+def rotate(instance_pk=None, user_pk=None, angle=None, **kwargs):
+    """
+    Rotates a part, the api locked it until it's done (transform-<pk> in redis).
+    Never retried, the part would be rotated twice.
+    """
+    try:
+        try:
+            DocumentPart = apps.get_model('core', 'DocumentPart')
+            part = DocumentPart.objects.get(pk=instance_pk)
+        except DocumentPart.DoesNotExist:
+            logger.error('Trying to rotate innexistant DocumentPart : %d', instance_pk)
+            return
+
+        try:
+            part.rotate(angle)
+        except Exception as e:
+            transform_failed(part, user_pk, "part:rotated", e)
+            raise
+        thumbnails = transform_thumbnails(part)
+    finally:
+        redis_.delete('transform-%d' % instance_pk)
+    transform_done(part, "part:rotated", angle=angle, thumbnails=thumbnails)
+
+
+@shared_task
+def crop(instance_pk=None, user_pk=None, x1=None, y1=None, x2=None, y2=None, **kwargs):
+    """
+    Crops a part, the api locked it until it's done (transform-<pk> in redis).
+    Never retried, the part would be cropped twice.
+    """
+    try:
+        try:
+            DocumentPart = apps.get_model('core', 'DocumentPart')
+            part = DocumentPart.objects.get(pk=instance_pk)
+        except DocumentPart.DoesNotExist:
+            logger.error('Trying to crop innexistant DocumentPart : %d', instance_pk)
+            return
+
+        try:
+            part.crop(x1, y1, x2, y2)
+            # the file name didn't change so the old thumbnails need to go
+            get_thumbnailer(part.image).delete_thumbnails()
+        except Exception as e:
+            transform_failed(part, user_pk, "part:cropped", e)
+            raise
+        thumbnails = transform_thumbnails(part)
+    finally:
+        redis_.delete('transform-%d' % instance_pk)
+    transform_done(part, "part:cropped", thumbnails=thumbnails)
+
+
 def train_(qs, document, transcription, model=None, user=None):
     # # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
     from multiprocessing import current_process
@@ -558,6 +735,152 @@ def transcribe(instance_pk=None, model_pk=None, user_pk=None, text_direction=Non
                         level='success')
 
 
+def update_part_task_state(part, task_name, signal_name, task_id=None):
+    """
+    Mimics the celery signals handlers below for tasks processing several parts at once,
+    so that each part still goes through the usual workflow states.
+    """
+    data = json.loads(redis_.get('process-%d' % part.pk) or '{}')
+    data[task_name] = {
+        "task_id": task_id,
+        "status": signal_name,
+        "shared": True
+    }
+    redis_.set('process-%d' % part.pk, json.dumps(data))
+    status = {
+        'task_success': 'done',
+        'task_failure': 'error',
+        'task_prerun': 'ongoing',
+        'pending': 'pending'
+    }[signal_name]
+    update_client_state(part.pk, task_name, status, task_id=task_id,
+                        document_pk=part.document_id)
+
+
+def fail_remaining_parts(part_pks, done, task_name, task_id=None):
+    """
+    Marks as failed the parts a task processing several parts didn't get to,
+    otherwise they would stay pending forever.
+    Also drops the cancelation flags of the parts, the task is over.
+    """
+    if not part_pks:
+        return
+    DocumentPart = apps.get_model('core', 'DocumentPart')
+    for part in DocumentPart.objects.filter(pk__in=part_pks).exclude(pk__in=done):
+        update_part_task_state(part, task_name, 'task_failure', task_id=task_id)
+    redis_.delete(*['canceled-%d' % pk for pk in part_pks])
+
+
+def retry_parts(task, part_pks, task_name):
+    """
+    Retries a task processing several parts for the given parts only (the ones which ran out
+    of memory), the other ones are not processed a second time.
+    Returns if the task can't be retried anymore.
+    """
+    if task.request.retries >= task.max_retries:
+        return
+    DocumentPart = apps.get_model('core', 'DocumentPart')
+    for part in DocumentPart.objects.filter(pk__in=part_pks):
+        update_part_task_state(part, task_name, 'pending', task_id=task.request.id)
+    raise task.retry(kwargs=dict(task.request.kwargs, part_pks=part_pks))
+
+
+def part_canceled(part):
+    """
+    Whether the part was canceled while waiting for a task processing several parts.
+    """
+    return bool(redis_.delete('canceled-%d' % part.pk))
+
+
+@shared_task(bind=True, default_retry_delay=10 * 60)
+def transcribe_document(task, document_pk=None, part_pks=None, model_pk=None,
+                        user_pk=None, text_direction=None, **kwargs):
+    """
+    Transcribes several parts of a document in a single worker invocation.
+    The model is loaded once and the image of the next part is decoded
+    in a background thread while the current one is being recognized.
+    Only the parts which ran out of memory are retried.
+    """
+    task_name = 'core.tasks.transcribe'
+    done = set()
+    try:
+        if user_pk:
+            try:
+                user = User.objects.get(pk=user_pk)
+                # If quotas are enforced, assert that the user still has free CPU minutes
+                if not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() != None:
+                    assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+            except User.DoesNotExist:
+                user = None
+        else:
+            user = None
+
+        DocumentPart = apps.get_model('core', 'DocumentPart')
+        OcrModel = apps.get_model('core', 'OcrModel')
+        model = OcrModel.objects.get(pk=model_pk)
+        # warms up the model cache, every part will hit it
+        load_recognition_model(model.file.path)
+
+        parts = list(DocumentPart.objects
+                     .filter(document=document_pk, pk__in=part_pks)
+                     .select_related('document', 'document__main_script')
+                     .order_by('order'))
+
+        def load_image(part):
+            im = Image.open(part.image.path)
+            im.load()
+            return im
+
+        error = None
+        out_of_memory = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_image = executor.submit(load_image, parts[0]) if parts else None
+            for i, part in enumerate(parts):
+                image = next_image
+                if i + 1 < len(parts):
+                    next_image = executor.submit(load_image, parts[i + 1])
+
+                if part_canceled(part):
+                    # its state was already set by cancel_tasks()
+                    if image.exception() is None:
+                        image.result().close()
+                    done.add(part.pk)
+                    continue
+
+                update_part_task_state(part, task_name, 'task_prerun', task_id=task.request.id)
+                try:
+                    im = image.result()
+                    try:
+                        part.transcribe(model, text_direction=text_direction, image=im)
+                    finally:
+                        im.close()
+                except Exception as e:
+                    part.workflow_state = part.WORKFLOW_STATE_SEGMENTED
+                    part.save()
+                    update_part_task_state(part, task_name, 'task_failure', task_id=task.request.id)
+                    logger.exception(e)
+                    error = e
+                    if isinstance(e, MemoryError):
+                        out_of_memory.append(part.pk)
+                else:
+                    update_part_task_state(part, task_name, 'task_success', task_id=task.request.id)
+                done.add(part.pk)
+    finally:
+        fail_remaining_parts(part_pks, done, task_name, task_id=task.request.id)
+
+    if out_of_memory:
+        retry_parts(task, out_of_memory, task_name)
+    if error is not None:
+        if user:
+            user.notify(_("Something went wrong during the transcription!"),
+                        id="transcription-error", level='danger')
+        raise error
+    elif user:
+        user.notify(_("Transcription done!"),
+                    id="transcription-success",
+                    level='success')
+
+
 def check_signal_order(old_signal, new_signal):
     SIGNAL_ORDER = ['before_task_publish', 'task_prerun', 'task_failure', 'task_success']
     return SIGNAL_ORDER.index(old_signal) < SIGNAL_ORDER.index(new_signal)
@@ -567,7 +890,10 @@ def check_signal_order(old_signal, new_signal):
 def before_publish_state(sender=None, body=None, **kwargs):
     if not sender.startswith('core.tasks') or sender.endswith('train'):
         return
-    instance_id = body[1]["instance_pk"]
+    instance_id = body[1].get("instance_pk")
+    if instance_id is None:
+        # tasks working on several parts handle their state themselves
+        return
     data = json.loads(redis_.get('process-%d' % instance_id) or '{}')
 
     signal_name = kwargs['signal'].name
@@ -597,7 +923,9 @@ def before_publish_state(sender=None, body=None, **kwargs):
 def done_state(sender=None, body=None, **kwargs):
     if not sender.name.startswith('core.tasks') or sender.name.endswith('train'):
         return
-    instance_id = sender.request.kwargs["instance_pk"]
+    instance_id = sender.request.kwargs.get("instance_pk")
+    if instance_id is None:
+        return
 
     try:
         data = json.loads(redis_.get('process-%d' % instance_id) or '{}')
@@ -1,11 +1,28 @@
 from .views import DocumentTestCase
 from .share import DocumentShareTestCase
 from .process import DocumentPartProcessTestCase
-from .tasks import TasksTestCase 
+from .tasks import TasksTestCase
+from .model_cache import ModelCacheTestCase
+from .ordering import ReadingOrderTestCase
+from .masks import MakeMasksJobsTestCase
+from .geometry import GeometryTestCase
+from .binarization import TiledBinarizationTestCase
+from .tiles import TilesTestCase
+from .benchmark import BenchmarkTestCase
+from .deduplication import ImageDeduplicationTestCase, SharedImageDeletionTestCase
 
 __all__ = [
     DocumentTestCase,
     DocumentShareTestCase,
     DocumentPartProcessTestCase,
-    TasksTestCase
+    TasksTestCase,
+    ModelCacheTestCase,
+    ReadingOrderTestCase,
+    MakeMasksJobsTestCase,
+    GeometryTestCase,
+    TiledBinarizationTestCase,
+    TilesTestCase,
+    BenchmarkTestCase,
+    ImageDeduplicationTestCase,
+    SharedImageDeletionTestCase
 ]
@@ -0,0 +1,42 @@
+import tempfile
+
+from core.management.commands.benchmark import Benchmark, BENCHMARKS
+from core.models import Line, LineTranscription
+from core.tests.factory import CoreFactoryTestCase
+
+
+class BenchmarkTestCase(CoreFactoryTestCase):
+    def test_synthetic_document(self):
+        document = self.factory.make_synthetic_document(parts=2, lines=10, transcriptions=2)
+        self.assertEqual(document.parts.count(), 2)
+        self.assertEqual(Line.objects.filter(document_part__document=document).count(), 20)
+        self.assertEqual(LineTranscription.objects.filter(
+            line__document_part__document=document).count(), 40)
+        part = document.parts.first()
+        self.assertEqual(part.blocks.count(), 2)
+        self.assertEqual(list(part.lines.values_list('order', flat=True)), list(range(10)))
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark = Benchmark(self.factory, parts=1, lines=6, tmp_dir=tmp_dir,
+                                  ordering_lines=50)
+            report = benchmark.run(only=[name for name in BENCHMARKS if name != 'make_masks'])
+        self.assertEqual([r['name'] for r in report['results']],
+                         [name for name in BENCHMARKS if name != 'make_masks'])
+        for result in report['results']:
+            if not result['name'].startswith('reading_order'):
+                self.assertGreater(result['queries'], 0)
+            self.assertGreater(result['peak_rss'], 0)
+        self.assertTrue(report['results'][-1]['same_order'])
+        # lines were recreated by the imports and the segmentation post processing
+        part = benchmark.parts[0]
+        self.assertEqual(part.lines.count(), 6)
+
+    def test_peak_rss(self):
+        # the peak of a step doesn't include the ones of the previous steps
+        benchmark = Benchmark(self.factory)
+        big = benchmark.measure('big', lambda: bytearray(200 * 1024 * 1024))
+        small = benchmark.measure('small', lambda: None)
+        if not benchmark.peak_rss_per_step:
+            self.skipTest('The peak RSS of the process can only be reset on linux.')
+        self.assertGreater(big['peak_rss'] - small['peak_rss'], 100 * 1024 * 1024)
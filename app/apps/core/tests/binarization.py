@@ -0,0 +1,43 @@
+from PIL import Image, ImageDraw
+from django.test import SimpleTestCase
+
+from core.binarization import NLBIN_BYTES_PER_PIXEL, binarize, binarize_tile, make_tiles
+
+
+class TiledBinarizationTestCase(SimpleTestCase):
+    def make_image(self, width=1200, height=900):
+        # uneven background so that the image isn't bitonal
+        im = Image.linear_gradient('L').resize((width, height)).point(lambda p: 170 + p // 4)
+        draw = ImageDraw.Draw(im)
+        for y in range(50, height - 50, 40):
+            draw.rectangle((60, y, width - 60, y + 12), fill=30)
+        return im
+
+    def test_tiles_cover_image(self):
+        tiles = make_tiles(1000, 700, 300, 50)
+        covered = sum((i[2] - i[0]) * (i[3] - i[1]) for _, i in tiles)
+        self.assertEqual(covered, 1000 * 700)
+        for box, inner in tiles:
+            self.assertTrue(box[0] <= inner[0] and box[1] <= inner[1])
+            self.assertTrue(box[2] >= inner[2] and box[3] >= inner[3])
+            self.assertTrue(box[2] <= 1000 and box[3] <= 700)
+
+    def test_tiled_binarization(self):
+        im = self.make_image()
+        # forces 4 tiles or more
+        res = binarize(im, memory_limit=im.width * im.height * NLBIN_BYTES_PER_PIXEL // 4,
+                       overlap=32)
+        self.assertEqual(res.size, im.size)
+        self.assertEqual(res.mode, 'L')
+        # text stays black, background white
+        self.assertEqual(res.getpixel((600, 55)), 0)
+        self.assertEqual(res.getpixel((600, 75)), 255)
+        self.assertEqual(res.getpixel((10, 10)), 255)
+
+    def test_uniform_tile(self):
+        # nlbin can't binarize uniform tiles, they are kept as they are
+        res = binarize_tile(Image.new('L', (300, 200), 250))
+        self.assertEqual(res.size, (300, 200))
+        self.assertEqual(res.getextrema(), (255, 255))
+        res = binarize_tile(Image.new('L', (300, 200), 10))
+        self.assertEqual(res.getextrema(), (0, 0))
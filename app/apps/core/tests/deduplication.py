@@ -0,0 +1,120 @@
+import hashlib
+import os
+
+from django.core.files.base import ContentFile
+from django.test import TransactionTestCase
+from PIL import Image
+
+from core.models import DocumentPart
+from core.tests.factory import CoreFactory, CoreFactoryTestCase
+
+
+class ImageDeduplicationTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = self.factory.make_image_file().read()
+        self.image_hash = hashlib.sha256(self.content).hexdigest()
+        self.part = self.factory.make_part()
+        self.part.store_image('test.png', ContentFile(self.content), self.image_hash)
+        self.part.save()
+
+    def make_twin(self):
+        part = DocumentPart(document=self.part.document)
+        part.store_image('again.png', ContentFile(self.content), self.image_hash)
+        part.save()
+        self.factory.cleanup_registry.append(part)
+        return part
+
+    def test_store_twin(self):
+        twin = self.make_twin()
+        self.assertEqual(twin.image.name, self.part.image.name)
+        self.assertEqual(twin.image_file_size, len(self.content))
+        self.assertTrue(twin.file_is_shared(twin.image.name))
+
+        # an image stored in another document is not shared
+        other = DocumentPart(document=self.factory.make_document())
+        other.store_image('test.png', ContentFile(self.content), self.image_hash)
+        other.save()
+        self.factory.cleanup_registry.append(other)
+        self.assertNotEqual(other.image.name, self.part.image.name)
+
+    def test_crop_twin(self):
+        twin = self.make_twin()
+        twin.crop(0, 0, 10, 10)
+        self.assertNotEqual(twin.image.name, self.part.image.name)
+        self.assertEqual(twin.image_hash, '')
+        with Image.open(twin.image.path) as im:
+            self.assertEqual(im.size, (10, 10))
+        with Image.open(self.part.image.path) as im:
+            self.assertEqual(im.size, (60, 60))
+
+    def test_disk_usage(self):
+        owner = self.part.document.owner
+        usage = owner.calc_disk_usage()
+        self.make_twin()
+        self.assertEqual(owner.calc_disk_usage(), usage)
+
+    def test_twin_deleted_meanwhile(self):
+        # the last part using the image is deleted after the image was found
+        part = DocumentPart(document=self.part.document)
+        part.store_image('again.png', ContentFile(self.content), self.image_hash)
+        self.assertEqual(part.image.name, self.part.image.name)
+        part.image.storage.delete(part.image.name)
+        part.save()
+        self.factory.cleanup_registry.append(part)
+        # it got its own copy
+        self.assertNotEqual(part.image.name, self.part.image.name)
+        self.assertTrue(part.image.storage.exists(part.image.name))
+        part.refresh_from_db()
+        with part.image.open('rb') as fh:
+            self.assertEqual(fh.read(), self.content)
+
+
+class SharedImageDeletionTestCase(TransactionTestCase):
+    """
+    The files are deleted once the transaction is committed,
+    which never happens in a TestCase.
+    """
+    def setUp(self):
+        self.factory = CoreFactory()
+        content = self.factory.make_image_file().read()
+        image_hash = hashlib.sha256(content).hexdigest()
+        self.part = self.factory.make_part()
+        self.part.store_image('test.png', ContentFile(content), image_hash)
+        self.part.save()
+        self.twin = DocumentPart(document=self.part.document)
+        self.twin.store_image('again.png', ContentFile(content), image_hash)
+        self.twin.save()
+        self.factory.cleanup_registry.append(self.twin)
+        self.assertEqual(self.twin.image.name, self.part.image.name)
+
+    def tearDown(self):
+        self.factory.cleanup()
+
+    def test_delete_twin(self):
+        self.twin.delete()
+        self.factory.cleanup_registry.remove(self.twin)
+        self.assertTrue(os.path.exists(self.part.image.path))
+        # deleted with the last part using it
+        path = self.part.image.path
+        self.part.delete()
+        self.factory.cleanup_registry.remove(self.part)
+        self.assertFalse(os.path.exists(path))
+
+    def test_crop_twin(self):
+        twin = DocumentPart.objects.get(pk=self.twin.pk)
+        twin.crop(0, 0, 10, 10)
+        self.assertTrue(os.path.exists(self.part.image.path))
+        self.assertTrue(os.path.exists(twin.image.path))
+        with Image.open(self.part.image.path) as im:
+            self.assertEqual(im.size, (60, 60))
+
+    def test_rotate_twin(self):
+        directory = os.path.dirname(self.part.image.path)
+        files = set(os.listdir(directory))
+        twin = DocumentPart.objects.get(pk=self.twin.pk)
+        twin.rotate(90)
+        self.assertTrue(os.path.exists(self.part.image.path))
+        # the copy of the shared image made before rotating it was deleted
+        self.assertEqual(set(os.listdir(directory)) - files, {os.path.basename(twin.image.name)})
+        self.assertEqual(files - set(os.listdir(directory)), set())
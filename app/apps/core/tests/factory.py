@@ -28,8 +28,9 @@ class CoreFactory():
     """
     A model Factory to help create data for tests.
     """
-    def __init__(self):
-        redis_.flushall()
+    def __init__(self, flush_redis=True):
+        if flush_redis:
+            redis_.flushall()
         self.cleanup_registry = []
 
     def cleanup(self):
@@ -148,6 +149,87 @@ class CoreFactory():
                                              line=line,
                                              content='test %d' % i)
 
+    def make_page_image(self, width, height, n_lines, n_columns=2, line_height=40,
+                        name='page.png'):
+        """
+        A white page with n_lines black stripes spread over n_columns,
+        the stripes being where make_synthetic_document puts the baselines.
+        """
+        file = BytesIO()
+        file.name = name
+        image = Image.new('L', size=(width, height), color=255)
+        draw = ImageDraw.Draw(image)
+        for baseline, _ in self.synthetic_lines(width, height, n_lines, n_columns,
+                                                line_height=line_height):
+            (x1, y), (x2, _) = baseline
+            draw.rectangle([x1, y - 15, x2, y], fill=0)
+        image.save(file, 'png')
+        file.seek(0)
+        return file
+
+    def synthetic_lines(self, width, height, n_lines, n_columns=2, line_height=40, margin=50):
+        """Yields (baseline, column) for n_lines lines in reading order."""
+        column_width = (width - margin) // n_columns
+        per_column = max(1, -(-n_lines // n_columns))
+        for i in range(n_lines):
+            column, row = divmod(i, per_column)
+            x = margin + column * column_width
+            y = margin + line_height + row * line_height
+            yield [[x, y], [x + column_width - margin, y]], column
+
+    def make_synthetic_document(self, parts=1, lines=30, transcriptions=1, n_columns=2,
+                                line_height=40, width=1200, **kwargs):
+        """
+        A document of the given amount of parts, each having lines lines
+        in n_columns regions, transcribed transcriptions times.
+        Objects are bulk created so that big documents can be made quickly.
+        """
+        document = self.make_document(**kwargs)
+        trans = [self.make_transcription(document=document, name='synthetic %d' % i)
+                 for i in range(transcriptions)]
+        height = 2 * 50 + line_height * (-(-lines // n_columns) + 1)
+
+        for p in range(parts):
+            name = 'synthetic_%d.png' % p
+            img = self.make_page_image(width, height, lines, n_columns=n_columns,
+                                       line_height=line_height, name=name)
+            content = img.read()
+            part = self.make_part(document=document,
+                                  name='synthetic %d' % p,
+                                  original_filename=name,
+                                  image=SimpleUploadedFile(name=name,
+                                                           content=content,
+                                                           content_type='image/png'),
+                                  image_file_size=len(content))
+            column_width = (width - 50) // n_columns
+            blocks = []
+            for c in range(n_columns):
+                x = 50 + c * column_width
+                block = Block(document_part=part, order=c,
+                              box=[[x - 10, 40], [x + column_width - 40, 40],
+                                   [x + column_width - 40, height - 10], [x - 10, height - 10]])
+                block.make_external_id()
+                blocks.append(block)
+            blocks = Block.objects.bulk_create(blocks)
+
+            lines_ = []
+            for i, (baseline, column) in enumerate(self.synthetic_lines(
+                    width, height, lines, n_columns, line_height=line_height)):
+                (x1, y), (x2, _) = baseline
+                line = Line(document_part=part, block=blocks[column], order=i,
+                            baseline=baseline,
+                            mask=[[x1, y - 25], [x2, y - 25], [x2, y + 5], [x1, y + 5]])
+                line.make_external_id()
+                lines_.append(line)
+            lines_ = Line.objects.bulk_create(lines_)
+
+            LineTranscription.objects.bulk_create([
+                LineTranscription(transcription=tr, line=line,
+                                  content='synthetic line %d of %s' % (i, tr.name))
+                for tr in trans
+                for i, line in enumerate(lines_)])
+        return document
+
 
 class CoreFactoryTestCase(TestCase):
     def setUp(self):
@@ -0,0 +1,26 @@
+from django.test import SimpleTestCase
+from shapely import affinity
+from shapely.geometry import LineString
+
+from core.geometry import rotation_matrix, translation_matrix, transform_polygons
+
+
+class GeometryTestCase(SimpleTestCase):
+    def test_rotation_like_shapely(self):
+        baseline = [[10, 20], [150, 25], [300, 18]]
+        center, offset = (200, 100), (-50, 50)
+        for angle in (90, 180, 270, 33):
+            rotated = affinity.rotate(LineString(baseline), angle, origin=center)
+            expected = [[round(x - offset[0]), round(y - offset[1])] for x, y in rotated.coords]
+            result = transform_polygons([baseline],
+                                        rotation_matrix(angle, center, offset=offset))
+            self.assertEqual(result, [expected])
+
+    def test_translation(self):
+        polygons = [[[10, 10], [20, 10], [20, 20]], None, [], [[5, 7], [8, 9]]]
+        result = transform_polygons(polygons, translation_matrix(-5, -7))
+        self.assertEqual(result, [[[5, 3], [15, 3], [15, 13]], None, [], [[0, 0], [3, 2]]])
+
+    def test_empty(self):
+        self.assertEqual(transform_polygons([], translation_matrix(1, 1)), [])
+        self.assertEqual(transform_polygons([None], translation_matrix(1, 1)), [None])
@@ -0,0 +1,37 @@
+from django.test import SimpleTestCase
+
+from core.masks import make_jobs
+
+
+class MakeMasksJobsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.box = [[0, 0], [100, 0], [100, 100], [0, 100]]
+        self.lines = [
+            (1, [[10, 10], [90, 10]], 1),
+            (2, [[10, 50], [90, 50]], 1),
+            (3, [[10, 90], [90, 90]], None),
+            (4, None, 1),  # no baseline
+        ]
+
+    def test_group_by_block(self):
+        jobs = make_jobs(self.lines, {1, 2, 3, 4}, {1: self.box})
+        self.assertEqual(len(jobs), 2)
+        pks, baselines, context = jobs[0]
+        self.assertEqual(pks, [1, 2])
+        # other lines of the job are left out, the block is closed
+        self.assertEqual(context, [[[10, 90], [90, 90]], self.box + [self.box[0]]])
+        pks, baselines, context = jobs[1]
+        self.assertEqual(pks, [3])
+        self.assertEqual(context, [[[10, 10], [90, 10]], [[10, 50], [90, 50]]])
+
+    def test_only(self):
+        jobs = make_jobs(self.lines, {2}, {1: self.box})
+        self.assertEqual(len(jobs), 1)
+        pks, baselines, context = jobs[0]
+        self.assertEqual(pks, [2])
+        self.assertEqual(len(context), 3)
+
+    def test_chunks(self):
+        jobs = make_jobs(self.lines, {1, 2, 3}, {1: self.box}, chunk_size=1)
+        self.assertEqual([job[0] for job in jobs], [[1], [2], [3]])
+        self.assertIn([[10, 50], [90, 50]], jobs[0][2])
@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from core.model_cache import ModelCache
+
+
+class ModelCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.loads = []
+        self.files = []
+
+    def tearDown(self):
+        for path in self.files:
+            os.remove(path)
+
+    def make_file(self, size=10):
+        fd, path = tempfile.mkstemp(suffix='.mlmodel')
+        os.write(fd, b'0' * size)
+        os.close(fd)
+        self.files.append(path)
+        return path
+
+    def loader(self, path):
+        self.loads.append(path)
+        return object()
+
+    def test_hit(self):
+        cache = ModelCache(max_size=100)
+        path = self.make_file()
+        model = cache.get(path, self.loader)
+        self.assertIs(cache.get(path, self.loader), model)
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_reload_on_change(self):
+        cache = ModelCache(max_size=100)
+        path = self.make_file()
+        cache.get(path, self.loader)
+        with open(path, 'ab') as fh:
+            fh.write(b'more')
+        cache.get(path, self.loader)
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual(len(cache.entries), 1)
+
+    def test_lru_eviction(self):
+        cache = ModelCache(max_size=25)
+        path1, path2, path3 = self.make_file(), self.make_file(), self.make_file()
+        cache.get(path1, self.loader)
+        cache.get(path2, self.loader)
+        cache.get(path1, self.loader)  # path2 is now the least recently used
+        cache.get(path3, self.loader)
+        self.assertEqual(cache.evictions, 1)
+        cache.get(path1, self.loader)
+        self.assertEqual(len(self.loads), 3)
+        cache.get(path2, self.loader)
+        self.assertEqual(len(self.loads), 4)
+
+    def test_disabled(self):
+        cache = ModelCache(max_size=0)
+        path = self.make_file()
+        cache.get(path, self.loader)
+        cache.get(path, self.loader)
+        self.assertEqual(len(self.loads), 2)
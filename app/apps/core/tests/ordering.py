@@ -0,0 +1,49 @@
+from django.test import SimpleTestCase
+
+from core.ordering import reading_order
+
+
+class ReadingOrderTestCase(SimpleTestCase):
+    def setUp(self):
+        # two columns of 3 lines, given in a random order
+        self.blocks = {
+            1: [[0, 0], [100, 0], [100, 100], [0, 100]],
+            2: [[200, 0], [300, 0], [300, 100], [200, 100]],
+        }
+        self.lines = [
+            ([[210, 50], [290, 50]], None, 2),  # 0
+            ([[10, 10], [90, 10]], None, 1),  # 1
+            ([[10, 90], [90, 90]], None, 1),  # 2
+            ([[210, 10], [290, 10]], None, 2),  # 3
+            ([[10, 50], [90, 50]], None, 1),  # 4
+            ([[210, 90], [290, 90]], None, 2),  # 5
+        ]
+
+    def test_ltr(self):
+        order = reading_order(self.lines, self.blocks, [0, 0])
+        self.assertEqual(list(order), [1, 4, 2, 3, 0, 5])
+
+    def test_rtl(self):
+        order = reading_order(self.lines, self.blocks, [300, 0], rtl=True)
+        self.assertEqual(list(order), [3, 0, 5, 1, 4, 2])
+
+    def test_same_row(self):
+        blocks = {1: [[0, 0], [300, 0], [300, 100], [0, 100]]}
+        lines = [
+            ([[10, 60], [90, 60]], None, 1),
+            ([[160, 12], [290, 12]], None, 1),
+            ([[10, 10], [140, 10]], None, 1),
+        ]
+        order = reading_order(lines, blocks, [0, 0])
+        self.assertEqual(list(order), [2, 1, 0])
+
+    def test_orphans_and_invalid(self):
+        lines = self.lines + [
+            (None, None, None),  # invalid
+            ([[250, 150], [290, 150]], None, None),  # orphan, far from the origin
+        ]
+        order = reading_order(lines, self.blocks, [0, 0])
+        self.assertEqual(list(order), [1, 4, 2, 3, 0, 5, 7, 6])
+
+    def test_empty(self):
+        self.assertEqual(len(reading_order([], {}, [0, 0])), 0)
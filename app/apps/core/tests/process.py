@@ -1,5 +1,78 @@
-from django.test import TestCase
+from core.models import Block, BlockType, Line, LineType
+from core.tests.factory import CoreFactoryTestCase
 
 
-class DocumentPartProcessTestCase(TestCase):
-    pass
+class DocumentPartProcessTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.part = self.factory.make_part()
+        document = self.part.document
+        self.main = BlockType.objects.create(name='main')
+        self.heading = LineType.objects.create(name='heading')
+        document.valid_block_types.add(self.main)
+        document.valid_line_types.add(self.heading)
+        # what kraken returns for an image of 864x206
+        self.res = {
+            'regions': {
+                'main': [[[0, 0], [400, 0], [400, 200], [0, 200]]],
+                'marginalia': [[[450, 0], [850, 0], [850, 200], [450, 200]]]
+            },
+            'lines': [
+                {'baseline': [[10, 50], [390, 50]],
+                 'boundary': [[10, 30], [390, 30], [390, 60], [10, 60]],
+                 'script': 'heading'},
+                {'baseline': [[460, 50], [840, 50]],
+                 'boundary': None,
+                 'script': 'default'},
+                # outside of the regions
+                {'baseline': [[600, 204], [700, 204]],
+                 'boundary': [[600, 200], [700, 200], [700, 206], [600, 206]],
+                 'script': 'default'},
+            ]
+        }
+
+    def assertOrders(self, qs):
+        self.assertEqual(list(qs.values_list('order', flat=True)), list(range(qs.count())))
+
+    def test_both(self):
+        self.part.save_segmentation(self.res, steps='both')
+        blocks = list(self.part.blocks.all())
+        self.assertEqual(len(blocks), 2)
+        # the regions of an invalid type don't have one
+        self.assertEqual([b.typology for b in blocks], [self.main, None])
+        lines = list(self.part.lines.all())
+        self.assertEqual(len(lines), 3)
+        self.assertEqual([l.block for l in lines], blocks + [None])
+        self.assertEqual([l.typology for l in lines], [self.heading, None, None])
+        self.assertIsNone(lines[1].mask)
+        self.assertEqual(lines[0].baseline, [[10, 50], [390, 50]])
+        self.assertOrders(self.part.blocks.all())
+        self.assertOrders(self.part.lines.all())
+        self.assertTrue(all(b.external_id for b in blocks))
+        self.assertTrue(all(l.external_id for l in lines))
+        self.assertEqual(len(set(l.external_id for l in lines)), 3)
+
+    def test_steps(self):
+        # the existing blocks and lines are kept and come first
+        block = Block.objects.create(document_part=self.part,
+                                     box=[[0, 0], [800, 0], [800, 100], [0, 100]])
+        line = Line.objects.create(document_part=self.part, baseline=[[0, 10], [50, 10]])
+
+        self.part.save_segmentation(self.res, steps='regions')
+        self.assertEqual(self.part.blocks.count(), 3)
+        self.assertEqual(self.part.lines.count(), 1)
+        self.assertOrders(self.part.blocks.all())
+        self.assertEqual(self.part.blocks.first(), block)
+
+        self.part.save_segmentation(self.res, steps='lines')
+        self.assertEqual(self.part.blocks.count(), 3)
+        lines = list(self.part.lines.all())
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0], line)
+        self.assertOrders(self.part.lines.all())
+        # the first region containing the center of the line, in order
+        self.assertEqual([l.block for l in lines[1:]], [block, block, None])
+
+        # regions only don't add lines
+        self.part.save_segmentation({'regions': {}, 'lines': self.res['lines']}, steps='regions')
+        self.assertEqual(self.part.lines.count(), 4)
@@ -1,10 +1,13 @@
 import unittest
 import os
+from unittest import mock
 
 from django.urls import reverse
 from django.test import TestCase, override_settings
+from celery.exceptions import Retry
 
 from core.models import *
+from core.tasks import transcribe_document, rotate
 from core.tests.factory import CoreFactoryTestCase
 
 # DO NOT REMOVE THIS IMPORT, it will break a lot of tests
@@ -135,3 +138,179 @@ class TasksTestCase(CoreFactoryTestCase):
 
     def test_train_existing_segmentation_model(self):
         pass
+
+    def makeTranscribeParts(self):
+        part = self.factory.make_part()
+        parts = [part,
+                 self.factory.make_part(document=part.document),
+                 self.factory.make_part(document=part.document)]
+        for p in parts:
+            p.workflow_state = p.WORKFLOW_STATE_SEGMENTED
+            p.save()
+        return parts
+
+    def transcribeStatus(self, part):
+        part = DocumentPart.objects.get(pk=part.pk)
+        return part.tasks['core.tasks.transcribe']['status']
+
+    def test_transcribe_document(self):
+        parts = self.makeTranscribeParts()
+        document = parts[0].document
+        model = self.factory.make_model(document)
+
+        def transcribe(part, model, text_direction=None, image=None):
+            if part.pk == parts[1].pk:
+                raise ValueError('broken part')
+
+        with mock.patch.object(DocumentPart, 'transcribe', autospec=True,
+                               side_effect=transcribe) as mocked:
+            with self.assertRaises(ValueError):
+                document.transcribe_parts(parts, model)
+        self.assertEqual([c[0][0].pk for c in mocked.call_args_list],
+                         [p.pk for p in parts])
+        self.assertEqual(self.transcribeStatus(parts[0]), 'task_success')
+        self.assertEqual(self.transcribeStatus(parts[1]), 'task_failure')
+        self.assertEqual(self.transcribeStatus(parts[2]), 'task_success')
+        parts[1].refresh_from_db()
+        self.assertEqual(parts[1].workflow_state, parts[1].WORKFLOW_STATE_SEGMENTED)
+
+    def test_transcribe_document_out_of_memory(self):
+        # only the part which ran out of memory is transcribed again
+        parts = self.makeTranscribeParts()
+        document = parts[0].document
+        model = self.factory.make_model(document)
+        failed = []
+
+        def transcribe(part, model, text_direction=None, image=None):
+            if part.pk == parts[1].pk and not failed:
+                failed.append(part.pk)
+                raise MemoryError
+
+        with mock.patch.object(DocumentPart, 'transcribe', autospec=True,
+                               side_effect=transcribe) as mocked:
+            # the retry is run right away by the eager tasks
+            with self.assertRaises(Retry):
+                document.transcribe_parts(parts, model)
+        self.assertEqual([c[0][0].pk for c in mocked.call_args_list],
+                         [parts[0].pk, parts[1].pk, parts[2].pk, parts[1].pk])
+        for part in parts:
+            self.assertEqual(self.transcribeStatus(part), 'task_success')
+
+    def test_transcribe_document_fails_early(self):
+        # the model doesn't exist anymore, no part is left pending
+        parts = self.makeTranscribeParts()
+        document = parts[0].document
+        with self.assertRaises(OcrModel.DoesNotExist):
+            document.transcribe_parts(parts, OcrModel(pk=0))
+        for part in parts:
+            self.assertEqual(self.transcribeStatus(part), 'task_failure')
+
+    def test_transcribe_document_cancel(self):
+        parts = self.makeTranscribeParts()
+        document = parts[0].document
+        model = self.factory.make_model(document)
+        with mock.patch.object(transcribe_document, 'delay') as delay:
+            document.transcribe_parts(parts, model)
+        for part in parts:
+            self.assertEqual(self.transcribeStatus(part), 'pending')
+
+        # canceling a part doesn't revoke the task of the others
+        DocumentPart.objects.get(pk=parts[1].pk).cancel_tasks()
+        with mock.patch.object(DocumentPart, 'transcribe', autospec=True) as mocked:
+            transcribe_document.delay(**delay.call_args[1])
+        self.assertEqual([c[0][0].pk for c in mocked.call_args_list],
+                         [parts[0].pk, parts[2].pk])
+        self.assertEqual(self.transcribeStatus(parts[0]), 'task_success')
+        self.assertEqual(self.transcribeStatus(parts[1]), 'canceled')
+        self.assertEqual(self.transcribeStatus(parts[2]), 'task_success')
+
+    def test_transcribe(self):
+        part = self.factory.make_part()
+        model = self.factory.make_model(part.document)
+        trans = Transcription.objects.create(name='kraken:' + model.name, document=part.document)
+        self.factory.make_content(part, amount=2, transcription=trans)
+        box_line = Line.objects.create(document_part=part,
+                                       mask=[[10, 100], [10, 130], [60, 130], [60, 100]])
+        lines = list(part.lines.all())
+        existing = LineTranscription.objects.get(line=lines[0], transcription=trans)
+        existing.new_version()
+        existing.save()
+        LineTranscription.objects.filter(line=lines[1], transcription=trans).delete()
+
+        def rpred(model_, im, bounds=None, pad=16, bidi_reordering=True):
+            if bounds['type'] == 'box':
+                texts = ['box %d' % i for i, box in enumerate(bounds['boxes'])]
+            else:
+                texts = ['line %d' % i for i, line in enumerate(bounds['lines'])]
+            return iter([mock.Mock(prediction=text,
+                                   cuts=[[[i, 0], [i + 1, 10]] for i in range(len(text))],
+                                   confidences=[0.5] * len(text))
+                         for text in texts])
+
+        with mock.patch('core.models.load_recognition_model'), \
+             mock.patch('core.models.rpred.rpred', side_effect=rpred) as mocked:
+            part.transcribe(model)
+
+        # one pass for the baselines and one for the boxes
+        self.assertEqual([c[1]['bounds']['type'] for c in mocked.call_args_list],
+                         ['baselines', 'box'])
+        self.assertEqual(len(mocked.call_args_list[0][1]['bounds']['lines']), 2)
+        self.assertEqual(mocked.call_args_list[1][1]['bounds']['boxes'], [[10, 100, 60, 130]])
+
+        lts = {lt.line_id: lt for lt in LineTranscription.objects.filter(transcription=trans)}
+        self.assertEqual(lts[lines[0].pk].content, 'line 0')
+        self.assertEqual(lts[lines[1].pk].content, 'line 1')
+        self.assertEqual(lts[box_line.pk].content, 'box 0')
+        self.assertEqual(lts[box_line.pk].graphs[0],
+                         {'c': 'b', 'poly': [[0, 0], [1, 10]], 'confidence': 0.5})
+        # the updated transcription kept its versions and was marked as updated
+        self.assertEqual(lts[lines[0].pk].pk, existing.pk)
+        self.assertEqual(len(lts[lines[0].pk].versions), 1)
+        self.assertGreater(lts[lines[0].pk].version_updated_at, existing.version_updated_at)
+        self.assertEqual(lts[lines[1].pk].versions, [])
+        part.refresh_from_db()
+        self.assertEqual(part.workflow_state, part.WORKFLOW_STATE_TRANSCRIBING)
+
+    def test_rotate_fails(self):
+        # not retried, the editor is told to reload the part and the lock is released
+        part = self.factory.make_part()
+        redis_.set('transform-%d' % part.pk, 1)
+        with mock.patch.object(DocumentPart, 'rotate', autospec=True,
+                               side_effect=MemoryError) as mocked, \
+             mock.patch('core.tasks.send_event') as send_event:
+            with self.assertRaises(MemoryError):
+                rotate.delay(instance_pk=part.pk, user_pk=part.document.owner.pk, angle=90)
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(send_event.call_args[0][:3], ('document', part.document.pk, 'part:rotated'))
+        self.assertIn('error', send_event.call_args[0][3])
+        self.assertIsNone(redis_.get('transform-%d' % part.pk))
+
+    def test_binarize_document_out_of_memory(self):
+        # only the part which ran out of memory is binarized again
+        parts = self.makeTranscribeParts()
+        failed = []
+
+        def binarize(part, threshold=None, executor=None, processes=None):
+            if part.pk == parts[1].pk and not failed:
+                failed.append(part.pk)
+                raise MemoryError
+
+        with mock.patch.object(DocumentPart, 'binarize', autospec=True,
+                               side_effect=binarize) as mocked:
+            with self.assertRaises(Retry):
+                parts[0].document.binarize_parts(parts)
+        self.assertEqual([c[0][0].pk for c in mocked.call_args_list],
+                         [parts[0].pk, parts[1].pk, parts[2].pk, parts[1].pk])
+        for part in parts:
+            part = DocumentPart.objects.get(pk=part.pk)
+            self.assertEqual(part.tasks['core.tasks.binarize']['status'], 'task_success')
+
+    def test_binarize_document_fails_early(self):
+        # the pool of processes can't be started, no part is left pending
+        parts = self.makeTranscribeParts()
+        with mock.patch('core.tasks.make_executor', side_effect=OSError):
+            with self.assertRaises(OSError):
+                parts[0].document.binarize_parts(parts)
+        for part in parts:
+            part = DocumentPart.objects.get(pk=part.pk)
+            self.assertEqual(part.tasks['core.tasks.binarize']['status'], 'task_failure')
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from PIL import Image, ImageChops, ImageDraw
+from django.test import SimpleTestCase
+
+from core import tiles
+
+
+class TilesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'page.png')
+        self.im = Image.new('RGB', (1100, 700), 'white')
+        draw = ImageDraw.Draw(self.im)
+        for y in range(0, 700, 50):
+            draw.rectangle((0, y, 1100, y + 20), fill=(200, 30, 30))
+        self.im.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_region(self):
+        self.assertEqual(tiles.parse_region('full', 1100, 700), (0, 0, 1100, 700))
+        self.assertEqual(tiles.parse_region('square', 1100, 700), (200, 0, 700, 700))
+        self.assertEqual(tiles.parse_region('1000,600,500,500', 1100, 700), (1000, 600, 100, 100))
+        self.assertEqual(tiles.parse_region('pct:50,50,50,50', 1100, 700), (550, 350, 550, 350))
+        with self.assertRaises(tiles.TileRequestError):
+            tiles.parse_region('2000,0,10,10', 1100, 700)
+        with self.assertRaises(tiles.TileRequestError):
+            tiles.parse_region('foo', 1100, 700)
+
+    def test_parse_size(self):
+        self.assertEqual(tiles.parse_size('max', 400, 200, 1000, 10 ** 6), (400, 200))
+        self.assertEqual(tiles.parse_size('full', 400, 200, 1000, 10 ** 6), (400, 200))
+        self.assertEqual(tiles.parse_size('100,', 400, 200, 1000, 10 ** 6), (100, 50))
+        self.assertEqual(tiles.parse_size(',100', 400, 200, 1000, 10 ** 6), (200, 100))
+        self.assertEqual(tiles.parse_size('pct:50', 400, 200, 1000, 10 ** 6), (200, 100))
+        self.assertEqual(tiles.parse_size('!100,100', 400, 200, 1000, 10 ** 6), (100, 50))
+        self.assertEqual(tiles.parse_size('30,40', 400, 200, 1000, 10 ** 6), (30, 40))
+        with self.assertRaises(tiles.TileRequestError):
+            tiles.parse_size(',', 400, 200, 1000, 10 ** 6)
+
+    def test_size_limits(self):
+        # max is bounded by the limits
+        self.assertEqual(tiles.parse_size('max', 400, 200, 100, 10 ** 6), (100, 50))
+        self.assertEqual(tiles.parse_size('max', 400, 100, 1000, 100 * 25), (100, 25))
+        for size in ('full', 'pct:200', '2000,', '101,100'):
+            with self.assertRaises(tiles.TileRequestError):
+                tiles.parse_size(size, 400, 200, 100, 10 ** 6)
+        with self.assertRaises(tiles.TileRequestError):
+            tiles.parse_size('300,300', 400, 200, 1000, 300 * 299)
+        self.assertEqual(tiles.info('url', 400, 200, 100, 1000)['maxWidth'], 100)
+
+    def test_generate_and_delete(self):
+        dzi = tiles.generate_tiles(self.path)
+        base = tiles.tiles_base(self.path)
+        self.assertEqual(dzi, base + '.dzi')
+        self.assertTrue(os.path.exists(dzi))
+        top = tiles.max_level(1100, 700)
+        self.assertTrue(os.path.exists(os.path.join(base + '_files', str(top), '4_2.jpg')))
+        tiles.delete_tiles(self.path)
+        self.assertFalse(os.path.exists(dzi))
+        self.assertFalse(os.path.exists(base + '_files'))
+
+    def test_tiles_base(self):
+        # images differing by their extension don't share their pyramid
+        self.assertNotEqual(tiles.tiles_base(self.path),
+                            tiles.tiles_base(self.path.replace('.png', '.jpg')))
+
+    def test_render_region(self):
+        tiles.generate_tiles(self.path)
+        base = tiles.tiles_base(self.path)
+        region = (200, 100, 600, 500)
+        # full resolution, spans several tiles
+        res = tiles.render_region(base, 1100, 700, region, (600, 500))
+        self.assertEqual(res.size, (600, 500))
+        expected = self.im.crop((200, 100, 800, 600))
+        diff = ImageChops.difference(res, expected).convert('L')
+        self.assertLess(max(diff.getdata()), 40)  # jpeg artefacts
+        # downscaled, comes from a lower level
+        res = tiles.render_region(base, 1100, 700, region, (150, 125))
+        self.assertEqual(res.size, (150, 125))
@@ -0,0 +1,188 @@
+"""
+Deep zoom (DZI) pyramids of tiles of the DocumentPart images.
+
+The pyramid of an image 'documents/1/page.png' is stored next to it as
+'documents/1/tiles/page.png.dzi' and 'documents/1/tiles/page.png_files/<level>/<col>_<row>.jpg',
+level 0 being a single pixel and the last level the full resolution image.
+Regions of the image can then be rendered at any size by reading only the
+few tiles of the closest level instead of decoding the whole image.
+The rendered sizes are bounded by max_width (and height) and max_area.
+"""
+import math
+import os
+import re
+import shutil
+import tempfile
+
+import pyvips
+from PIL import Image
+
+TILE_SIZE = 256
+TILE_FORMAT = 'jpg'
+TILE_QUALITY = 85
+
+
+class TileRequestError(ValueError):
+    pass
+
+
+def tiles_base(name):
+    """
+    The path of the pyramid (without extension) of the image at path name,
+    the extension of the image is kept so that page.png and page.jpg don't share it.
+    """
+    dirname, basename = os.path.split(name)
+    return os.path.join(dirname, 'tiles', basename)
+
+
+def generate_tiles(image_path):
+    base = tiles_base(image_path)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    # generated aside and moved in place once done, the .dzi last,
+    # the existing pyramid is served meanwhile
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(base))
+    try:
+        tmp_base = os.path.join(tmp_dir, os.path.basename(base))
+        image = pyvips.Image.new_from_file(image_path, access='sequential')
+        image.dzsave(tmp_base,
+                     layout='dz',
+                     tile_size=TILE_SIZE,
+                     overlap=0,
+                     suffix='.%s[Q=%d]' % (TILE_FORMAT, TILE_QUALITY))
+        delete_tiles(image_path)
+        os.rename(tmp_base + '_files', base + '_files')
+        os.rename(tmp_base + '.dzi', base + '.dzi')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return base + '.dzi'
+
+
+def delete_tiles(image_path):
+    base = tiles_base(image_path)
+    if os.path.exists(base + '.dzi'):
+        os.remove(base + '.dzi')
+    shutil.rmtree(base + '_files', ignore_errors=True)
+
+
+def max_level(width, height):
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def scale_factors(width, height):
+    return [2 ** i for i in range(max_level(width, height) + 1)
+            if math.ceil(max(width, height) / 2 ** i) >= TILE_SIZE or i == 0]
+
+
+def parse_region(region, width, height):
+    """IIIF Image API region parameter -> (x, y, w, h) clipped to the image."""
+    if region == 'full':
+        x, y, w, h = 0, 0, width, height
+    elif region == 'square':
+        side = min(width, height)
+        x, y, w, h = (width - side) // 2, (height - side) // 2, side, side
+    else:
+        match = re.fullmatch(r'(pct:)?([\d.]+),([\d.]+),([\d.]+),([\d.]+)', region)
+        if not match:
+            raise TileRequestError('Invalid region %s.' % region)
+        values = [float(v) for v in match.groups()[1:]]
+        if match.group(1):
+            values = [values[0] * width / 100, values[1] * height / 100,
+                      values[2] * width / 100, values[3] * height / 100]
+        x, y, w, h = [int(v) for v in values]
+    w, h = min(w, width - x), min(h, height - y)
+    if w <= 0 or h <= 0:
+        raise TileRequestError('Region %s is out of the image.' % region)
+    return x, y, w, h
+
+
+def parse_size(size, w, h, max_width, max_area):
+    """
+    IIIF Image API size parameter -> (width, height) of the rendered region.
+    'max' is the full size bounded by the limits, any other size above them is refused,
+    as are the percentages above 100.
+    """
+    if size == 'max':
+        ratio = min(1, max_width / w, max_width / h, math.sqrt(max_area / (w * h)))
+        return max(1, int(w * ratio)), max(1, int(h * ratio))
+    sw, sh = _parse_size(size, w, h)
+    if max(sw, sh) > max_width or sw * sh > max_area:
+        raise TileRequestError('Size %s is above the limits (maxWidth %d, maxArea %d).' % (
+            size, max_width, max_area))
+    return sw, sh
+
+
+def _parse_size(size, w, h):
+    if size == 'full':
+        return w, h
+    match = re.fullmatch(r'pct:([\d.]+)', size)
+    if match:
+        ratio = float(match.group(1)) / 100
+        if ratio > 1:
+            raise TileRequestError('Invalid size %s, images are not upscaled.' % size)
+        return max(1, round(w * ratio)), max(1, round(h * ratio))
+    match = re.fullmatch(r'(!)?(\d*),(\d*)', size)
+    if not match or not (match.group(2) or match.group(3)):
+        raise TileRequestError('Invalid size %s.' % size)
+    best_fit, sw, sh = match.group(1), match.group(2), match.group(3)
+    if sw and sh:
+        sw, sh = int(sw), int(sh)
+        if best_fit:
+            ratio = min(sw / w, sh / h)
+            return max(1, round(w * ratio)), max(1, round(h * ratio))
+        return sw, sh
+    if best_fit:
+        raise TileRequestError('Invalid size %s.' % size)
+    if sw:
+        return int(sw), max(1, round(h * int(sw) / w))
+    return max(1, round(w * int(sh) / h)), int(sh)
+
+
+def render_region(base, width, height, region, size):
+    """
+    Renders the region (x, y, w, h) of the full resolution image of the pyramid stored at base
+    at the given size (width, height) and returns a PIL image.
+    Uses the smallest level at least as big as the requested size.
+    """
+    x, y, w, h = region
+    sw, sh = size
+    top = max_level(width, height)
+    # downscale factor 2**k of the level, the biggest one not going below the requested size
+    k = max(0, min(top, int(math.floor(math.log2(max(w / sw, h / sh, 1))))))
+    factor = 2 ** k
+    level = top - k
+    level_width, level_height = math.ceil(width / factor), math.ceil(height / factor)
+
+    # region in the level coordinates
+    lx0, ly0 = x // factor, y // factor
+    lx1 = min(math.ceil((x + w) / factor), level_width)
+    ly1 = min(math.ceil((y + h) / factor), level_height)
+
+    canvas = Image.new('RGB', (lx1 - lx0, ly1 - ly0), 'white')
+    for row in range(ly0 // TILE_SIZE, (ly1 - 1) // TILE_SIZE + 1):
+        for col in range(lx0 // TILE_SIZE, (lx1 - 1) // TILE_SIZE + 1):
+            path = os.path.join('%s_files' % base, str(level),
+                                '%d_%d.%s' % (col, row, TILE_FORMAT))
+            with Image.open(path) as tile:
+                canvas.paste(tile.convert('RGB'),
+                             (col * TILE_SIZE - lx0, row * TILE_SIZE - ly0))
+
+    if canvas.size != (sw, sh):
+        canvas = canvas.resize((sw, sh), Image.LANCZOS)
+    return canvas
+
+
+def info(url, width, height, max_width, max_area):
+    """IIIF Image API 2.1 info.json"""
+    return {
+        '@context': 'http://iiif.io/api/image/2/context.json',
+        '@id': url,
+        'protocol': 'http://iiif.io/api/image',
+        'width': width,
+        'height': height,
+        'maxWidth': max_width,
+        'maxArea': max_area,
+        'tiles': [{'width': TILE_SIZE, 'scaleFactors': scale_factors(width, height)}],
+        'profile': ['http://iiif.io/api/image/2/level1.json',
+                    {'formats': ['jpg', 'png'],
+                     'qualities': ['default', 'color', 'gray']}],
+    }
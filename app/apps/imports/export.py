@@ -0,0 +1,573 @@
+"""
+Rendering of the document exports, used by the document_export task.
+
+The ALTO and PAGE pages are rendered in a pool of processes (EXPORT_PROCESSES),
+each worker fetching its parts by itself, while the task appends them to the zip in order.
+
+The pages and the text of the parts are cached on disk (EXPORT_CACHE_DIR),
+an export only renders the parts changed since the previous one.
+
+The zips can also be streamed in the response as the parts are rendered (XMLExport.stream),
+since they are made the same way every time from the cache, their downloads can be resumed.
+"""
+import glob
+import hashlib
+import logging
+import math
+import multiprocessing
+import os.path
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from itertools import groupby, islice
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q, Prefetch, Avg, Max
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.text import slugify
+
+from core.models import DocumentPart, Line, LineTranscription, Transcription
+from imports.writers import AltoWriter, PagexmlWriter
+
+ALTO_FORMAT = "alto"
+PAGEXML_FORMAT = "pagexml"
+TEXT_FORMAT = "text"
+
+XML_WRITERS = {
+    ALTO_FORMAT: AltoWriter,
+    PAGEXML_FORMAT: PagexmlWriter,
+}
+
+# rendering through the templates is kept to compare it with the writers
+XML_TEMPLATES = {
+    ALTO_FORMAT: 'export/alto.xml',
+    PAGEXML_FORMAT: 'export/pagexml.xml',
+}
+
+# number of lines fetched at once by the text export
+TEXT_CHUNK_SIZE = 2000
+
+logger = logging.getLogger(__name__)
+
+# the writer of the export process, set by init_worker
+_writer = None
+
+
+class RenderError(Exception):
+    pass
+
+
+class ExportCache:
+    """
+    The renderings of the parts of an export, stored in EXPORT_CACHE_DIR/<part pk>/.
+
+    A rendering is named after its transcription, the export (format, region filter...)
+    and the change token of its part, made of its updated_at, its order
+    and the version_updated_at of its latest line transcription.
+    The tokens are fetched before rendering the parts,
+    a part changed meanwhile is cached under its previous token and rendered again next time.
+    The renderings of the deleted transcriptions and the ones unused for a while are
+    removed by purge (the purge_export_cache command).
+    """
+
+    def __init__(self, file_format, transcription, part_pks, key_parts=()):
+        self.extension = file_format == TEXT_FORMAT and 'txt' or 'xml'
+        self.transcription_pk = transcription.pk
+        self.key = hashlib.sha1(repr((file_format, transcription.pk) + tuple(key_parts))
+                                .encode()).hexdigest()[:16]
+        self.tokens = {}
+        for pk, updated_at, order, last_version in (
+                DocumentPart.objects
+                .filter(pk__in=part_pks)
+                .annotate(last_version=Max('lines__transcriptions__version_updated_at',
+                                           filter=Q(lines__transcriptions__transcription=transcription)))
+                .order_by()
+                .values_list('pk', 'updated_at', 'order', 'last_version')):
+            self.tokens[pk] = hashlib.sha1(repr((updated_at, order, last_version))
+                                           .encode()).hexdigest()[:16]
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        """Returns None if the cache is disabled (EXPORT_CACHE_DIR is empty)."""
+        if not getattr(settings, 'EXPORT_CACHE_DIR', None):
+            return None
+        return cls(*args, **kwargs)
+
+    @staticmethod
+    def part_dir(part_pk):
+        return os.path.join(settings.EXPORT_CACHE_DIR, str(part_pk))
+
+    def path(self, part_pk):
+        return os.path.join(self.part_dir(part_pk), '%d_%s_%s.%s' % (
+            self.transcription_pk, self.key, self.tokens[part_pk], self.extension))
+
+    def has(self, part_pk):
+        return os.path.exists(self.path(part_pk))
+
+    def get(self, part_pk):
+        path = self.path(part_pk)
+        try:
+            with open(path, 'rb') as fh:
+                content = fh.read()
+            # the age of a rendering is the time since it was last used
+            os.utime(path)
+            return content
+        except OSError:
+            return None
+
+    def set(self, part_pk, content):
+        path = self.path(part_pk)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # other exports may be reading it
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as fh:
+                fh.write(content)
+            os.replace(fh.name, path)
+            # the renderings of previous versions of the part
+            for old in glob.glob(os.path.join(os.path.dirname(path), '%d_%s_*' % (
+                    self.transcription_pk, self.key))):
+                if old != path:
+                    os.remove(old)
+        except OSError as e:
+            logger.warning("Couldn't cache the export of part %d: %s", part_pk, e)
+
+    @classmethod
+    def delete_part(cls, part_pk):
+        shutil.rmtree(cls.part_dir(part_pk), ignore_errors=True)
+
+    @classmethod
+    def purge(cls, max_age):
+        """
+        Removes the renderings of the deleted parts and transcriptions (or archived),
+        and the files of the cache unused for max_age seconds.
+        Returns the number of removed files.
+        """
+        root = settings.EXPORT_CACHE_DIR
+        if not root or not os.path.isdir(root):
+            return 0
+
+        limit = time.time() - max_age
+        dirs = [name for name in os.listdir(root) if name.isdigit()]
+        parts = set(map(str, DocumentPart.objects.filter(pk__in=dirs).values_list('pk', flat=True)))
+        # the archived transcriptions aren't exported anymore
+        transcriptions = set(map(str, Transcription.objects.filter(archived=False)
+                                 .values_list('pk', flat=True)))
+        removed = 0
+        for name in dirs:
+            path = os.path.join(root, name)
+            if name not in parts:
+                removed += len(os.listdir(path))
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            for filename in os.listdir(path):
+                filepath = os.path.join(path, filename)
+                try:
+                    if (filename.split('_')[0] not in transcriptions
+                            or os.path.getmtime(filepath) < limit):
+                        os.remove(filepath)
+                        removed += 1
+                except OSError:
+                    pass  # removed meanwhile by an export
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass  # not empty
+
+        # the sizes of the streamed zips
+        sizes = os.path.join(root, 'sizes')
+        if os.path.isdir(sizes):
+            for filename in os.listdir(sizes):
+                filepath = os.path.join(sizes, filename)
+                try:
+                    if os.path.getmtime(filepath) < limit:
+                        os.remove(filepath)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+def base_filename(document, file_format):
+    return "export_doc%d_%s_%s_%s" % (
+        document.pk,
+        slugify(document.name).replace('-', '_')[:32],
+        file_format,
+        datetime.now().strftime('%Y%m%d%H%M'))
+
+
+def split_region_types(region_types):
+    """
+    Returns the region types without the special 'Orphan' and 'Undefined' values
+    of the ExportForm, and whether these were selected (include_orphans, include_undefined).
+    """
+    types = [rt for rt in region_types if rt not in ('Orphan', 'Undefined')]
+    return types, 'Orphan' in region_types, 'Undefined' in region_types
+
+
+def text_lines(transcription, part_pks, region_types,
+               include_orphans=False, include_undefined=False):
+    region_filters = Q(line__block__typology_id__in=region_types)
+    if include_orphans:
+        region_filters |= Q(line__block__isnull=True)
+    if include_undefined:
+        region_filters |= Q(line__block__isnull=False, line__block__typology_id__isnull=True)
+
+    return (LineTranscription.objects
+            .filter(transcription=transcription, line__document_part__pk__in=part_pks)
+            .filter(region_filters)
+            .exclude(content="")
+            .order_by('line__document_part', 'line__document_part__order', 'line__order'))
+
+
+def iter_text(transcription, part_pks, region_types,
+              include_orphans=False, include_undefined=False):
+    """
+    Yields the lines of the text export one by one,
+    only TEXT_CHUNK_SIZE of them are fetched from the database at a time.
+    The text of the parts found in the cache is read from it instead,
+    the text of the others is cached once all their lines have been fetched.
+    """
+    lines = text_lines(transcription, part_pks, region_types,
+                       include_orphans=include_orphans,
+                       include_undefined=include_undefined)
+    cache = ExportCache.create(TEXT_FORMAT, transcription, part_pks,
+                               key_parts=(sorted(map(str, region_types)),
+                                          include_orphans, include_undefined))
+    if cache is None:
+        for content, in lines.values_list('content').iterator(chunk_size=TEXT_CHUNK_SIZE):
+            yield '%s\n' % content
+        return
+
+    parts = list(DocumentPart.objects.filter(pk__in=part_pks)
+                 .order_by('order').values_list('pk', flat=True))
+    cached = {pk for pk in parts if cache.has(pk)}
+    # the parts without any line are missing from the groups
+    groups = groupby(lines.exclude(line__document_part__in=cached)
+                     .values_list('line__document_part', 'content')
+                     .iterator(chunk_size=TEXT_CHUNK_SIZE),
+                     key=lambda line: line[0])
+    group_pk, group = next(groups, (None, None))
+    for pk in parts:
+        if pk in cached:
+            text = cache.get(pk)
+            if text is None:
+                # removed meanwhile by another export
+                text = ''.join('%s\n' % content for content, in
+                               lines.filter(line__document_part=pk).values_list('content'))
+                cache.set(pk, text.encode())
+            else:
+                text = text.decode()
+            yield text
+            continue
+
+        text = []
+        if pk == group_pk:
+            for part_pk, content in group:
+                text.append('%s\n' % content)
+                yield text[-1]
+            group_pk, group = next(groups, (None, None))
+        cache.set(pk, ''.join(text).encode())
+
+
+def write_text(filepath, transcription, part_pks, region_types,
+               include_orphans=False, include_undefined=False):
+    with open(filepath, 'w') as fh:
+        fh.writelines(iter_text(transcription, part_pks, region_types,
+                                include_orphans=include_orphans,
+                                include_undefined=include_undefined))
+
+
+def render_xml_page(tplt, document, part, transcription, region_types,
+                    include_orphans=False, include_undefined=False):
+    region_filters = Q(typology_id__in=region_types)
+    if include_undefined:
+        region_filters |= Q(typology_id__isnull=True)
+
+    render_orphans = {} if not include_orphans else {
+        'orphan_lines': part.lines.prefetch_transcription(transcription).filter(block=None)
+    }
+    return tplt.render({
+        'valid_block_types': document.valid_block_types.all(),
+        'valid_line_types': document.valid_line_types.all(),
+        'part': part,
+        'blocks': (part.blocks.filter(region_filters)
+                   .annotate(avglo=Avg('lines__order'))
+                   .order_by('avglo')
+                   .prefetch_related(
+                       Prefetch(
+                           'lines',
+                           queryset=Line.objects.prefetch_transcription(
+                               transcription)))),
+        **render_orphans
+    })
+
+
+def init_worker(writer):
+    global _writer
+    _writer = writer
+
+
+def render_part(part_pk):
+    try:
+        return _writer.render(DocumentPart.objects.get(pk=part_pk))
+    except Exception as e:
+        # some database errors don't survive pickling
+        raise RenderError(str(e))
+
+
+def make_executor(writer, processes):
+    if processes < 2:
+        return None
+    # the forked workers can't share the connections of the task, they open their own
+    connections.close_all()
+    # # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
+    multiprocessing.current_process().daemon = False
+    return ProcessPoolExecutor(max_workers=processes,
+                               initializer=init_worker, initargs=(writer,))
+
+
+def render_parts(writer, parts, executor=None, ahead=1):
+    """
+    Yields (part, page) in the order of parts, page being the rendered xml
+    or the exception raised while rendering it,
+    up to ahead parts being rendered in advance by the executor.
+    """
+    if executor is None:
+        for part in parts:
+            try:
+                yield part, writer.render(part)
+            except Exception as e:
+                yield part, e
+        return
+
+    parts = iter(parts)
+    futures = deque((part, executor.submit(render_part, part.pk))
+                    for part in islice(parts, ahead))
+    try:
+        while futures:
+            part, future = futures.popleft()
+            for next_part in parts:
+                futures.append((next_part, executor.submit(render_part, next_part.pk)))
+                break
+            try:
+                yield part, future.result()
+            except RenderError as e:
+                yield part, e
+    finally:
+        for part, future in futures:
+            future.cancel()
+
+
+class StreamBuffer:
+    """
+    The unseekable file a streamed zip is written to, keeping what is past start
+    until it is popped and sent, the position is the size of the zip so far.
+    """
+
+    def __init__(self, start=0):
+        self.start = start
+        self.position = 0
+        self.chunks = []
+
+    def write(self, data):
+        size = len(data)
+        if self.position + size > self.start:
+            self.chunks.append(bytes(data[max(self.start - self.position, 0):]))
+        self.position += size
+        return size
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+class XMLExport:
+    """
+    An ALTO or PAGE export, a zip of one file per part (and its image if include_images).
+    Only the parts missing from the cache are rendered.
+    """
+    CHUNK_SIZE = 64 * 1024
+    # part of the ETag, to be changed along with the way the streamed zips are written
+    ZIP_LAYOUT = 2
+
+    def __init__(self, file_format, document, part_pks, transcription, region_types,
+                 include_orphans=False, include_undefined=False, include_images=False):
+        self.writer = XML_WRITERS[file_format](document, transcription, region_types,
+                                               include_orphans=include_orphans,
+                                               include_undefined=include_undefined)
+        # the typologies are part of the pages
+        self.cache = ExportCache.create(
+            file_format, transcription, part_pks,
+            key_parts=(sorted(map(str, region_types)),
+                       include_orphans, include_undefined,
+                       [(t.pk, t.name) for t in self.writer.valid_block_types],
+                       [(t.pk, t.name) for t in self.writer.valid_line_types]))
+        self.parts = list(DocumentPart.objects.filter(document=document, pk__in=part_pks))
+        self.include_images = include_images
+
+    def pages(self, processes=1):
+        """
+        Yields (part, page) in the order of the parts, page being the rendered xml
+        or the exception raised while rendering it,
+        the parts missing from the cache are rendered in a pool of processes and cached.
+        """
+        cache = self.cache
+        cached = {part.pk for part in self.parts if cache and cache.has(part.pk)}
+        to_render = [part for part in self.parts if part.pk not in cached]
+        processes = min(processes, len(to_render))
+        executor = make_executor(self.writer, processes)
+
+        try:
+            pages = render_parts(self.writer, to_render, executor, ahead=processes * 2)
+            for part in self.parts:
+                page = part.pk in cached and cache.get(part.pk)
+                if not page:
+                    if part.pk in cached:
+                        # removed meanwhile by another export
+                        _, page = next(render_parts(self.writer, [part]))
+                    else:
+                        _, page = next(pages)
+                    if cache and not isinstance(page, Exception):
+                        cache.set(part.pk, page)
+                yield part, page
+        finally:
+            if executor:
+                executor.shutdown()
+
+    @staticmethod
+    def page_name(part):
+        return '%s.xml' % os.path.splitext(part.filename)[0]
+
+    @staticmethod
+    def skip(part, error, report=None):
+        if report:
+            report.append("Skipped {element}({image}) because '{reason}'.".format(
+                element=part.name, image=part.filename, reason=str(error)
+            ))
+
+    def write(self, filepath, report=None, processes=1):
+        """The parts failing to render are skipped and added to the report."""
+        with ZipFile(filepath, 'w') as zip_:
+            for part, page in self.pages(processes=processes):
+                if self.include_images:
+                    # Note adds image before the xml file
+                    zip_.write(part.image.path, part.filename)
+                if isinstance(page, Exception):
+                    self.skip(part, page, report=report)
+                else:
+                    zip_.writestr(self.page_name(part), page)
+
+    @cached_property
+    def etag(self):
+        """
+        Identifies the streamed zip, only known if the pages are cached,
+        rendering the pages again wouldn't give the same bytes (dates...).
+        """
+        if not self.cache:
+            return None
+        return '"%s"' % hashlib.sha1(repr((
+            self.ZIP_LAYOUT, self.cache.key, self.include_images,
+            [(part.pk, self.cache.tokens.get(part.pk), part.image.name) for part in self.parts]
+        )).encode()).hexdigest()
+
+    def write_stream(self, fh, sizing=False, report=None):
+        """
+        Writes the zip to the unseekable fh, yielding each time something was written to it.
+        The images are stored as is and the pages deflated,
+        the dates of the files are the ones of the parts so that the same parts
+        and pages always give the same bytes.
+        If sizing, the images aren't read but replaced by as many zeros,
+        it gives the size of the zip without their I/O.
+        """
+        with ZipFile(fh, 'w', compression=ZIP_DEFLATED) as zip_:
+            for part, page in self.pages():
+                date_time = timezone.localtime(part.updated_at).timetuple()[:6]
+                if self.include_images:
+                    info = ZipInfo(part.filename, date_time)
+                    info.file_size = part.image.size
+                    # the size of a deflated image isn't known without deflating it
+                    info.compress_type = ZIP_STORED
+                    with zip_.open(info, 'w') as dest:
+                        if sizing:
+                            for offset in range(0, info.file_size, self.CHUNK_SIZE):
+                                dest.write(bytes(min(self.CHUNK_SIZE, info.file_size - offset)))
+                        else:
+                            with part.image.open('rb') as image:
+                                for chunk in iter(partial(image.read, self.CHUNK_SIZE), b''):
+                                    dest.write(chunk)
+                                    yield
+                if isinstance(page, Exception):
+                    self.skip(part, page, report=report)
+                else:
+                    info = ZipInfo(self.page_name(part), date_time)
+                    info.compress_type = ZIP_DEFLATED
+                    zip_.writestr(info, page)
+                yield
+
+    def stream(self, start=0):
+        """Yields the chunks of the zip from the byte start, as the parts are rendered."""
+        buffer = StreamBuffer(start=start)
+        for _ in self.write_stream(buffer):
+            yield from buffer.pop()
+        # the central directory
+        yield from buffer.pop()
+        if start == 0:
+            self.save_size(buffer.position)
+
+    def size_path(self):
+        return os.path.join(settings.EXPORT_CACHE_DIR, 'sizes', self.etag.strip('"'))
+
+    def save_size(self, size):
+        if not self.etag:
+            return
+        path = self.size_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as fh:
+                fh.write(str(size))
+            os.replace(fh.name, path)
+        except OSError as e:
+            logger.warning("Couldn't cache the size of an export: %s", e)
+
+    def size(self):
+        """
+        The size of the streamed zip, only computed once for an ETag,
+        it is kept next to the cached pages.
+        """
+        if self.etag:
+            try:
+                with open(self.size_path()) as fh:
+                    size = int(fh.read())
+                os.utime(self.size_path())
+                return size
+            except (OSError, ValueError):
+                pass
+        buffer = StreamBuffer(start=math.inf)
+        for _ in self.write_stream(buffer, sizing=True):
+            pass
+        self.save_size(buffer.position)
+        return buffer.position
+
+
+def write_xml(filepath, file_format, document, part_pks, transcription, region_types,
+              include_orphans=False, include_undefined=False, include_images=False,
+              report=None):
+    """
+    Writes a zip of one ALTO or PAGE file per part (and its image if include_images),
+    the parts failing to render are skipped and added to the report.
+    """
+    XMLExport(file_format, document, part_pks, transcription, region_types,
+              include_orphans=include_orphans,
+              include_undefined=include_undefined,
+              include_images=include_images).write(
+                  filepath, report=report, processes=getattr(settings, 'EXPORT_PROCESSES', 4))
@@ -1,18 +1,22 @@
 import json
 import io
+import re
 from django.conf import settings
 import requests
 
 from django import forms
 from django.core.files.base import ContentFile
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.translation import gettext as _
 
 from bootstrap.forms import BootstrapFormMixin
 
 from core.models import Transcription, DocumentPart
+from imports import export
 from imports.models import DocumentImport
 from imports.parsers import make_parser, ParseError
 from imports.tasks import document_import, document_export
+from reporting.models import TaskReport
 from users.consumers import send_event
 
 
@@ -156,6 +160,9 @@ class ExportForm(BootstrapFormMixin, forms.Form):
         label=_('Include images'),
         help_text=_("Will significantly increase the time to produce and download the export."))
     region_types = forms.MultipleChoiceField(widget=forms.CheckboxSelectMultiple)
+    streaming = forms.BooleanField(
+        initial=False, required=False,
+        help_text=_("Sends the export in the response instead of preparing a file."))
 
     def __init__(self, document, user, *args, **kwargs):
         self.document = document
@@ -183,6 +190,85 @@ class ExportForm(BootstrapFormMixin, forms.Form):
 
         return super().clean()
 
+    def stream(self, range_header=None, if_range=None):
+        """
+        Returns the export in a streamed response, the pages being rendered as it is sent.
+        The zips of ALTO and PAGE files can be resumed with a 'bytes=<start>-' range_header
+        (the Range header of the request), if_range being its If-Range header.
+        """
+        region_types, include_orphans, include_undefined = export.split_region_types(
+            self.cleaned_data['region_types'])
+        file_format = self.cleaned_data['file_format']
+        part_pks = list(self.cleaned_data['parts'].values_list('pk', flat=True))
+        filename = export.base_filename(self.document, file_format)
+        report = TaskReport.objects.create(
+            user=self.user, document=self.document,
+            label=_('Export %(document_name)s') % {'document_name': self.document.name})
+        report.start(None, 'imports.forms.ExportForm.stream')
+
+        if file_format == self.TEXT_FORMAT:
+            # the lines are fetched as the response is sent
+            response = StreamingHttpResponse(
+                self.report_stream(report, export.iter_text(self.cleaned_data['transcription'],
+                                                            part_pks,
+                                                            region_types,
+                                                            include_orphans=include_orphans,
+                                                            include_undefined=include_undefined)),
+                content_type='text/plain; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename="%s.txt"' % filename
+            return response
+
+        zip_ = export.XMLExport(file_format, self.document, part_pks,
+                                self.cleaned_data['transcription'],
+                                region_types,
+                                include_orphans=include_orphans,
+                                include_undefined=include_undefined,
+                                include_images=self.cleaned_data['include_images'])
+        match = range_header and re.match(r'^bytes=(\d+)-$', range_header)
+        if zip_.etag and match and if_range in (None, zip_.etag):
+            start = int(match.group(1))
+            # renders the missing pages, the same pages are then read from the cache
+            size = zip_.size()
+            if start >= size:
+                self.end_report(report)
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+            response = StreamingHttpResponse(self.report_stream(report, zip_.stream(start=start)),
+                                             status=206, content_type='application/zip')
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, size - 1, size)
+            response['Content-Length'] = size - start
+        else:
+            response = StreamingHttpResponse(self.report_stream(report, zip_.stream()),
+                                             content_type='application/zip')
+
+        if zip_.etag:
+            response['ETag'] = zip_.etag
+            response['Accept-Ranges'] = 'bytes'
+        response['Content-Disposition'] = 'attachment; filename="%s.zip"' % filename
+        return response
+
+    @staticmethod
+    def end_report(report):
+        if report.done_at is None:
+            report.end()
+        # the streamed exports are made by the web process, on a single core
+        report.calc_cpu_cost(1)
+
+    def report_stream(self, report, chunks):
+        """
+        Yields the chunks of a streamed export, recording the time spent in its report
+        so that it counts towards the CPU quota like the exports made by the task.
+        """
+        try:
+            yield from chunks
+        except Exception as e:
+            report.error(str(e))
+            raise
+        finally:
+            # also when the download is interrupted
+            self.end_report(report)
+
     def process(self):
         parts = self.cleaned_data['parts']
         file_format = self.cleaned_data['file_format']
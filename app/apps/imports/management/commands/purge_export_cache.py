@@ -0,0 +1,25 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from imports.export import ExportCache
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Removes the cached pages of the exports of deleted parts and transcriptions, '
+            'and the ones unused for EXPORT_CACHE_MAX_AGE days.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.EXPORT_CACHE_MAX_AGE,
+                            help='Maximum age of the cached pages, in days.')
+
+    def handle(self, *args, **options):
+        if not settings.EXPORT_CACHE_DIR:
+            logger.info('The export cache is disabled on this instance, no need to run this command')
+            return
+
+        removed = ExportCache.purge(options['days'] * 24 * 60 * 60)
+        self.stdout.write('Removed %d files from the export cache.' % removed)
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from imports.models import ImportUpload
+
+
+class Command(BaseCommand):
+    help = ('Deletes the resumable uploads of imports created more than '
+            'IMPORT_UPLOAD_MAX_AGE hours ago, and their partial files.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=settings.IMPORT_UPLOAD_MAX_AGE,
+                            help='Maximum age of the uploads, in hours.')
+
+    def handle(self, *args, **options):
+        removed = ImportUpload.purge(options['hours'] * 60 * 60)
+        self.stdout.write('Deleted %d uploads and partial files.' % removed)
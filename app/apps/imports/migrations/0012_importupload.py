@@ -0,0 +1,31 @@
+# Generated by Django 2.2.24 on 2021-10-21 09:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0058_documentpart_image_hash'),
+        ('imports', '0011_auto_20201009_1015'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('filename', models.CharField(max_length=256)),
+                ('size', models.BigIntegerField()),
+                ('name', models.CharField(blank=True, max_length=256)),
+                ('override', models.BooleanField(default=False)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Document')),
+            ],
+        ),
+    ]
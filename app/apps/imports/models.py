@@ -1,16 +1,29 @@
+import fcntl
 import os.path
+import time
+import uuid
+from datetime import timedelta
 
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
 from django.core.validators import FileExtensionValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext as _
+from django_redis import get_redis_connection
 
 from escriptorium.celery import app
 
-from core.models import Document
+from core.models import Document, DocumentPart
 from users.models import User
+from imports.export import ExportCache
 from imports.parsers import make_parser, XML_EXTENSIONS
 from reporting.models import TaskReport
 
+redis_ = get_redis_connection()
+
 
 class DocumentImport(models.Model):
     WORKFLOW_STATE_CREATED = 0
@@ -72,22 +85,46 @@ class DocumentImport(models.Model):
         if self.report and self.report.task_id:
             app.control.revoke(self.report.task_id, terminate=True)
 
+    @property
+    def progress_key(self):
+        return 'import-%d-processed' % self.pk
+
+    def resume_at(self):
+        # the count in redis is ahead of the saved one if the worker died between two checkpoints
+        return max(self.processed, int(redis_.get(self.progress_key) or 0))
+
     def process(self, resume=True):
+        """
+        Yields the imported objects.
+        The progress is saved every settings.IMPORT_PROGRESS_EVERY objects
+        or IMPORT_PROGRESS_INTERVAL seconds, progress_saved tells if it just was;
+        in between, the count is only kept in redis, which is enough to resume the import.
+        """
+        every = getattr(settings, 'IMPORT_PROGRESS_EVERY', 20)
+        interval = getattr(settings, 'IMPORT_PROGRESS_INTERVAL', 2)
+        self.progress_saved = False
         try:
             self.workflow_state = self.WORKFLOW_STATE_STARTED
+            self.processed = resume and self.resume_at() or 0
             self.save()
 
-            start_at = resume and self.processed or 0
+            saved, saved_at = self.processed, time.monotonic()
             parser = make_parser(self.document, self.import_file,
                                  name=self.name, report=self.report)
-            for obj in parser.parse(start_at=start_at,
+            for obj in parser.parse(start_at=self.processed,
                                     override=self.override,
                                     user=self.started_by):
                 self.processed += 1
-                self.save()
+                redis_.set(self.progress_key, self.processed)
+                self.progress_saved = (self.processed - saved >= every
+                                       or time.monotonic() - saved_at >= interval)
+                if self.progress_saved:
+                    self.save()
+                    saved, saved_at = self.processed, time.monotonic()
                 yield obj
             self.workflow_state = self.WORKFLOW_STATE_DONE
             self.save()
+            redis_.delete(self.progress_key)
 
         except Exception as e:
             self.workflow_state = self.WORKFLOW_STATE_ERROR
@@ -95,3 +132,127 @@ class DocumentImport(models.Model):
             self.report.error(str(e))
             self.save()
             raise e
+
+
+class UploadConflict(Exception):
+    pass
+
+
+class AssembledFile(UploadedFile):
+    """
+    The file of a complete ImportUpload,
+    like a TemporaryUploadedFile it is moved to the storage instead of being copied.
+    """
+    def __init__(self, path, name, size):
+        super().__init__(open(path, 'rb'), name, None, size, None)
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class ImportUpload(models.Model):
+    """
+    A file uploaded in chunks to be imported, the chunks are appended to a file on disk
+    so that the upload can be resumed from its current offset after a network failure.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    document = models.ForeignKey(Document, on_delete=models.CASCADE)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    filename = models.CharField(max_length=256)
+    size = models.BigIntegerField()
+
+    # the options of the import
+    name = models.CharField(max_length=256, blank=True)
+    override = models.BooleanField(default=False)
+
+    @property
+    def path(self):
+        # in the media root to be moved to the storage without a copy once complete
+        return os.path.join(settings.MEDIA_ROOT, 'import_src', 'partial', str(self.id))
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def append(self, stream, start, length):
+        """
+        Writes length bytes read from stream at the position start of the file,
+        start has to be the current offset, and returns the new offset.
+        Whatever was received is kept if the stream ends early.
+        """
+        if start + length > self.size:
+            # checked by the api, it's a bad request rather than a conflict
+            raise ValueError("The chunk goes beyond the size of the file.")
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'ab') as fh:
+            # the same chunk could be sent twice at the same time
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadConflict(_("Another chunk is being uploaded."))
+
+            if fh.seek(0, os.SEEK_END) != start:
+                raise UploadConflict(_("The chunk doesn't start at the offset of the upload."))
+
+            remaining = length
+            while remaining:
+                chunk = stream.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                fh.write(chunk)
+                remaining -= len(chunk)
+            return fh.tell()
+
+    def assembled_file(self):
+        return AssembledFile(self.path, self.filename, self.size)
+
+    def delete_file(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @classmethod
+    def purge(cls, max_age):
+        """
+        Deletes the uploads created more than max_age seconds ago, they won't be resumed,
+        and the partial files left without an upload.
+        Returns the number of deleted uploads and files.
+        """
+        limit = timezone.now() - timedelta(seconds=max_age)
+        expired = cls.objects.filter(created_at__lt=limit)
+        removed = expired.count()
+        # one by one for the pre_delete signal to remove their files
+        for upload in expired:
+            upload.delete()
+
+        partial_dir = os.path.join(settings.MEDIA_ROOT, 'import_src', 'partial')
+        if os.path.isdir(partial_dir):
+            ids = set(map(str, cls.objects.values_list('id', flat=True)))
+            for filename in os.listdir(partial_dir):
+                path = os.path.join(partial_dir, filename)
+                try:
+                    if (filename not in ids
+                            and os.path.getmtime(path) < limit.timestamp()):
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+@receiver(pre_delete, sender=ImportUpload, dispatch_uid='import_upload_delete_signal')
+def delete_upload_file(sender, instance, using, **kwargs):
+    instance.delete_file()
+
+
+@receiver(pre_delete, sender=DocumentPart, dispatch_uid='export_cache_delete_signal')
+def delete_export_cache(sender, instance, using, **kwargs):
+    if getattr(settings, 'EXPORT_CACHE_DIR', None):
+        part_pk = instance.pk
+        transaction.on_commit(lambda: ExportCache.delete_part(part_pk))
@@ -1,23 +1,33 @@
+import hashlib
 import json
 import logging
 import os.path
 import re
 import requests
+import shutil
+import tempfile
+import threading
 import time
 import uuid
 import zipfile
 import pyvips
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from lxml import etree
 from urllib.parse import urlparse
 
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.core.validators import get_available_image_extensions
 from django.db import transaction
 from django.forms import ValidationError
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from django.utils.functional import cached_property
 
+from imports import pdf, schemas
 from core.models import (Block,
                          Line,
                          Transcription,
@@ -41,6 +51,28 @@ class DownloadError(ParseError):
     pass
 
 
+def map_ahead(executor, func, items, ahead):
+    """
+    Submits func(item) to the executor for each item, at most ahead calls in advance
+    of the consumer, and yields the (item, future) tuples in the order of items.
+    If the consumer stops early, the pending calls are cancelled
+    and the results (files) of the ones already done are closed.
+    """
+    items = iter(items)
+    futures = deque((item, executor.submit(func, item)) for item in islice(items, ahead))
+    try:
+        while futures:
+            item, future = futures.popleft()
+            for next_item in items:
+                futures.append((next_item, executor.submit(func, next_item)))
+                break
+            yield item, future
+    finally:
+        for item, future in futures:
+            if not future.cancel() and future.exception() is None:
+                future.result().close()
+
+
 class ParserDocument:
     """
     The base class for parsing files to populate a core.Document object
@@ -76,53 +108,107 @@ class PdfParser(ParserDocument):
     def __init__(self, document, file_handler, report):
         super().__init__(document, file_handler, report)
         pyvips.voperation.cache_set_max(10) # 0 = no parallelisation at all; default is 1000
+        self.tmp_file = None
 
-    def validate(self):
+    @cached_property
+    def path(self):
+        # pages are loaded from the file on disk, not from a copy in memory
+        if hasattr(self.file, 'temporary_file_path'):
+            return self.file.temporary_file_path()
         try:
-            self.doc = pyvips.Image.pdfload_buffer(self.file.read(), n=-1, access='sequential')
-        except pyvips.error.Error as e:
+            return self.file.path
+        except (AttributeError, NotImplementedError, ValueError):
+            # uploaded in memory
+            self.tmp_file = tempfile.NamedTemporaryFile(suffix='.pdf')
+            self.file.seek(0)
+            shutil.copyfileobj(self.file, self.tmp_file)
+            self.tmp_file.flush()
+            return self.tmp_file.name
+
+    def close(self):
+        # deletes the copy of a file uploaded in memory, if any
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+            self.tmp_file = None
+            del self.path
+
+    @cached_property
+    def n_pages(self):
+        try:
+            return pdf.count_pages(self.path)
+        except pdf.RenderError as e:
             logger.exception(e)
             raise ParseError(_("Invalid PDF file."))
+        finally:
+            self.close()
+
+    def validate(self):
+        self.n_pages
 
     @property
     def total(self):
-        if 'n-pages' in self.doc.get_fields():
-            return self.doc.get('n-pages')
-        else:
-            return 0
+        return self.n_pages
 
     def parse(self, start_at=0, override=False, user=None):
-        buff = self.file.read()
-        doc = pyvips.Image.pdfload_buffer(buff, n=-1, access='sequential')
-        n_pages = doc.get('n-pages')
-        try:
+        n_pages = self.n_pages
+        storage = DocumentPart._meta.get_field('image').storage
+        parts = {}
+
+        def pages():
+            # the pages are rendered straight to their place in the storage
             for page_nb in range(start_at, n_pages):
+                part = DocumentPart(document=self.document)
+                part.original_filename = '%s_page_%d.png' % (
+                    self.file.name.rsplit('/')[-1], page_nb+1)
+                part.image.name = storage.get_available_name(
+                    part.image.field.generate_filename(part, part.original_filename),
+                    max_length=part.image.field.max_length)
+                os.makedirs(os.path.dirname(part.image.path), exist_ok=True)
+                parts[page_nb] = part
+                yield page_nb, part.image.path
+
+        processes = getattr(settings, 'PDF_IMPORT_PROCESSES', 4)
+        executor = pdf.make_executor(processes)
+        renders = pdf.render_pages(self.path, pages(), executor=executor, ahead=processes * 2)
+        try:
+            for page_nb, path, image_hash in renders:
+                part = parts.pop(page_nb)
                 # If quotas are enforced, assert that the user still has free disk storage
                 if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
+                    os.remove(path)
                     raise DiskQuotaReachedError(
                         _(f"You ran out of disk storage. {n_pages - page_nb} pages were left to import (over {n_pages - start_at})")
                     )
 
-                page = pyvips.Image.pdfload_buffer(buff,
-                                                   page=page_nb,
-                                                   dpi=300,
-                                                   access='sequential')
-                part = DocumentPart(document=self.document)
-                fname = '%s_page_%d.png' % (self.file.name.rsplit('/')[-1], page_nb+1)
-                part.image_file_size = 0
-                part.image.save(fname, ContentFile(page.write_to_buffer('.png')))
+                if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                    os.chmod(path, settings.FILE_UPLOAD_PERMISSIONS)
+                own_name = part.image.name
+                twin = part.find_twin_image(image_hash)
+                if twin:
+                    # the page was already imported
+                    part.image = twin
+                part.image_hash = image_hash
                 part.image_file_size = part.image.size
-                part.original_filename = fname
                 part.save()
+                if twin:
+                    if part.twin_image_kept():
+                        os.remove(path)
+                    else:
+                        part.image = own_name
+                        part.save()
                 yield part
-                page_nb = page_nb + 1
-        except pyvips.error.Error as e:
+        except pdf.RenderError as e:
             msg = _("Parse error in {filename}: {error}, skipping it.").format(
                 filename=self.file.name, error=e.args[0]
             )
             logger.warning(msg)
             if self.report:
                 self.report.append(msg)
+        finally:
+            renders.close()
+            if executor:
+                executor.shutdown()
+            self.close()
 
 
 class ZipParser(ParserDocument):
@@ -131,37 +217,71 @@ class ZipParser(ParserDocument):
     """
 
     DEFAULT_NAME = _("Zip Import")
+    CHUNK_SIZE = 64 * 1024
 
-    def validate(self):
+    @cached_property
+    def archive(self):
+        # only reads the listing of the members, opened once for the validation and the import
         try:
-            with zipfile.ZipFile(self.file) as zfh:
-                if zfh.testzip() is not None:
-                    raise ParseError(_("File appears to not be a valid zip."))
-                # for i,finfo in enumerate(zfh.infolist()):
-                #     with zfh.open(finfo) as zipedfh:
-                #         parser = make_parser(self.document, zipedfh)
-                #         parser.validate()
-        except Exception as e:
+            return zipfile.ZipFile(self.file)
+        except (zipfile.BadZipFile, OSError) as e:
             logger.exception(e)
             raise ParseError(_("Zip file appears to be corrupted."))
 
+    @cached_property
+    def members(self):
+        return self.archive.infolist()
+
+    def validate(self):
+        # the CRC of each member is checked when it is extracted instead of decompressing
+        # the whole archive here (testzip)
+        self.members
+
     @property
     def total(self):
-        # TODO: we open the file twice on upload
-        with zipfile.ZipFile(self.file) as zfh:
-            return len(zfh.infolist())
+        return len(self.members)
+
+    @staticmethod
+    def is_image(finfo):
+        extension = os.path.splitext(finfo.filename)[1][1:]
+        return extension.lower() in get_available_image_extensions()
+
+    def extract(self, finfo):
+        """
+        Streams the member to a temporary file which can be moved to the storage,
+        reading it until the end verifies its CRC (raises zipfile.BadZipFile).
+        The sha256 of the content is stored on the file.
+        """
+        fh = TemporaryUploadedFile(os.path.basename(finfo.filename), None, finfo.file_size, None)
+        sha256 = hashlib.sha256()
+        try:
+            with self.archive.open(finfo) as zipedfh:
+                for chunk in iter(partial(zipedfh.read, self.CHUNK_SIZE), b''):
+                    fh.write(chunk)
+                    sha256.update(chunk)
+        except Exception:
+            fh.close()
+            raise
+        fh.sha256 = sha256.hexdigest()
+        fh.seek(0)
+        return fh
 
     def parse(self, start_at=0, override=False, user=None):
-        with zipfile.ZipFile(self.file) as zfh:
-            total = len(zfh.infolist())
-            for index, finfo in enumerate(zfh.infolist()):
-                if index < start_at:
-                    continue
-                with zfh.open(finfo) as zipedfh:
-                    try:
-                        file_extension = os.path.splitext(zipedfh.name)[1][1:]
-                        # image
-                        if file_extension.lower() in get_available_image_extensions():
+        total = len(self.members)
+        members = list(enumerate(self.members))[start_at:]
+        # images are extracted ahead in parallel, the parts are still created in order
+        threads = getattr(settings, 'ZIP_IMPORT_THREADS', 4)
+        executor = ThreadPoolExecutor(max_workers=threads)
+        images = map_ahead(executor, self.extract,
+                           [finfo for index, finfo in members if self.is_image(finfo)],
+                           threads * 2)
+        try:
+            for index, finfo in members:
+                try:
+                    # image
+                    if self.is_image(finfo):
+                        image = next(images)[1].result()
+                        try:
                             # If quotas are enforced, assert that the user still has free disk storage
                             if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
                                 raise DiskQuotaReachedError(
@@ -170,99 +290,205 @@ class ZipParser(ParserDocument):
                             try:
                                 part = DocumentPart.objects.filter(
                                     document=self.document,
-                                    original_filename=zipedfh.name
+                                    original_filename=finfo.filename
                                 )[0]
                             except IndexError:
                                 part = DocumentPart(
                                     document=self.document,
-                                    original_filename=zipedfh.name
+                                    original_filename=finfo.filename
                                 )
-                            part.image_file_size = 0
-                            part.image.save(zipedfh.name, ContentFile(zipedfh.read()))
-                            part.image_file_size = part.image.size
+                            # moves the extracted file to the storage instead of copying it
+                            part.store_image(finfo.filename, image, image.sha256)
                             part.save()
+                        finally:
+                            image.close()
 
-                        # xml
-                        elif file_extension in XML_EXTENSIONS:
+                    # xml
+                    elif os.path.splitext(finfo.filename)[1][1:] in XML_EXTENSIONS:
+                        with self.archive.open(finfo) as zipedfh:
                             parser = make_parser(self.document, zipedfh,
-                                                 name=self.name, report=self.report)
+                                                 name=self.name, report=self.report,
+                                                 reopen=partial(self.archive.open, finfo))
 
                             for part in parser.parse(override=override, user=user):
                                 yield part
-                    except IndexError:
-                        # no file extension!?
-                        pass
-                    except ParseError as e:
-                        # we let go to try other documents
-                        msg = _("Parse error in {filename}: {error}, skipping it.").format(
-                            filename=self.file.name, error=e.args[0]
-                        )
-                        logger.warning(msg)
-                        if self.report:
-                            self.report.append(msg)
-                        if user:
-                            user.notify(msg, id="import:warning", level="warning")
+                except (ParseError, zipfile.BadZipFile) as e:
+                    # we let go to try other documents
+                    msg = _("Parse error in {filename}: {error}, skipping it.").format(
+                        filename=self.file.name, error=e.args[0]
+                    )
+                    logger.warning(msg)
+                    if self.report:
+                        self.report.append(msg)
+                    if user:
+                        user.notify(msg, id="import:warning", level="warning")
+        finally:
+            images.close()
+            executor.shutdown()
+            self.archive.close()
+            # a later call opens it again
+            del self.archive
+
+
+def read_header(file_handler):
+    """
+    Starts an incremental parsing of the xml file and stops at the first page,
+    returns the root element, only containing the header (metadata, tags...) at this point,
+    and the iterparse context to resume the parsing from.
+    """
+    context = etree.iterparse(file_handler, events=('start', 'end'))
+    root = None
+    try:
+        for event, elem in context:
+            if root is None:
+                root = elem
+            if event == 'start' and etree.QName(elem).localname in ('Layout', 'Page'):
+                break
+    except etree.XMLSyntaxError as e:
+        raise ParseError("Invalid XML. %s" % e.msg)
+    return root, context
 
 
 class XMLParser(ParserDocument):
     ACCEPTED_SCHEMAS = ()
 
-    def __init__(self, document, file_handler, report, transcription_name=None, xml_root=None):
+    def __init__(self, document, file_handler, report, transcription_name=None,
+                 xml_root=None, context=None, reopen=None):
         super().__init__(document,
                          file_handler,
                          transcription_name=transcription_name,
                          report=report)
-        if xml_root is not None:
-            self.root = xml_root
-            try:
-                self.schema_location = self.root.xpath(
-                    "//*/@xsi:schemaLocation",
-                    namespaces={"xsi": "http://www.w3.org/2001/XMLSchema-instance"},
-                )[0].split(" ")[-1]
-            except (etree.XPathEvalError, IndexError) as e:
-                message = "Cannot Find Schema location %s, %s" % (e.args[0], OWN_RISK)
-                if report:
-                    report.append(message)
-                else:
-                    raise ParseError(message)
-        else:
-            try:
-                self.root = etree.parse(self.file).getroot()
-            except (AttributeError, etree.XMLSyntaxError) as e:
-                raise ParseError("Invalid XML. %s" % e.args[0])
+        if xml_root is None:
+            xml_root, context = read_header(self.file)
+        self.root = xml_root
+        self.context = context
+        # returns a new file handler on the file, cf start_validation
+        self.reopen = reopen
+        self.schema_location = None
+        try:
+            self.schema_location = self.root.xpath(
+                "//*/@xsi:schemaLocation",
+                namespaces={"xsi": "http://www.w3.org/2001/XMLSchema-instance"},
+            )[0].split(" ")[-1]
+        except (etree.XPathEvalError, IndexError) as e:
+            message = "Cannot Find Schema location %s, %s" % (e.args[0], OWN_RISK)
+            if report:
+                report.append(message)
+            else:
+                raise ParseError(message)
+
+    @property
+    def page_tag(self):
+        return etree.QName(self.root.nsmap.get(None), 'Page').text
+
+    def restart(self, **kwargs):
+        """
+        A new incremental parsing of the whole file,
+        the ongoing one, if any, can't be resumed anymore.
+        """
+        self.context = None
+        self.file.seek(0)
+        return etree.iterparse(self.file, events=('end',), tag=self.page_tag, **kwargs)
+
+    def iter_pages(self, context):
+        """
+        Resumes the incremental parsing of context and yields the pages one at a time,
+        a page is cleared from memory (with everything before it) once processed
+        so that the memory used doesn't depend on the size of the file.
+        """
+        for event, elem in context:
+            if event == 'end' and elem.tag == self.page_tag:
+                yield elem
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
 
     def validate(self):
-        if self.schema_location in self.ACCEPTED_SCHEMAS:
-            try:
-                response = requests.get(self.schema_location)
-                content = response.content
-                schema_root = etree.XML(content)
-            except requests.exceptions.RequestException as e:
-                logger.exception(e)
-                if self.report:
-                    self.report.append("Can't reach validation document %s, %s" % (
-                        self.schema_location, OWN_RISK))
-            else:
+        # the header was parsed by make_parser already, the (slow) validation against the schema
+        # happens in the background of the import, cf start_validation
+        pass
+
+    def validate_schema(self, fh):
+        """
+        Validates the whole file read from fh against its schema,
+        returns the messages to add to the report.
+        """
+        if self.schema_location not in self.ACCEPTED_SCHEMAS:
+            return ["Document Schema %s is not in the accepted escriptiium list. Valid schemas are: %s, %s" %
+                    (self.schema_location, self.ACCEPTED_SCHEMAS, OWN_RISK)]
+
+        try:
+            xmlschema = schemas.get_schema(self.schema_location)
+        except schemas.SchemaUnavailable as e:
+            logger.exception(e)
+            return ["Can't reach validation document %s, %s" % (self.schema_location, OWN_RISK)]
+
+        context = etree.iterparse(fh, events=('end',), tag=self.page_tag, schema=xmlschema)
+        try:
+            for page in self.iter_pages(context):
+                pass
+        except (etree.DocumentInvalid, etree.XMLSyntaxError) as e:
+            return ["Document didn't validate. %s, %s" % (e.args[0], OWN_RISK)]
+        return []
+
+    def open_again(self):
+        if self.reopen:
+            return self.reopen()
+        if hasattr(self.file, 'temporary_file_path'):
+            return open(self.file.temporary_file_path(), 'rb')
+        try:
+            return open(self.file.path, 'rb')
+        except (AttributeError, NotImplementedError, ValueError, OSError):
+            return None
+
+    def start_validation(self):
+        """
+        Validates the file against its schema in a thread, reading it a second time,
+        while the import writes to the database.
+        Returns a future of the messages, or None if the validation is disabled
+        or the file can't be opened again.
+        """
+        if not getattr(settings, 'IMPORT_VALIDATE_XML', True) or not self.report:
+            return None
+        fh = self.open_again()
+        if fh is None:
+            return None
+
+        def validate():
+            with fh:
                 try:
-                    xmlschema = etree.XMLSchema(schema_root)
-                    xmlschema.assertValid(self.root)
-                except (
-                    AttributeError,
-                    etree.DocumentInvalid,
-                    etree.XMLSyntaxError,
-                ) as e:
-                    if self.report:
-                        self.report.append("Document didn't validate. %s, %s" % (e.args[0], OWN_RISK))
-        else:
-            if self.report:
-                self.report.append("Document Schema %s is not in the accepted escriptiium list. Valid schemas are: %s, %s" %
-                                   (self.schema_location, self.ACCEPTED_SCHEMAS, OWN_RISK))
+                    return self.validate_schema(fh)
+                except Exception as e:
+                    # never fails the import
+                    logger.exception(e)
+                    return ["Document couldn't be validated. %s, %s" % (e, OWN_RISK)]
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(validate)
+        executor.shutdown(wait=False)
+        return future
+
+    @cached_property
+    def valid_block_types(self):
+        return {t.name: t for t in self.document.valid_block_types.all()}
+
+    @cached_property
+    def valid_line_types(self):
+        return {t.name: t for t in self.document.valid_line_types.all()}
 
     def get_filename(self, pageTag):
         raise NotImplementedError
 
     def get_pages(self):
-        raise NotImplementedError
+        if self.context is None:
+            # the file was already read, by the validation for example
+            self.file.seek(0)
+            self.root, self.context = read_header(self.file)
+        context, self.context = self.context, None
+        try:
+            yield from self.iter_pages(context)
+        except etree.XMLSyntaxError as e:
+            raise ParseError("Invalid XML. %s" % e.msg)
 
     def get_blocks(self, pageTag):
         raise NotImplementedError
@@ -276,36 +502,165 @@ class XMLParser(ParserDocument):
     def update_line(self, line, lineTag):
         raise NotImplementedError
 
-    def make_transcription(self, line, lineTag, content, user=None):
-        try:
-            # lazily creates the Transcription on the fly if need be cf transcription() property
-            lt = LineTranscription.objects.get(
-                transcription=self.transcription, line=line
-            )
-        except LineTranscription.DoesNotExist:
-            lt = LineTranscription(
-                version_source="import",
-                version_author=user and user.username or "",
-                transcription=self.transcription,
-                line=line,
-            )
-        else:
-            try:
-                lt.new_version(author=user and user.username,
-                               source='import')  # save current content in history
-            except NoChangeException:
-                pass
-        finally:
+    def make_transcriptions(self, part, contents, user=None):
+        """
+        contents: a list of (line, content) tuples.
+        Creates or updates (storing the current content in history)
+        the LineTranscriptions of the lines in bulk.
+        """
+        if not contents:
+            return
+
+        # lazily creates the Transcription on the fly if need be cf transcription() property
+        existing = {lt.line_id: lt for lt in LineTranscription.objects.filter(
+            transcription=self.transcription, line__document_part=part)}
+        to_create, to_update = {}, {}
+        now = timezone.now()
+        for line, content in contents:
+            lt = existing.get(line.pk)
+            if lt is None:
+                lt = LineTranscription(
+                    version_source="import",
+                    version_author=user and user.username or "",
+                    transcription=self.transcription,
+                    line=line,
+                )
+                existing[line.pk] = lt
+                to_create[line.pk] = lt
+            elif line.pk not in to_create:
+                if lt.content == content and line.pk not in to_update:
+                    # unchanged, neither a new version nor an update
+                    continue
+                try:
+                    lt.new_version(author=user and user.username,
+                                   source='import')  # save current content in history
+                except NoChangeException:
+                    pass
+                lt.version_updated_at = now  # bulk_update bypasses auto_now
+                to_update[line.pk] = lt
             lt.content = content
-            lt.save()
+
+        LineTranscription.objects.bulk_create(to_create.values())
+        LineTranscription.objects.bulk_update(to_update.values(), [
+            'content', 'versions', 'revision', 'version_author', 'version_source',
+            'version_created_at', 'version_updated_at'])
+
+    def parse_page(self, part, pageTag, user=None):
+        """
+        Creates or updates the blocks, lines and transcriptions of a page.
+        Existing blocks and lines are matched by external_id from a single query each,
+        everything is validated in memory and written with a few bulk queries.
+        Returns the number of blocks and lines of the page.
+        """
+        existing_blocks = list(part.blocks.all())
+        blocks_by_id = {b.external_id: b for b in existing_blocks if b.external_id}
+        block_order = max((b.order for b in existing_blocks), default=-1)
+        existing_lines = list(part.lines.all())
+        lines_by_id = {l.external_id: l for l in existing_lines if l.external_id}
+        line_order = max((l.order for l in existing_lines), default=-1)
+
+        blocks = self.get_blocks(pageTag)
+        new_blocks, updated_blocks = {}, {}
+        parsed_blocks = []
+        for block_id, blockTag in blocks:
+            if block_id and not block_id.startswith("eSc_dummyblock_"):
+                block = blocks_by_id.get(block_id)
+                if block is None:
+                    # not found, create it then
+                    block = Block(document_part=part, external_id=block_id)
+                    blocks_by_id[block_id] = block
+                try:
+                    self.update_block(block, blockTag)
+                except TypeError:
+                    block = None
+                else:
+                    try:
+                        # foreign keys are known to be valid, don't query them
+                        block.full_clean(exclude=['document_part', 'typology'])
+                    except ValidationError as e:
+                        if self.report:
+                            self.report.append(
+                                _("Block in '{filen}' line N°{line} was skipped because: {error}").format(
+                                    filen=self.file.name, line=blockTag.sourceline, error=e))
+                        if block.pk is None:
+                            block = None
+                    else:
+                        if block.pk is None:
+                            if id(block) not in new_blocks:
+                                block_order += 1
+                                block.order = block_order
+                                new_blocks[id(block)] = block
+                        else:
+                            updated_blocks[id(block)] = block
+            else:
+                block = None
+            parsed_blocks.append((block, blockTag))
+
+        Block.objects.bulk_create(new_blocks.values())
+        Block.objects.bulk_update(updated_blocks.values(), ['box', 'typology'])
+
+        n_lines = 0
+        new_lines, updated_lines = {}, {}
+        contents = []
+        for block, blockTag in parsed_blocks:
+            lines = self.get_lines(blockTag)
+            n_lines += len(lines)
+
+            for line_id, lineTag in lines:
+                line = line_id and lines_by_id.get(line_id) or None
+                if line is None:
+                    # not found, create it then
+                    line = Line(document_part=part, block=block, external_id=line_id)
+                    if line_id:
+                        lines_by_id[line_id] = line
+
+                self.update_line(line, lineTag)
+                try:
+                    line.full_clean(exclude=['document_part', 'block', 'typology'])
+                except ValidationError as e:
+                    if self.report:
+                        self.report.append(
+                            _("Line in '{filen}' line N°{line} (id: {lineid}) was skipped because: {error}")
+                            .format(filen=self.file.name,
+                                    line=blockTag.sourceline,
+                                    lineid=line_id,
+                                    error=e))
+                    if line.pk is None and id(line) not in new_lines:
+                        # can't attach a transcription to it
+                        continue
+                else:
+                    if line.pk is None:
+                        if id(line) not in new_lines:
+                            if line.external_id is None:
+                                line.make_external_id()
+                            line_order += 1
+                            line.order = line_order
+                            new_lines[id(line)] = line
+                    else:
+                        updated_lines[id(line)] = line
+
+                tc = self.get_transcription_content(lineTag)
+                if tc:
+                    contents.append((line, tc))
+
+        Line.objects.bulk_create(new_lines.values())
+        Line.objects.bulk_update(updated_lines.values(), ['baseline', 'mask', 'typology'])
+
+        # needs to be done after lines are created!
+        self.make_transcriptions(part, contents, user=user)
+        return len(blocks), n_lines
 
     def parse(self, start_at=0, override=False, user=None):
-        pages = self.get_pages()
-        n_pages = len(pages)
+        validation = self.start_validation()
+        n_pages = 0
         n_blocks = 0
         n_lines = 0
 
-        for pageTag in pages:
+        for index, pageTag in enumerate(self.get_pages()):
+            n_pages += 1
+            if index < start_at:
+                # imported before the import was interrupted
+                continue
             # find the filename to match with existing images
             filename = self.get_filename(pageTag)
             try:
@@ -327,73 +682,21 @@ class XMLParser(ParserDocument):
                         part.lines.all().delete()
                         part.blocks.all().delete()
 
-                    blocks = self.get_blocks(pageTag)
-                    n_blocks += len(blocks)
-
-                    for block_id, blockTag in blocks:
-                        if block_id and not block_id.startswith("eSc_dummyblock_"):
-                            try:
-                                block = Block.objects.get(document_part=part, external_id=block_id)
-                            except Block.DoesNotExist:
-                                # not found, create it then
-                                block = Block(document_part=part, external_id=block_id)
-                            try:
-                                self.update_block(block, blockTag)
-                            except TypeError:
-                                block = None
-                            else:
-                                try:
-                                    block.full_clean()
-                                except ValidationError as e:
-                                    if self.report:
-                                        self.report.append(
-                                            _("Block in '{filen}' line N°{line} was skipped because: {error}").format(
-                                                filen=self.file.name, line=blockTag.sourceline, error=e))
-                                else:
-                                    block.save()
-                        else:
-                            block = None
-                    
-                        lines = self.get_lines(blockTag)
-                        n_lines += len(lines)
-
-                        for line_id, lineTag in lines:
-                            if line_id:
-                                try:
-                                    line = Line.objects.get(document_part=part, external_id=line_id)
-                                except Line.DoesNotExist:
-                                    line = None
-                            else:
-                                line = None
-
-                            if line is None:
-                                # not found, create it then
-                                line = Line(document_part=part, block=block, external_id=line_id)
-
-                            self.update_line(line, lineTag)
-                            try:
-                                line.full_clean()
-                            except ValidationError as e:
-                                if self.report:
-                                    self.report.append(
-                                        _("Line in '{filen}' line N°{line} (id: {lineid}) was skipped because: {error}")
-                                        .format(filen=self.file.name,
-                                                line=blockTag.sourceline,
-                                                lineid=line_id,
-                                                error=e))
-                            else:
-                                line.save()
-
-                            # needs to be done after line is created!
-                            tc = self.get_transcription_content(lineTag)
-                            if tc:
-                                self.make_transcription(line, lineTag, tc, user=user)
+                    page_blocks, page_lines = self.parse_page(part, pageTag, user=user)
+                    n_blocks += page_blocks
+                    n_lines += page_lines
+                    # the geometry changed, its cached exports are stale
+                    part.touch()
 
                 # TODO: store glyphs too
                 logger.info("Uncompressed and parsed %s (%i page(s), %i block(s), %i line(s))" % (self.file.name, n_pages, n_blocks, n_lines))
                 part.calculate_progress()
                 yield part
 
+        if validation:
+            for message in validation.result():
+                self.report.append(message)
+
 
 class AltoParser(XMLParser):
     DEFAULT_NAME = _("Default ALTO Import")
@@ -412,6 +715,12 @@ class AltoParser(XMLParser):
         # An alto file always describes 1 'document part'
         return 1
 
+    @cached_property
+    def tags(self):
+        # ID -> LABEL of the Tags, referenced by the TAGREFS of the blocks and lines
+        return {tag.get("ID"): tag.get("LABEL")
+                for tag in self.root.iterfind("Tags/*", self.root.nsmap)}
+
     def get_filename(self, pageTag):
         try:
             filename = self.root.find(
@@ -424,9 +733,6 @@ The ALTO file should contain a Description/sourceImageInformation/fileName tag f
         else:
             return filename
 
-    def get_pages(self):
-        return self.root.findall("Layout/Page", self.root.nsmap)
-
     def get_blocks(self, pageTag):
         return [
             (b.get("ID"), b)
@@ -453,15 +759,14 @@ The ALTO file should contain a Description/sourceImageInformation/fileName tag f
 
         try:
             tag = blockTag.get("TAGREFS").split(" ")[0]
-            type_ = self.root.find("./Tags/*[@ID='"+tag+"']", self.root.nsmap).get("LABEL")
+            type_ = self.tags.get(tag)
         except (IndexError, AttributeError):
             # Index to catch empty tagrefs, Attribute to catch no tagrefs or invalid
             type_ = None
 
         if type_:
-            valid_types_mapping = {t.name: t for t in self.document.valid_block_types.all()}
-            if type_ in valid_types_mapping.keys():
-                block.typology = valid_types_mapping[type_]
+            if type_ in self.valid_block_types:
+                block.typology = self.valid_block_types[type_]
             else:
                 # raise warning discard type
                 pass
@@ -513,14 +818,13 @@ The ALTO file should contain a Description/sourceImageInformation/fileName tag f
 
         try:
             tag = lineTag.get("TAGREFS").split(" ")[0]
-            type_ = self.root.find("./Tags/*[@ID='"+tag+"']", self.root.nsmap).get("LABEL")
+            type_ = self.tags.get(tag)
         except (IndexError, AttributeError):
             type_ = None
 
         if type_:
-            valid_types_mapping = {t.name: t for t in self.document.valid_line_types.all()}
-            if type_ in valid_types_mapping.keys():
-                line.typology = valid_types_mapping[type_]
+            if type_ in self.valid_line_types:
+                line.typology = self.valid_line_types[type_]
             else:
                 # raise warning discard type
                 pass
@@ -541,12 +845,13 @@ class PagexmlParser(XMLParser):
         "http://schema.primaresearch.org/PAGE/gts/pagecontent/2013-07-15/pagecontent.xsd",
     )
 
-    @property
+    @cached_property
     def total(self):
-        # PAGE file can contain multiple parts
-        if not self.root:
-            self.root = etree.parse(self.file).getroot()
-        return len(self.root.findall("Page", self.root.nsmap))
+        # PAGE file can contain multiple parts, counts them without keeping them in memory
+        try:
+            return sum(1 for page in self.iter_pages(self.restart()))
+        except etree.XMLSyntaxError as e:
+            raise ParseError("Invalid XML. %s" % e.msg)
 
     def get_filename(self, pageTag):
         try:
@@ -558,9 +863,6 @@ The PAGE file should contain an attribute imageFilename in Page tag for matching
         else:
             return filename
 
-    def get_pages(self):
-        return self.root.findall("Page", self.root.nsmap)
-
     def get_blocks(self, pageTag):
         return [
             (b.get("id"), b) for b in pageTag.findall("TextRegion", self.root.nsmap)
@@ -583,9 +885,8 @@ The PAGE file should contain an attribute imageFilename in Page tag for matching
                     type_ = match.groups()[0]
 
         if type_:
-            valid_types_mapping = {t.name: t for t in self.document.valid_block_types.all()}
-            if type_ in valid_types_mapping.keys():
-                block.typology = valid_types_mapping[type_]
+            if type_ in self.valid_block_types:
+                block.typology = self.valid_block_types[type_]
             else:
                 # raise warning discard type
                 pass
@@ -614,9 +915,8 @@ The PAGE file should contain an attribute imageFilename in Page tag for matching
                     type_ = match.groups()[0]
 
         if type_:
-            valid_types_mapping = {t.name: t for t in self.document.valid_line_types.all()}
-            if type_ in valid_types_mapping.keys():
-                line.typology = valid_types_mapping[type_]
+            if type_ in self.valid_line_types:
+                line.typology = self.valid_line_types[type_]
             else:
                 # raise warning discard type
                 pass
@@ -675,45 +975,6 @@ class IIIFManifestParser(ParserDocument):
     def total(self):
         return len(self.canvases)
 
-    @staticmethod
-    def get_image(url: str, retry_limit: int=4) -> requests.Response:
-        """Retrieve a iiif image from a iiif server
-
-        This method will retry on certain 5XX errors that are likely to
-        be transient.  It will only retry a fixed number of times (default 10),
-        and it backs off a little more on each retry. Failure to retrieve
-        the image within the retry limit will result in a DownloadError
-        being raised. All other unsuccessful requests will raise a
-        DownloadError as well.
-        """
-
-        current_retry = 0
-        while current_retry < retry_limit:
-            time.sleep(0.1 * current_retry)  # avoid being throttled; add a little backoff
-            try:
-                r = requests.get(url, stream=True, verify=False, timeout=5)
-                r.raise_for_status()
-                return r
-
-            except requests.exceptions.HTTPError as http_error:
-                # retry on transient 5XX errors, but keep a record of the retry count
-                if http_error.response.status_code in [500, 502, 503, 504, 507, 508]:
-                    current_retry = current_retry + 1
-                    continue
-
-                # We probably got a 4XX error, but whatever it is just raise it
-                raise DownloadError(http_error)
-
-            except requests.exceptions.ConnectionError as connection_error:
-                raise DownloadError(connection_error)
-
-            except requests.exceptions.Timeout as timeout_error:
-                raise DownloadError(timeout_error)
-
-        # Max retries has been exceeded
-        raise DownloadError(f"After {current_retry + 1} tries, the server still errors out loading"
-            f": {url}")
-
     def parse(self, start_at=0, override=False, user=None):
         try:
             for metadata in self.manifest["metadata"]:
@@ -727,20 +988,13 @@ class IIIFManifestParser(ParserDocument):
             pass
 
         total = len(self.canvases)
+        images = []
         for i, canvas in enumerate(self.canvases):
             if i < start_at:
                 continue
 
-            # If quotas are enforced, assert that the user still has free disk storage
-            if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
-                raise DiskQuotaReachedError(
-                    _(f"You ran out of disk storage. {total - i} canvases were left to import (over {total - start_at})")
-                )
-
             try:
                 resource = canvas["images"][0]["resource"]
-                url = resource["@id"]
-                base_url = urlparse(url).hostname
                 uri_template = "{image}/{region}/{size}/{rotation}/{quality}.{format}"
                 url = uri_template.format(
                     image=resource["service"]["@id"],
@@ -752,28 +1006,145 @@ class IIIFManifestParser(ParserDocument):
                 )  # we could gain some time by fetching png, but it's not implemented everywhere.
                 # TODO, we should probably grab the iiif image manifest, it will tell
                 # us important things about the supported file types and the available sizing.
-                r = self.get_image(url)
-
-                part = DocumentPart(document=self.document, source=url)
-                if "label" in resource:
-                    part.name = resource["label"]
+            except (KeyError, IndexError) as e:
+                if self.report:
+                    self.report.append(_('Error while fetching {filename}: {error}').format(
+                        filename=i, error=e))
+            else:
                 # iiif file names are always default.jpg or close to
                 name = "%d_%s_%s" % (i, uuid.uuid4().hex[:5], url.split("/")[-1])
-                part.original_filename = name
-                part.image_file_size = 0
-                part.image.save(name, ContentFile(r.content), save=False)
-                part.image_file_size = part.image.size
-                part.save()
-                yield part
-                time.sleep(0.1)  # avoid being throttled
-            except (KeyError, IndexError, DownloadError) as e:
+                images.append((i, resource, url, name))
+
+        # the images are downloaded ahead in the background but the parts are created in order
+        fetcher = ImageFetcher()
+        downloads = fetcher.fetch_all([url for i, resource, url, name in images])
+        for (i, resource, url, name), image in zip(images, downloads):
+            if isinstance(image, DownloadError):
                 if self.report:
                     self.report.append(_('Error while fetching {filename}: {error}').format(
-                        filename=name, error=e))
-                if isinstance(e, DownloadError):
-                    error_msg = f"Could not download image: {url}"
+                        filename=name, error=image))
+                error_msg = f"Could not download image: {url}"
+                if user:
                     user.notify(error_msg)
+                if self.report:
                     self.report.append(error_msg)
+                continue
+
+            try:
+                # If quotas are enforced, assert that the user still has free disk storage
+                if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
+                    raise DiskQuotaReachedError(
+                        _(f"You ran out of disk storage. {total - i} canvases were left to import (over {total - start_at})")
+                    )
+
+                part = DocumentPart(document=self.document, source=url)
+                if "label" in resource:
+                    part.name = resource["label"]
+                part.original_filename = name
+                # moves the downloaded file to the storage instead of copying it
+                part.store_image(name, image, image.sha256)
+                part.save()
+            finally:
+                image.close()
+            yield part
+
+
+class ImageFetcher:
+    """
+    Downloads images over a pool of keep-alive connections
+    with a bounded number of simultaneous requests to the same host.
+
+    Transient server errors are retried after waiting for the delay asked by
+    the server (Retry-After) or an exponential backoff, the responses are streamed
+    to temporary files which can be moved to the storage.
+    """
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504, 507, 508)
+    CHUNK_SIZE = 64 * 1024
+    MAX_DELAY = 60
+
+    def __init__(self, concurrency=None, retry_limit=4, backoff=0.5, timeout=5):
+        self.concurrency = concurrency or settings.IIIF_IMPORT_CONCURRENCY
+        self.retry_limit = retry_limit
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.concurrency)
+            return self.hosts[host]
+
+    def retry_delay(self, retry, response):
+        try:
+            delay = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            # no delay or a http date
+            delay = self.backoff * 2 ** retry
+        return min(delay, self.MAX_DELAY)
+
+    def fetch(self, url):
+        """
+        Retrieves the image at url in a temporary file,
+        failing to do so within the retry limit raises a DownloadError.
+        """
+        # the host slot is kept while waiting to retry to not hammer a struggling server
+        with self.host_semaphore(url):
+            for retry in range(self.retry_limit):
+                try:
+                    with self.session.get(url, stream=True, timeout=self.timeout) as r:
+                        r.raise_for_status()
+                        fh = TemporaryUploadedFile(url.split("/")[-1],
+                                                   r.headers.get('Content-Type'), 0, None)
+                        sha256 = hashlib.sha256()
+                        try:
+                            for chunk in r.iter_content(chunk_size=self.CHUNK_SIZE):
+                                fh.write(chunk)
+                                sha256.update(chunk)
+                        except requests.exceptions.RequestException:
+                            fh.close()
+                            raise
+                        fh.size = fh.tell()
+                        fh.sha256 = sha256.hexdigest()
+                        fh.seek(0)
+                        return fh
+
+                except requests.exceptions.HTTPError as http_error:
+                    # retry on transient errors
+                    if http_error.response.status_code in self.RETRY_STATUS_CODES:
+                        time.sleep(self.retry_delay(retry, http_error.response))
+                        continue
+
+                    # We probably got a 4XX error, but whatever it is just raise it
+                    raise DownloadError(http_error)
+
+                except requests.exceptions.RequestException as error:
+                    raise DownloadError(error)
+
+        # Max retries has been exceeded
+        raise DownloadError(f"After {self.retry_limit} tries, the server still errors out loading"
+                            f": {url}")
+
+    def fetch_all(self, urls):
+        """
+        Yields the temporary file of each url, or the DownloadError raised while fetching it,
+        in the order of urls. Up to twice the concurrency of images are downloaded ahead.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for url, future in map_ahead(executor, self.fetch, urls, self.concurrency * 2):
+                try:
+                    yield future.result()
+                except DownloadError as e:
+                    yield e
 
 
 class TranskribusPageXmlParser(PagexmlParser):
@@ -795,14 +1166,13 @@ class TranskribusPageXmlParser(PagexmlParser):
             ]
 
 
-def make_parser(document, file_handler, name=None, report=None, zip_allowed=True, pdf_allowed=True):
+def make_parser(document, file_handler, name=None, report=None, zip_allowed=True, pdf_allowed=True,
+                reopen=None):
     # TODO: not great to rely on file name extension
     ext = os.path.splitext(file_handler.name)[1][1:]
     if ext in XML_EXTENSIONS:
-        try:
-            root = etree.parse(file_handler).getroot()
-        except etree.XMLSyntaxError as e:
-            raise ParseError(e.msg)
+        # only reads the header, the pages are parsed one by one afterwards
+        root, context = read_header(file_handler)
         try:
             schema = root.nsmap[None]
         except KeyError:
@@ -813,16 +1183,20 @@ def make_parser(document, file_handler, name=None, report=None, zip_allowed=True
         #     return AbbyyParser(root, name=name)
         if "alto" in schema:
             return AltoParser(
-                document, file_handler, report, transcription_name=name, xml_root=root
+                document, file_handler, report, transcription_name=name,
+                xml_root=root, context=context, reopen=reopen
             )
         elif "PAGE" in schema:
+            # Transkribus flags its exports in the metadata, the header is enough
             if b"Transkribus" in etree.tostring(root):
                 return TranskribusPageXmlParser(
-                    document, file_handler, report, transcription_name=name, xml_root=root
+                    document, file_handler, report, transcription_name=name,
+                    xml_root=root, context=context, reopen=reopen
                 )
             else:
                 return PagexmlParser(
-                    document, file_handler, report, transcription_name=name, xml_root=root
+                    document, file_handler, report, transcription_name=name,
+                    xml_root=root, context=context, reopen=reopen
                 )
 
         else:
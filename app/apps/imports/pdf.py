@@ -0,0 +1,91 @@
+"""
+Rendering of the pages of a PDF file to PNG files, in a pool of processes.
+
+The workers are spawned rather than forked, libvips doesn't survive a fork
+once it has been used in the parent process, they only import this module.
+"""
+import hashlib
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import pyvips
+
+DPI = 300
+
+
+class RenderError(Exception):
+    pass
+
+
+def count_pages(path):
+    try:
+        page = pyvips.Image.pdfload(path, access='sequential')
+    except pyvips.error.Error as e:
+        raise RenderError(e.message)
+    if 'n-pages' in page.get_fields():
+        return page.get('n-pages')
+    return 0
+
+
+def file_sha256(path, chunk_size=64 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def render_page(path, page_nb, dest, dpi=DPI):
+    """
+    Renders the page page_nb (starting at 0) of the pdf at path to the png file dest,
+    returns the sha256 of the png, computed while it is still in the page cache.
+    """
+    try:
+        page = pyvips.Image.pdfload(path, page=page_nb, dpi=dpi, access='sequential')
+        page.pngsave(dest)
+    except pyvips.error.Error as e:
+        if os.path.exists(dest):
+            os.remove(dest)
+        # pyvips errors don't survive pickling
+        raise RenderError(e.message)
+    return file_sha256(dest)
+
+
+def make_executor(processes):
+    if processes < 2:
+        return None
+    # # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
+    multiprocessing.current_process().daemon = False
+    return ProcessPoolExecutor(max_workers=processes,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def render_pages(path, pages, executor=None, ahead=1):
+    """
+    pages: an iterable of (page_nb, dest) tuples.
+    Yields (page_nb, dest, sha256) in the same order once the page is rendered to dest,
+    up to ahead pages being rendered in advance by the executor.
+    The files of the pages rendered in advance but not consumed are deleted.
+    """
+    pages = iter(pages)
+    if executor is None:
+        for page_nb, dest in pages:
+            yield page_nb, dest, render_page(path, page_nb, dest)
+        return
+
+    futures = deque((page, executor.submit(render_page, path, *page))
+                    for page in islice(pages, ahead))
+    try:
+        while futures:
+            page, future = futures.popleft()
+            for next_page in pages:
+                futures.append((next_page, executor.submit(render_page, path, *next_page)))
+                break
+            yield page + (future.result(),)
+    finally:
+        for (page_nb, dest), future in futures:
+            if not future.cancel() and future.exception() is None:
+                os.remove(dest)
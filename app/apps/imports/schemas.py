@@ -0,0 +1,100 @@
+"""
+Cache of the XML schemas the imported ALTO and PAGE files are validated against.
+
+A schema is compiled once per process and reused for all the files.
+Its source is read from the copy bundled with the app or cached on disk (XSD_CACHE_DIR),
+it is only fetched from the network, then cached, the first time it is needed.
+The schemas it imports (xlink...) go through the same cache.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+BUNDLED_SCHEMAS = {
+    "https://gitlab.inria.fr/scripta/escriptorium/-/raw/develop/app/escriptorium/static/alto-4-1-baselines.xsd":
+    os.path.join(settings.BASE_DIR, 'escriptorium', 'static', 'alto-4-1-baselines.xsd'),
+}
+
+_compiled = {}
+_lock = threading.Lock()
+
+
+class SchemaUnavailable(Exception):
+    pass
+
+
+def cache_path(location):
+    digest = hashlib.sha1(location.encode()).hexdigest()[:16]
+    return os.path.join(settings.XSD_CACHE_DIR,
+                        '%s_%s' % (digest, os.path.basename(urlparse(location).path)))
+
+
+def fetch(location):
+    try:
+        response = requests.get(location, timeout=10)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        raise SchemaUnavailable(e)
+
+    path = cache_path(location)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # other processes may be reading it
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as fh:
+            fh.write(response.content)
+        os.replace(fh.name, path)
+    except OSError as e:
+        logger.warning("Couldn't cache the schema %s: %s", location, e)
+    return response.content
+
+
+def load(location):
+    path = BUNDLED_SCHEMAS.get(location) or cache_path(location)
+    try:
+        with open(path, 'rb') as fh:
+            return fh.read()
+    except OSError:
+        return fetch(location)
+
+
+class CacheResolver(etree.Resolver):
+    """Goes through the cache for the schemas imported by a schema too (xlink...)."""
+
+    def resolve(self, url, pubid, context):
+        if urlparse(url).scheme in ('http', 'https'):
+            try:
+                return self.resolve_string(load(url), context, base_url=url)
+            except SchemaUnavailable:
+                pass
+        # lets libxml2 try by itself
+        return None
+
+
+def get_schema(location):
+    """
+    Returns the compiled etree.XMLSchema of location,
+    raises SchemaUnavailable if it can't be found or compiled.
+    """
+    with _lock:
+        if location not in _compiled:
+            # the base url resolves the relative imports of the schema as if it was fetched
+            parser = etree.XMLParser()
+            parser.resolvers.add(CacheResolver())
+            try:
+                _compiled[location] = etree.XMLSchema(
+                    etree.XML(load(location), parser, base_url=location))
+            except (etree.XMLSyntaxError, etree.XMLSchemaParseError) as e:
+                path = cache_path(location)
+                if os.path.exists(path):
+                    os.remove(path)
+                raise SchemaUnavailable(e)
+        return _compiled[location]
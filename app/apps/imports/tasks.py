@@ -1,18 +1,15 @@
-from datetime import datetime
 import logging
 import os.path
-from zipfile import ZipFile
 
 from django.apps import apps
 from django.conf import settings
-from django.db.models import Q, Prefetch, Avg
-from django.template import loader
-from django.utils.text import slugify
+from django.db.models import Q
 from django.utils.translation import gettext as _
 
 from celery import shared_task
 
-from core.models import Line
+from imports import export
+from imports.export import ALTO_FORMAT, PAGEXML_FORMAT, TEXT_FORMAT
 from users.consumers import send_event
 from escriptorium.utils import send_email
 
@@ -47,12 +44,20 @@ def document_import(task, import_pk=None, resume=True, task_id=None, user_pk=Non
             "id": imp.document.pk
         })
 
-        for obj in imp.process(resume=resume):
+        def send_progress():
             send_event('document', imp.document.pk, "import:progress", {
                 "id": imp.document.pk,
                 "progress": imp.processed,
                 "total": imp.total
             })
+
+        for obj in imp.process(resume=resume):
+            # the progress is sent as often as it is saved
+            if imp.progress_saved:
+                send_progress()
+        if not imp.progress_saved:
+            # the last objects were imported after the last checkpoint
+            send_progress()
     except Exception as e:
         if user:
             user.notify(_("Something went wrong during the import!"),
@@ -81,15 +86,9 @@ def document_import(task, import_pk=None, resume=True, task_id=None, user_pk=Non
 def document_export(task, file_format, part_pks,
                     transcription_pk, region_types, document_pk=None, include_images=False,
                     user_pk=None, report_label=None):
-    ALTO_FORMAT = "alto"
-    PAGEXML_FORMAT = "pagexml"
-    TEXT_FORMAT = "text"
-
     User = apps.get_model('users', 'User')
     Document = apps.get_model('core', 'Document')
-    DocumentPart = apps.get_model('core', 'DocumentPart')
     Transcription = apps.get_model('core', 'Transcription')
-    LineTranscription = apps.get_model('core', 'LineTranscription')
     TaskReport = apps.get_model('reporting', 'TaskReport')
 
     user = User.objects.get(pk=user_pk)
@@ -106,94 +105,28 @@ def document_export(task, file_format, part_pks,
             "id": document.pk
         })
 
-        # Check if we have to include orphan lines
-        include_orphans = False
-        if 'Orphan' in region_types:
-            include_orphans = True
-            region_types.remove('Orphan')
-
-        # Check if we have to include lines with an undefined region type
-        include_undefined = False
-        if 'Undefined' in region_types:
-            include_undefined = True
-            region_types.remove('Undefined')
+        # Check if we have to include orphan lines or lines with an undefined region type
+        region_types, include_orphans, include_undefined = export.split_region_types(region_types)
 
         transcription = Transcription.objects.get(document=document, pk=transcription_pk)
 
-        base_filename = "export_doc%d_%s_%s_%s" % (
-            document.pk,
-            slugify(document.name).replace('-', '_')[:32],
-            file_format,
-            datetime.now().strftime('%Y%m%d%H%M'))
+        base_filename = export.base_filename(document, file_format)
 
         if file_format == TEXT_FORMAT:
             filename = "%s.txt" % base_filename
             filepath = os.path.join(user.get_document_store_path(), filename)
-            # content_type = 'text/plain'
-
-            region_filters = Q(line__block__typology_id__in=region_types)
-            if include_orphans:
-                region_filters |= Q(line__block__isnull=True)
-            if include_undefined:
-                region_filters |= Q(line__block__isnull=False, line__block__typology_id__isnull=True)
-
-            lines = (LineTranscription.objects
-                     .filter(transcription=transcription, line__document_part__pk__in=part_pks)
-                     .filter(region_filters)
-                     .exclude(content="")
-                     .order_by('line__document_part', 'line__document_part__order', 'line__order'))
-            # return StreamingHttpResponse(['%s\n' % line.content for line in lines],
-            #                              content_type=content_type)
-            with open(filepath, 'w') as fh:
-                fh.writelines(['%s\n' % line.content for line in lines])
-                fh.close()
+            export.write_text(filepath, transcription, part_pks, region_types,
+                              include_orphans=include_orphans,
+                              include_undefined=include_undefined)
 
         elif file_format == ALTO_FORMAT or file_format == PAGEXML_FORMAT:
             filename = "%s.zip" % base_filename
             filepath = os.path.join(user.get_document_store_path(), filename)
-            # buff = io.BytesIO()
-            if file_format == ALTO_FORMAT:
-                tplt = loader.get_template('export/alto.xml')
-            elif file_format == PAGEXML_FORMAT:
-                tplt = loader.get_template('export/pagexml.xml')
-            parts = DocumentPart.objects.filter(document=document, pk__in=part_pks)
-
-            region_filters = Q(typology_id__in=region_types)
-            if include_undefined:
-                region_filters |= Q(typology_id__isnull=True)
-
-            with ZipFile(filepath, 'w') as zip_:
-                for part in parts:
-                    render_orphans = {} if not include_orphans else {
-                        'orphan_lines': part.lines.prefetch_transcription(transcription).filter(block=None)
-                    }
-
-                    if include_images:
-                        # Note adds image before the xml file
-                        zip_.write(part.image.path, part.filename)
-                    try:
-                        page = tplt.render({
-                            'valid_block_types': document.valid_block_types.all(),
-                            'valid_line_types': document.valid_line_types.all(),
-                            'part': part,
-                            'blocks': (part.blocks.filter(region_filters)
-                                       .annotate(avglo=Avg('lines__order'))
-                                       .order_by('avglo')
-                                       .prefetch_related(
-                                           Prefetch(
-                                               'lines',
-                                               queryset=Line.objects.prefetch_transcription(
-                                                   transcription)))),
-                            **render_orphans
-                        })
-                    except Exception as e:
-                        report.append("Skipped {element}({image}) because '{reason}'.".format(
-                            element=part.name, image=part.filename, reason=str(e)
-                        ))
-                    else:
-                        zip_.writestr('%s.xml' % os.path.splitext(part.filename)[0], page)
-
-                zip_.close()
+            export.write_xml(filepath, file_format, document, part_pks, transcription, region_types,
+                             include_orphans=include_orphans,
+                             include_undefined=include_undefined,
+                             include_images=include_images,
+                             report=report)
 
     except Exception as e:
         if user:
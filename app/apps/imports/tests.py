@@ -1,15 +1,32 @@
 import json
 import os.path
-from unittest import mock
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from io import BytesIO
+from unittest import mock, skipIf
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
+import pyvips
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
+from django.template import loader
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
+from lxml import etree
+from PIL import Image
 
+from imports import export, schemas
 from imports.models import DocumentImport
-from imports.parsers import AltoParser, IIIFManifestParser
+from imports.parsers import (AltoParser, IIIFManifestParser, ImageFetcher, DownloadError,
+                             ParseError, make_parser)
+from reporting.models import TaskReport
 from core.models import Block, Line, Transcription, LineTranscription, BlockType, LineType
 from core.tests.factory import CoreFactoryTestCase
 
@@ -18,6 +35,82 @@ from core.tests.factory import CoreFactoryTestCase
 from reporting.tasks import end_task_reporting, start_task_reporting
 
 
+def canonical_xml(content):
+    """To compare xml documents regardless of their indentation and of when they were made."""
+    root = etree.fromstring(content)
+    for el in root.iter():
+        el.text = el.text and el.text.strip() or None
+        el.tail = None
+        if etree.QName(el).localname in ('Created', 'LastChange'):
+            el.text = None
+        # the templates refer to an undefined tag for blocks without type
+        if el.get('TAGREFS') == 'BT':
+            del el.attrib['TAGREFS']
+    return etree.tostring(root, method='c14n')
+
+
+class StandInIIIFServer(ThreadingMixIn, HTTPServer):
+    """
+    A local stand in for a IIIF image server,
+    '/unavailable/<n>/...' answers 503 to the first n requests
+    and '/missing/...' answers 404, anything else answers content (or the path).
+    """
+    daemon_threads = True
+
+    def __init__(self, content=None, delay=0):
+        super().__init__(('127.0.0.1', 0), StandInIIIFHandler)
+        self.content = content
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.hits = Counter()
+        self.active = 0
+        self.max_active = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInIIIFHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits[self.path] += 1
+            hits = server.hits[self.path]
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            parts = self.path.split('/')
+            if parts[1] == 'unavailable' and hits <= int(parts[2]):
+                self.send_response(503)
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+            elif parts[1] == 'missing':
+                self.send_error(404)
+            else:
+                body = server.content or self.path.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
 class XmlImportTestCase(CoreFactoryTestCase):
     def setUp(self):
         super().setUp()
@@ -74,7 +167,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_single.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(58):
+            with self.assertNumQueries(38):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -98,7 +191,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_single_baselines.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(44):
+            with self.assertNumQueries(38):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -122,7 +215,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test.zip'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(76):
+            with self.assertNumQueries(50):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -147,7 +240,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_composedblock.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(70):
+            with self.assertNumQueries(40):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -184,6 +277,89 @@ class XmlImportTestCase(CoreFactoryTestCase):
         imp.refresh_from_db()
         self.assertEqual(imp.workflow_state, imp.WORKFLOW_STATE_DONE)
 
+    @override_settings(IMPORT_PROGRESS_EVERY=2, IMPORT_PROGRESS_INTERVAL=3600)
+    def test_progress(self):
+        filename = 'test_pagexml.zip'
+        mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
+        with open(mock_path, 'rb') as fh:
+            imp = DocumentImport.objects.create(
+                document=self.document,
+                started_by=self.document.owner,
+                import_file=SimpleUploadedFile(filename, fh.read()))
+
+        progress = []
+        for part in imp.process():
+            progress.append((imp.progress_saved,
+                             DocumentImport.objects.get(pk=imp.pk).processed))
+            if imp.processed == 3:
+                break  # as if the worker died
+        self.assertEqual(progress, [(False, 0), (True, 2), (False, 2)])
+        # resumes after the last imported page, not the last saved one
+        self.assertEqual(DocumentImport.objects.get(pk=imp.pk).resume_at(), 3)
+
+    def make_pagexml_import(self, truncate=False):
+        # a PAGE file of 3 pages, one per part
+        mock_path = os.path.join(os.path.dirname(__file__), 'mocks', 'pagexml_test.xml')
+        with open(mock_path) as fh:
+            content = fh.read()
+        start, end = content.index('<Page '), content.index('</Page>') + len('</Page>')
+        pages = [content[start:end].replace('test3.png', 'test%d.png' % i) for i in range(1, 4)]
+        content = content[:start] + '\n'.join(pages) + content[end:]
+        if truncate:
+            # in the middle of the second page
+            content = content[:start + len(pages[0]) + len(pages[1]) // 2]
+        return DocumentImport.objects.create(
+            document=self.document,
+            started_by=self.document.owner,
+            import_file=SimpleUploadedFile('multi.xml', content.encode()),
+            report=TaskReport.objects.create(user=self.document.owner, label='import'))
+
+    @override_settings(IMPORT_VALIDATE_XML=False)
+    def test_pagexml_truncated(self):
+        imp = self.make_pagexml_import(truncate=True)
+        imported = []
+        with self.assertRaises(ParseError):
+            for part in imp.process():
+                imported.append(part.pk)
+        # the pages before the error were imported
+        self.assertEqual(imported, [self.part1.pk])
+        self.assertGreater(self.part1.lines.count(), 0)
+        self.assertEqual(self.part2.lines.count(), 0)
+        imp.refresh_from_db()
+        self.assertEqual(imp.workflow_state, imp.WORKFLOW_STATE_ERROR)
+        self.assertIn('Invalid XML', imp.report.messages)
+
+    @override_settings(IMPORT_VALIDATE_XML=False)
+    def test_pagexml_resume(self):
+        imp = self.make_pagexml_import()
+        imp.workflow_state = imp.WORKFLOW_STATE_ERROR
+        imp.processed = 1
+        imp.save()
+        self.assertEqual([part.pk for part in imp.process()], [self.part2.pk, self.part3.pk])
+        # the first page was not imported again
+        self.assertEqual(self.part1.lines.count(), 0)
+        self.assertEqual(self.part2.lines.count(), self.part3.lines.count())
+        self.assertGreater(self.part2.lines.count(), 0)
+        imp.refresh_from_db()
+        self.assertEqual(imp.processed, 3)
+        self.assertEqual(imp.workflow_state, imp.WORKFLOW_STATE_DONE)
+
+    @override_settings(IMPORT_PROGRESS_EVERY=2, IMPORT_PROGRESS_INTERVAL=3600)
+    def test_progress_events(self):
+        uri = reverse('api:document-imports', kwargs={'pk': self.document.pk})
+        filename = 'test_pagexml.zip'
+        mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
+        with open(mock_path, 'rb') as fh, mock.patch('imports.tasks.send_event') as send_event:
+            response = self.client.post(uri, {
+                'upload_file': SimpleUploadedFile(filename, fh.read())
+            })
+        self.assertEqual(response.status_code, 200, response.content)
+        events = [c[0][2:] for c in send_event.call_args_list]
+        # the last page isn't a checkpoint, the final count is sent anyway
+        self.assertEqual([data['progress'] for name, data in events if name == 'import:progress'],
+                         [2, 3])
+        self.assertEqual(events[-1][0], 'import:done')
+
     def test_name(self):
         trans = Transcription.objects.create(name=AltoParser.DEFAULT_NAME, document=self.document)
         b = Block.objects.create(document_part=self.part1, external_id="textblock_0",
@@ -339,7 +515,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_pagexml.zip'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(417):  # there's a lot of lines in there
+            with self.assertNumQueries(47):  # lines are inserted in bulk
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -368,7 +544,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_pagexml_types.xml'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(78):
+            with self.assertNumQueries(40):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -389,40 +565,47 @@ class XmlImportTestCase(CoreFactoryTestCase):
         self.assertEqual(self.part1.lines.count(), 3)
 
     def test_iiif(self):
-        filename = 'iiif.json'
+        filename = 'test.png'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
+            image = fh.read()
 
-            imp = DocumentImport(
-                document=self.document,
-                name='test',
-                started_by=self.document.owner
-            )
-            imp.import_file.save(
-                'iiif_manifest.json',
-                ContentFile(fh.read()))
-
-            # we don't go through the form but we want to test json validation
-            fh.seek(0)
-            IIIFManifestParser(self.document, fh, imp.report).validate()
+        with StandInIIIFServer(content=image) as server:
+            filename = 'iiif.json'
+            mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
+            with open(mock_path, 'rb') as fh:
+                # the images are fetched from the local server
+                manifest = fh.read().replace(b'https://gallica.bnf.fr', server.url.encode())
 
-            imp.save()
+                imp = DocumentImport(
+                    document=self.document,
+                    name='test',
+                    started_by=self.document.owner
+                )
+                imp.import_file.save(
+                    'iiif_manifest.json',
+                    ContentFile(manifest))
 
-        # mock images grabbing
-        filename = 'test.png'
-        mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
-        with open(mock_path, 'rb') as fh:
-            # mock the image grabbing
-            mock_resp = mock.Mock(content=fh.read(), status_code=200)
-            with mock.patch('requests.get', return_value=mock_resp):
-                for part in imp.process():  # exaust the generator
-                    pass
+                # we don't go through the form but we want to test json validation
+                fh.seek(0)
+                IIIFManifestParser(self.document, fh, imp.report).validate()
+
+                imp.save()
+
+            for part in imp.process():  # exaust the generator
+                pass
 
         self.assertEqual(imp.workflow_state, imp.WORKFLOW_STATE_DONE)
         self.assertEqual(imp.processed, 5)
 
         # +2 from factory # change 7 by 8 i addedpart 3 manuallly
         self.assertEqual(self.document.parts.count(), 8)
+        part = self.document.parts.order_by('order').last()
+        self.assertEqual(part.image_file_size, len(image))
+        # canvas order is kept
+        parts = self.document.parts.filter(source__startswith=server.url).order_by('order')
+        self.assertEqual([p.source.split('/')[-5] for p in parts],
+                         ['f1', 'f2', 'f3', 'f4', 'f5'])
 
     def test_cancel(self):
         # Note: not actually testing celery's revoke
@@ -441,6 +624,215 @@ class XmlImportTestCase(CoreFactoryTestCase):
         self.assertEqual(response.status_code, 400)
 
 
+class ZipImportTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.factory.make_document()
+        self.images = []
+        for i in range(5):
+            fh = BytesIO()
+            Image.new('RGB', size=(60, 60), color=(i * 50, 0, 0)).save(fh, 'png')
+            self.images.append(('page%d.png' % i, fh.getvalue()))
+
+    def make_zip(self, images):
+        fh = BytesIO()
+        with ZipFile(fh, 'w', ZIP_STORED) as zip_:
+            for name, content in images:
+                zip_.writestr(name, content)
+        fh.name = 'test.zip'
+        fh.seek(0)
+        return fh
+
+    def parse(self, fh):
+        report = TaskReport(user=self.document.owner)
+        parser = make_parser(self.document, fh, report=report)
+        archive = parser.archive
+        parts = list(parser.parse(user=self.document.owner))
+        # the archive was closed at the end of the parsing
+        self.assertIsNone(archive.fp)
+        return parts, report
+
+    @override_settings(ZIP_IMPORT_THREADS=3)
+    def test_order(self):
+        parts, report = self.parse(self.make_zip(self.images))
+        # the images were extracted in parallel but the parts were created in order
+        self.assertEqual(report.messages, '')
+        self.assertEqual(list(self.document.parts.order_by('order')
+                              .values_list('original_filename', flat=True)),
+                         [name for name, content in self.images])
+        for part, (name, content) in zip(self.document.parts.order_by('order'), self.images):
+            with part.image.open('rb') as fh:
+                self.assertEqual(fh.read(), content)
+
+    @override_settings(ZIP_IMPORT_THREADS=2)
+    def test_corrupted_member(self):
+        fh = self.make_zip(self.images)
+        data = bytearray(fh.getvalue())
+        # flips a byte in the middle of the second image, its CRC doesn't match anymore
+        content = self.images[1][1]
+        offset = data.index(content) + len(content) // 2
+        data[offset] ^= 0xff
+        fh = BytesIO(bytes(data))
+        fh.name = 'test.zip'
+        parts, report = self.parse(fh)
+        self.assertIn('Parse error in test.zip', report.messages)
+        self.assertEqual(list(self.document.parts.order_by('order')
+                              .values_list('original_filename', flat=True)),
+                         [name for name, content in self.images if name != 'page1.png'])
+
+
+@skipIf(not pyvips.type_find('VipsForeign', 'pdfload'), 'libvips was built without pdf support.')
+class PdfImportTestCase(CoreFactoryTestCase):
+    def make_pdf(self, n_pages):
+        fh = BytesIO()
+        pages = [Image.new('RGB', size=(60, 60), color=(i * 50, 0, 0)) for i in range(n_pages)]
+        pages[0].save(fh, 'pdf', save_all=True, append_images=pages[1:])
+        return SimpleUploadedFile('test.pdf', fh.getvalue())
+
+    @override_settings(PDF_IMPORT_PROCESSES=1)
+    def test_parse(self):
+        document = self.factory.make_document()
+        parser = make_parser(document, self.make_pdf(3))
+        self.assertEqual(parser.total, 3)
+        # the uploaded file was copied to disk to be read by libvips
+        path = parser.path
+        parts = list(parser.parse(user=document.owner))
+        self.assertEqual([part.original_filename for part in parts],
+                         ['test.pdf_page_%d.png' % i for i in range(1, 4)])
+        for part in parts:
+            self.assertTrue(os.path.exists(part.image.path))
+        # and the copy was deleted afterwards
+        self.assertFalse(os.path.exists(path))
+
+
+class ImageFetcherTestCase(SimpleTestCase):
+    def test_order(self):
+        with StandInIIIFServer(delay=0.05) as server:
+            urls = ['%s/image%d/full/full/0/default.jpg' % (server.url, i) for i in range(10)]
+            fetcher = ImageFetcher(concurrency=3)
+            contents = []
+            for fh in fetcher.fetch_all(urls):
+                contents.append(fh.read().decode())
+                fh.close()
+
+        self.assertEqual(contents, [url[len(server.url):] for url in urls])
+        # never more than the concurrency at the same time on the same host
+        self.assertLessEqual(server.max_active, 3)
+        self.assertGreater(server.max_active, 1)
+
+    def test_retry(self):
+        with StandInIIIFServer() as server:
+            fetcher = ImageFetcher(concurrency=2, retry_limit=3)
+            fh = fetcher.fetch(server.url + '/unavailable/2/image')
+            self.assertEqual(fh.read(), b'/unavailable/2/image')
+            fh.close()
+            self.assertEqual(server.hits['/unavailable/2/image'], 3)
+
+            with self.assertRaises(DownloadError):
+                fetcher.fetch(server.url + '/unavailable/3/image')
+            self.assertEqual(server.hits['/unavailable/3/image'], 3)
+
+    def test_errors(self):
+        with StandInIIIFServer() as server:
+            urls = [server.url + '/image1', server.url + '/missing/image', server.url + '/image2']
+            results = list(ImageFetcher(concurrency=2).fetch_all(urls))
+
+        self.assertEqual(results[0].read(), b'/image1')
+        self.assertIsInstance(results[1], DownloadError)
+        self.assertEqual(results[2].read(), b'/image2')
+        for fh in (results[0], results[2]):
+            fh.close()
+
+
+class SchemaCacheTestCase(SimpleTestCase):
+    XSD = b"""<?xml version="1.0"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="page" type="xs:string"/>
+</xs:schema>"""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        schemas._compiled.clear()
+
+    def tearDown(self):
+        schemas._compiled.clear()
+
+    def test_fetched_once(self):
+        with override_settings(XSD_CACHE_DIR=self.cache_dir):
+            with StandInIIIFServer(content=self.XSD) as server:
+                location = server.url + '/schema.xsd'
+                schema = schemas.get_schema(location)
+                self.assertTrue(schema.validate(etree.XML(b'<page>test</page>')))
+                self.assertFalse(schema.validate(etree.XML(b'<line>test</line>')))
+                # compiled once per process
+                self.assertIs(schemas.get_schema(location), schema)
+                # another process reads it from the disk cache
+                schemas._compiled.clear()
+                schemas.get_schema(location)
+            self.assertEqual(server.hits['/schema.xsd'], 1)
+            self.assertTrue(os.path.exists(schemas.cache_path(location)))
+
+    def test_unavailable(self):
+        with override_settings(XSD_CACHE_DIR=self.cache_dir):
+            with StandInIIIFServer() as server:
+                with self.assertRaises(schemas.SchemaUnavailable):
+                    schemas.get_schema(server.url + '/missing/schema.xsd')
+                # not an xsd, not cached
+                with self.assertRaises(schemas.SchemaUnavailable):
+                    schemas.get_schema(server.url + '/schema.xsd')
+                self.assertFalse(os.path.exists(schemas.cache_path(server.url + '/schema.xsd')))
+
+
+class RenderPartsTestCase(SimpleTestCase):
+    """The pool of processes of the exports, threads stand in for them."""
+
+    class StubPart:
+        def __init__(self, pk):
+            self.pk = pk
+
+    class StubWriter:
+        def render(self, part):
+            if part.pk == 3:
+                raise ValueError('broken part %d' % part.pk)
+            # the pages aren't rendered in order
+            time.sleep(0.01 * (5 - part.pk))
+            return b'<page %d/>' % part.pk
+
+    class StubParts:
+        def get(self, pk):
+            return RenderPartsTestCase.StubPart(pk)
+
+    def setUp(self):
+        self.parts = [self.StubPart(pk) for pk in range(1, 6)]
+        self.writer = self.StubWriter()
+
+    def check_pages(self, pages):
+        self.assertEqual([part.pk for part, page in pages], [1, 2, 3, 4, 5])
+        for part, page in pages:
+            if part.pk == 3:
+                self.assertIsInstance(page, Exception)
+                self.assertIn('broken part 3', str(page))
+            else:
+                self.assertEqual(page, b'<page %d/>' % part.pk)
+
+    def test_in_process(self):
+        self.check_pages(list(export.render_parts(self.writer, self.parts)))
+
+    def test_executor(self):
+        # what init_worker does in the processes of the pool
+        export.init_worker(self.writer)
+        stub_model = type('StubDocumentPart', (), {'objects': self.StubParts()})
+        try:
+            with mock.patch.object(export, 'DocumentPart', stub_model), \
+                 ThreadPoolExecutor(max_workers=3) as executor:
+                pages = list(export.render_parts(self.writer, self.parts, executor, ahead=3))
+        finally:
+            export.init_worker(None)
+        self.check_pages(pages)
+        # the error is reported as it doesn't survive pickling
+        self.assertIsInstance(pages[2][1], export.RenderError)
+
+
 class DocumentExportTestCase(CoreFactoryTestCase):
     def setUp(self):
         super().setUp()
@@ -476,12 +868,69 @@ class DocumentExportTestCase(CoreFactoryTestCase):
                                          'region_types': self.region_types_choices})
             self.assertEqual(response.status_code, 200)
 
-        # self.assertEqual(''.join([c.decode() for c in response.streaming_content]),
-        #                  "line 1:1\nline 1:2\nline 1:3\nline 2:1\nline 2:2\nline 2:3\n")
+    def test_stream(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('api:document-export',
+                                            kwargs={'pk': self.trans.document.pk}),
+                                    {'transcription': self.trans.pk,
+                                     'file_format': 'text',
+                                     'streaming': True,
+                                     'parts': [str(p.pk) for p in self.parts],
+                                     'region_types': self.region_types_choices})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join([c.decode() for c in response.streaming_content]),
+                         "line 1:1\nline 1:2\nline 1:3\nline 2:1\nline 2:2\nline 2:3\n")
+
+    def test_stream_zip(self):
+        self.client.force_login(self.user)
+        uri = reverse('api:document-export', kwargs={'pk': self.trans.document.pk})
+        params = {'transcription': self.trans.pk,
+                  'file_format': 'alto',
+                  'include_images': True,
+                  'parts': [str(p.pk) for p in self.parts],
+                  'region_types': self.region_types_choices}
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+             override_settings(EXPORT_CACHE_DIR=cache_dir):
+            response = self.client.get(uri, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+            content = b''.join(response.streaming_content)
+            with ZipFile(BytesIO(content)) as zip_:
+                self.assertIsNone(zip_.testzip())
+                # the images are stored as is
+                self.assertEqual([(info.filename, info.compress_type) for info in zip_.infolist()],
+                                 [(name, compress_type)
+                                  for p in self.parts
+                                  for name, compress_type in (
+                                      (p.filename, ZIP_STORED),
+                                      ('%s.xml' % os.path.splitext(p.filename)[0], ZIP_DEFLATED))])
+
+            # the time spent counts towards the CPU quota
+            report = TaskReport.objects.filter(user=self.user).latest('pk')
+            self.assertEqual(report.workflow_state, report.WORKFLOW_STATE_DONE)
+            self.assertIsNotNone(report.cpu_cost)
+            # the size of the zip was kept for the resumed downloads
+            self.assertEqual(os.listdir(os.path.join(cache_dir, 'sizes')),
+                             [response['ETag'].strip('"')])
+
+            # resumes the download
+            response = self.client.get(uri, params, HTTP_RANGE='bytes=100-',
+                                       HTTP_IF_RANGE=response['ETag'])
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'],
+                             'bytes 100-%d/%d' % (len(content) - 1, len(content)))
+            self.assertEqual(b''.join(response.streaming_content), content[100:])
+
+            # the export changed meanwhile
+            response = self.client.get(uri, params, HTTP_RANGE='bytes=100-',
+                                       HTTP_IF_RANGE='"outdated"')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), content)
 
     def test_alto(self):
         self.client.force_login(self.user)
-        with self.assertNumQueries(30):
+        with self.assertNumQueries(28):
             response = self.client.post(reverse('api:document-export',
                                                 kwargs={'pk': self.trans.document.pk}),
                                         {'transcription': self.trans.pk,
@@ -491,6 +940,127 @@ class DocumentExportTestCase(CoreFactoryTestCase):
             self.assertEqual(response.status_code, 200)
         # self.assertEqual(response.content, '')
 
+    def test_writers(self):
+        document = self.trans.document
+        bt = BlockType.objects.create(name='test block type')
+        lt = LineType.objects.create(name='test line type')
+        document.valid_block_types.add(bt)
+        document.valid_line_types.add(lt)
+        block = Block.objects.create(document_part=self.parts[0], typology=bt,
+                                     box=[[0, 0], [0, 20], [20, 20], [20, 0]])
+        line = self.parts[0].lines.first()
+        line.block = block
+        line.typology = lt
+        line.save()
+        Block.objects.create(document_part=self.parts[1], box=[[0, 0], [0, 20], [20, 20], [20, 0]])
+
+        region_types = [bt.pk]
+        for file_format in (export.ALTO_FORMAT, export.PAGEXML_FORMAT):
+            tplt = loader.get_template(export.XML_TEMPLATES[file_format])
+            writer = export.XML_WRITERS[file_format](document, self.trans, region_types,
+                                                     include_orphans=True,
+                                                     include_undefined=True)
+            for part in self.parts:
+                expected = export.render_xml_page(tplt, document, part, self.trans, region_types,
+                                                  include_orphans=True, include_undefined=True)
+                self.assertEqual(canonical_xml(writer.render(part)),
+                                 canonical_xml(expected.encode()))
+
+    def test_cache(self):
+        pks = [p.pk for p in self.parts]
+        region_types, include_orphans, include_undefined = export.split_region_types(
+            self.region_types_choices)
+
+        def text():
+            return ''.join(export.iter_text(self.trans, pks, region_types,
+                                            include_orphans=include_orphans,
+                                            include_undefined=include_undefined))
+
+        def xml(path):
+            export.write_xml(path, export.ALTO_FORMAT, self.trans.document, pks, self.trans,
+                             region_types, include_orphans=include_orphans,
+                             include_undefined=include_undefined)
+            with ZipFile(path) as zip_:
+                return {name: zip_.read(name) for name in zip_.namelist()}
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+             override_settings(EXPORT_CACHE_DIR=cache_dir):
+            self.assertEqual(text(), "line 1:1\nline 1:2\nline 1:3\nline 2:1\nline 2:2\nline 2:3\n")
+            pages = xml(os.path.join(cache_dir, 'first.zip'))
+
+            lt = LineTranscription.objects.get(content='line 2:2')
+            lt.content = 'changed'
+            lt.save()
+
+            # tokens, parts, lines of the second part
+            with self.assertNumQueries(3):
+                self.assertEqual(text(),
+                                 "line 1:1\nline 1:2\nline 1:3\nline 2:1\nchanged\nline 2:3\n")
+
+            # only the page of the second part is rendered again
+            second = xml(os.path.join(cache_dir, 'second.zip'))
+            first_name, second_name = ['%s.xml' % os.path.splitext(p.filename)[0]
+                                       for p in self.parts]
+            self.assertEqual(second[first_name], pages[first_name])
+            self.assertIn(b'CONTENT="changed"', second[second_name])
+
+            part_dir = export.ExportCache.part_dir(self.parts[0].pk)
+            self.assertEqual(len(os.listdir(part_dir)), 2)  # text and alto
+            export.ExportCache.delete_part(self.parts[0].pk)
+            self.assertFalse(os.path.exists(part_dir))
+
+    @override_settings(IMPORT_VALIDATE_XML=False)
+    def test_cache_import(self):
+        # an import only changing the coordinates invalidates the cached pages
+        part = self.parts[1]
+        part.original_filename = part.filename
+        part.save()
+        pks = [p.pk for p in self.parts]
+        region_types, include_orphans, include_undefined = export.split_region_types(
+            self.region_types_choices)
+        name = '%s.xml' % os.path.splitext(part.filename)[0]
+
+        def xml(path):
+            export.write_xml(path, export.ALTO_FORMAT, self.trans.document, pks, self.trans,
+                             region_types, include_orphans=include_orphans,
+                             include_undefined=include_undefined)
+            with ZipFile(path) as zip_:
+                return zip_.read(name)
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+             override_settings(EXPORT_CACHE_DIR=cache_dir):
+            page = xml(os.path.join(cache_dir, 'first.zip'))
+            self.assertIn(b'BASELINE="5 5 5 10"', page)
+            fh = BytesIO(page.replace(b'BASELINE="5 5 5 10"', b'BASELINE="5 6 50 6"'))
+            fh.name = 'import.xml'
+            parser = make_parser(self.trans.document, fh, name=self.trans.name,
+                                 report=TaskReport(user=self.user))
+            self.assertEqual([p.pk for p in parser.parse(user=self.user)], [part.pk])
+            page = xml(os.path.join(cache_dir, 'second.zip'))
+            self.assertNotIn(b'BASELINE="5 5 5 10"', page)
+            self.assertIn(b'BASELINE="5 6 50 6"', page)
+
+    def test_purge_cache(self):
+        pks = [p.pk for p in self.parts]
+        other = self.factory.make_transcription(document=self.trans.document, name='other')
+        with tempfile.TemporaryDirectory() as cache_dir, \
+             override_settings(EXPORT_CACHE_DIR=cache_dir):
+            for transcription in (self.trans, other):
+                ''.join(export.iter_text(transcription, pks, []))
+            part_dir = export.ExportCache.part_dir(pks[0])
+            self.assertEqual(len(os.listdir(part_dir)), 2)
+
+            # the text of the deleted transcription
+            other.delete()
+            self.assertEqual(export.ExportCache.purge(3600), 2)
+            self.assertEqual(len(os.listdir(part_dir)), 1)
+
+            # the text unused for too long
+            path = os.path.join(part_dir, os.listdir(part_dir)[0])
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+            self.assertEqual(export.ExportCache.purge(3600), 1)
+            self.assertFalse(os.path.exists(part_dir))
+
     def test_alto_qs_scaling(self):
         for i in range(4, 20):
             part = self.factory.make_part(name='part %d' % i,
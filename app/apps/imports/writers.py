@@ -0,0 +1,194 @@
+"""
+ALTO 4 and PAGE 2019 writers of the document exports.
+
+They produce the same documents as the export/alto.xml and export/pagexml.xml templates
+(without their indentation) but write them incrementally with lxml.etree.xmlfile,
+the boxes of the blocks and lines are computed once
+and the typologies of the document are only fetched once for all the parts.
+"""
+from io import BytesIO
+
+from django.db.models import Q, Prefetch, Avg
+from django.utils import timezone
+from lxml import etree
+
+from core.models import Line
+from imports.templatetags.export_tags import alto_points, pagexml_points
+
+XSI_NAMESPACE = 'http://www.w3.org/2001/XMLSchema-instance'
+
+
+class XMLWriter:
+    NAMESPACE = None
+    SCHEMA_LOCATION = None
+    STANDALONE = None
+
+    def __init__(self, document, transcription, region_types,
+                 include_orphans=False, include_undefined=False):
+        self.document = document
+        self.transcription = transcription
+        self.region_filters = Q(typology_id__in=region_types)
+        if include_undefined:
+            self.region_filters |= Q(typology_id__isnull=True)
+        self.include_orphans = include_orphans
+        self.valid_block_types = list(document.valid_block_types.all())
+        self.valid_line_types = list(document.valid_line_types.all())
+
+    def tag(self, name):
+        return '{%s}%s' % (self.NAMESPACE, name)
+
+    def root(self, xf, name):
+        return xf.element(self.tag(name),
+                          {'{%s}schemaLocation' % XSI_NAMESPACE: self.SCHEMA_LOCATION},
+                          nsmap={None: self.NAMESPACE, 'xsi': XSI_NAMESPACE})
+
+    def leaf(self, xf, name, attrib=None, text=None):
+        with xf.element(self.tag(name), attrib or {}):
+            if text:
+                xf.write(text)
+
+    def lines(self):
+        return Line.objects.prefetch_transcription(self.transcription).select_related('typology')
+
+    def blocks(self, part):
+        return (part.blocks.filter(self.region_filters)
+                .select_related('typology')
+                .annotate(avglo=Avg('lines__order'))
+                .order_by('avglo')
+                .prefetch_related(Prefetch('lines', queryset=self.lines())))
+
+    def orphan_lines(self, part):
+        if not self.include_orphans:
+            return []
+        return list(self.lines().filter(document_part=part, block=None))
+
+    @staticmethod
+    def content(line):
+        return line.transcription and line.transcription[0].content or ''
+
+    def write(self, fh, part):
+        with etree.xmlfile(fh, encoding='UTF-8') as xf:
+            xf.write_declaration(standalone=self.STANDALONE)
+            self.write_page(xf, part)
+
+    def write_page(self, xf, part):
+        raise NotImplementedError
+
+    def render(self, part):
+        fh = BytesIO()
+        self.write(fh, part)
+        return fh.getvalue()
+
+
+class AltoWriter(XMLWriter):
+    NAMESPACE = 'http://www.loc.gov/standards/alto/ns-v4#'
+    SCHEMA_LOCATION = ('http://www.loc.gov/standards/alto/ns-v4# '
+                       'http://www.loc.gov/standards/alto/v4/alto-4-2.xsd')
+
+    def write_page(self, xf, part):
+        size = {'WIDTH': str(part.image.width), 'HEIGHT': str(part.image.height)}
+        with self.root(xf, 'alto'):
+            with xf.element(self.tag('Description')):
+                self.leaf(xf, 'MeasurementUnit', text='pixel')
+                with xf.element(self.tag('sourceImageInformation')):
+                    self.leaf(xf, 'fileName', text=part.filename)
+                    if part.source:
+                        self.leaf(xf, 'fileIdentifier', text=part.source)
+
+            if self.valid_block_types or self.valid_line_types:
+                with xf.element(self.tag('Tags')):
+                    for type_ in self.valid_block_types:
+                        self.leaf(xf, 'OtherTag', {'ID': 'BT%d' % type_.id,
+                                                   'LABEL': type_.name,
+                                                   'DESCRIPTION': 'block type %s' % type_.name})
+                    for type_ in self.valid_line_types:
+                        self.leaf(xf, 'OtherTag', {'ID': 'LT%d' % type_.id,
+                                                   'LABEL': type_.name,
+                                                   'DESCRIPTION': 'line type %s' % type_.name})
+
+            with xf.element(self.tag('Layout')):
+                with xf.element(self.tag('Page'), dict(size, PHYSICAL_IMG_NR=str(part.order),
+                                                       ID='eSc_dummypage_')):
+                    with xf.element(self.tag('PrintSpace'), dict(size, HPOS='0', VPOS='0')):
+                        for block in self.blocks(part):
+                            self.write_block(xf, block)
+
+                        orphans = self.orphan_lines(part)
+                        if orphans:
+                            with xf.element(self.tag('TextBlock'), {'ID': 'eSc_dummyblock_'}):
+                                for line in orphans:
+                                    self.write_line(xf, line)
+
+    def write_block(self, xf, block):
+        xmin, ymin, xmax, ymax = block.coordinates_box
+        attrib = {'HPOS': str(xmin), 'VPOS': str(ymin),
+                  'WIDTH': str(xmax - xmin), 'HEIGHT': str(ymax - ymin),
+                  'ID': str(block.external_id)}
+        # the template refers to a nonexistent 'BT' tag for the blocks without a type
+        if block.typology_id:
+            attrib['TAGREFS'] = 'BT%d' % block.typology_id
+        with xf.element(self.tag('TextBlock'), attrib):
+            with xf.element(self.tag('Shape')):
+                self.leaf(xf, 'Polygon', {'POINTS': alto_points(block.box)})
+            for line in block.lines.all():
+                self.write_line(xf, line)
+
+    def write_line(self, xf, line):
+        xmin, ymin, xmax, ymax = line.box
+        box = {'HPOS': str(xmin), 'VPOS': str(ymin),
+               'WIDTH': str(xmax - xmin), 'HEIGHT': str(ymax - ymin)}
+        attrib = {'ID': str(line.external_id)}
+        if line.typology_id:
+            attrib['TAGREFS'] = 'LT%d' % line.typology_id
+        if line.baseline:
+            attrib['BASELINE'] = alto_points(line.baseline)
+        attrib.update(box)
+        with xf.element(self.tag('TextLine'), attrib):
+            if line.mask:
+                with xf.element(self.tag('Shape')):
+                    self.leaf(xf, 'Polygon', {'POINTS': alto_points(line.mask)})
+            self.leaf(xf, 'String', dict(box, CONTENT=self.content(line)))
+
+
+class PagexmlWriter(XMLWriter):
+    NAMESPACE = 'http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15'
+    SCHEMA_LOCATION = NAMESPACE + ' ' + NAMESPACE + '/pagecontent.xsd'
+    STANDALONE = True
+
+    def write_page(self, xf, part):
+        now = timezone.now().isoformat()
+        with self.root(xf, 'PcGts'):
+            with xf.element(self.tag('Metadata'), part.source and {'externalRef': part.source} or {}):
+                self.leaf(xf, 'Creator', text='escriptorium')
+                self.leaf(xf, 'Created', text=now)
+                self.leaf(xf, 'LastChange', text=now)
+
+            with xf.element(self.tag('Page'), {'imageFilename': part.filename,
+                                               'imageWidth': str(part.image.width),
+                                               'imageHeight': str(part.image.height)}):
+                for block in self.blocks(part):
+                    attrib = {'id': str(block.external_id)}
+                    if block.typology:
+                        attrib['custom'] = 'structure {type:%s;}' % block.typology.name
+                    with xf.element(self.tag('TextRegion'), attrib):
+                        self.leaf(xf, 'Coords', {'points': pagexml_points(block.box)})
+                        for line in block.lines.all():
+                            self.write_line(xf, line)
+
+                orphans = self.orphan_lines(part)
+                if orphans:
+                    with xf.element(self.tag('TextRegion'), {'id': 'eSc_dummyblock_'}):
+                        for line in orphans:
+                            self.write_line(xf, line)
+
+    def write_line(self, xf, line):
+        attrib = {'id': str(line.external_id)}
+        if line.typology:
+            attrib['custom'] = 'structure {type:%s;}' % line.typology.name
+        with xf.element(self.tag('TextLine'), attrib):
+            if line.mask:
+                self.leaf(xf, 'Coords', {'points': pagexml_points(line.mask)})
+            if line.baseline:
+                self.leaf(xf, 'Baseline', {'points': pagexml_points(line.baseline)})
+            with xf.element(self.tag('TextEquiv')):
+                self.leaf(xf, 'Unicode', text=self.content(line))
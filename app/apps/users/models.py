@@ -4,7 +4,7 @@ import uuid
 from datetime import datetime, date, timedelta
 
 from django.conf import settings
-from django.db import models
+from django.db import connection, models
 from django.db.models import Sum
 from django.contrib.auth.models import AbstractUser, Group
 from django.utils.translation import gettext as _
@@ -60,7 +60,15 @@ class User(AbstractUser):
 
     def calc_disk_usage(self):
         models_size = self.ocrmodel_set.aggregate(Sum('file_size'))['file_size__sum'] or 0
-        images_size = self.document_set.aggregate(Sum('parts__image_file_size'))['parts__image_file_size__sum'] or 0
+        # identical images are shared by the parts of a document, they are only counted once
+        images = (self.document_set.filter(parts__isnull=False)
+                  .order_by()
+                  .values_list('parts__image', 'parts__image_file_size').distinct())
+        sql, params = images.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COALESCE(SUM(images.image_file_size), 0) FROM (%s) AS images' % sql,
+                           params)
+            images_size = cursor.fetchone()[0]
         return models_size + images_size
 
     def disk_storage_limit(self):
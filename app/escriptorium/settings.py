@@ -317,6 +317,11 @@ ALWAYS_CONVERT = False
 
 FILE_UPLOAD_PERMISSIONS = 0o644
 THUMBNAIL_ENABLE = True
+# deep zoom pyramid of tiles of the images, generated with the thumbnails
+TILES_ENABLE = True
+# Biggest images rendered by the iiif api of the parts, in pixels
+IIIF_MAX_WIDTH = int(os.getenv('IIIF_MAX_WIDTH', 4096))
+IIIF_MAX_AREA = int(os.getenv('IIIF_MAX_AREA', 4096 * 4096))
 THUMBNAIL_ALIASES = {
     '': {
         'list': {'size': (50, 50), 'crop': 'center'},
@@ -339,10 +344,43 @@ VERSION_DATE = os.getenv('VERSION_DATE', '<development>')
 KRAKEN_VERSION = subprocess.getoutput('kraken --version')
 
 IIIF_IMPORT_QUALITY = 'full'
+# Validates the imported ALTO and PAGE files against their schema (in the background of the import)
+IMPORT_VALIDATE_XML = os.getenv('IMPORT_VALIDATE_XML', "True").lower() not in ("false", "0")
+# Where the schemas fetched for the validation are cached
+XSD_CACHE_DIR = os.getenv('XSD_CACHE_DIR', os.path.join(BASE_DIR, 'xsd_cache'))
+# Maximum number of images downloaded simultaneously from the same IIIF server
+IIIF_IMPORT_CONCURRENCY = int(os.getenv('IIIF_IMPORT_CONCURRENCY', 4))
+# Number of processes rendering the pages of an imported PDF, 1 renders them in the worker itself
+PDF_IMPORT_PROCESSES = int(os.getenv('PDF_IMPORT_PROCESSES', 4))
+# Number of threads extracting the images of an imported zip
+ZIP_IMPORT_THREADS = int(os.getenv('ZIP_IMPORT_THREADS', 4))
+# The progress of an import is saved and sent to the browser every IMPORT_PROGRESS_EVERY imported
+# pages or IMPORT_PROGRESS_INTERVAL seconds, whichever comes first
+IMPORT_PROGRESS_EVERY = int(os.getenv('IMPORT_PROGRESS_EVERY', 20))
+IMPORT_PROGRESS_INTERVAL = float(os.getenv('IMPORT_PROGRESS_INTERVAL', 2))
+# The resumable uploads of imports older than that many hours are deleted by the purge_import_uploads command
+IMPORT_UPLOAD_MAX_AGE = int(os.getenv('IMPORT_UPLOAD_MAX_AGE', 24))
+# Number of processes rendering the pages of the ALTO and PAGE exports, 1 renders them in the worker itself
+EXPORT_PROCESSES = int(os.getenv('EXPORT_PROCESSES', 4))
+# Where the rendered pages of the exports are cached, the cache is disabled if empty,
+# it has to be shared by the web and celery containers
+EXPORT_CACHE_DIR = os.getenv('EXPORT_CACHE_DIR', os.path.join(MEDIA_ROOT, 'export_cache'))
+# The cached pages unused for that many days are removed by the purge_export_cache command
+EXPORT_CACHE_MAX_AGE = int(os.getenv('EXPORT_CACHE_MAX_AGE', 30))
 
 KRAKEN_TRAINING_DEVICE = os.getenv('KRAKEN_TRAINING_DEVICE', 'cpu')
 KRAKEN_TRAINING_LOAD_THREADS = int(os.getenv('KRAKEN_TRAINING_LOAD_THREADS', 0))
 KRAKEN_DEFAULT_SEGMENTATION_MODEL = SEGMENTATION_DEFAULT_MODEL
+# Memory budget (in Mb) of the per worker cache of loaded kraken models, 0 disables it
+KRAKEN_MODEL_CACHE_SIZE = int(os.getenv('KRAKEN_MODEL_CACHE_SIZE', 1024))
+# Number of processes used to calculate the masks of pages with at least KRAKEN_MASKS_PARALLEL_MIN_LINES lines
+KRAKEN_MASKS_PROCESSES = int(os.getenv('KRAKEN_MASKS_PROCESSES', 4))
+KRAKEN_MASKS_PARALLEL_MIN_LINES = int(os.getenv('KRAKEN_MASKS_PARALLEL_MIN_LINES', 100))
+# Images needing more memory (in Mb) than this to be binarized are binarized by overlapping tiles, 0 disables it
+BINARIZATION_MEMORY_LIMIT = int(os.getenv('BINARIZATION_MEMORY_LIMIT', 1024))
+BINARIZATION_TILE_OVERLAP = int(os.getenv('BINARIZATION_TILE_OVERLAP', 128))
+# Number of processes the tiles are spread over when binarizing a whole document
+BINARIZATION_PROCESSES = int(os.getenv('BINARIZATION_PROCESSES', 4))
 
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
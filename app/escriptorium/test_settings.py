@@ -18,6 +18,10 @@ class DisableMigrations(object):
 MIGRATION_MODULES = DisableMigrations()
 
 KRAKEN_TRAINING_LOAD_THREADS = 0
+# the connections of the export processes wouldn't see the data of the test transactions
+EXPORT_PROCESSES = 1
+# enabled by the tests of the cache only
+EXPORT_CACHE_DIR = ''
 
 # Disables easy-thumbnail spamming
 THUMBNAIL_OPTIMIZE_COMMAND = {}
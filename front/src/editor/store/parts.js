@@ -64,8 +64,12 @@ export const actions = {
     },
 
     async rotate({state, commit, dispatch, rootState}, angle) {
+        // the rotation happens in the background,
+        // the part is reloaded when the part:rotated event is received
         await api.rotateDocumentPart(rootState.document.id, state.pk, {angle: angle})
+    },
 
+    async reload({state, commit, dispatch, rootState}) {
         let pk = state.pk
         commit('regions/reset', {}, {root: true})
         commit('lines/reset', {}, {root: true})